@@ -0,0 +1,183 @@
+import math
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from flask import abort, g, request
+
+from constants import RATE_LIMITS, CONCURRENCY_LIMITS, RATE_LIMIT_MAX_KEYS
+
+
+'''
+InMemoryBucketStore
+    token buckets of the current process. A bucket holds up to burst tokens
+    and gains rate tokens per second; each request takes one. At most
+    max_keys buckets are kept, the least recently used being evicted first,
+    which only ever hands a client a full bucket again
+'''
+
+
+class InMemoryBucketStore:
+
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, key, rate, burst):
+        '''
+        takes a token from the bucket of key and returns 0, or returns the
+        seconds until a token is available without taking any
+        '''
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+'''
+KeyValueBucketStore
+    token buckets shared by all workers through a key-value store, e.g. a
+    redis client or kvstore.LocalKeyValueStore. Each bucket is kept as the
+    time at which it will be full again (the theoretical arrival time of
+    GCRA), which admits the same requests as a token bucket with a single
+    value. The read and the write are not atomic, so workers racing on one
+    client may let a request or two more through
+'''
+
+
+class KeyValueBucketStore:
+
+    def __init__(self, client, prefix='rate_limit:'):
+        self.client = client
+        self.prefix = prefix
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        interval = 1.0 / rate
+        value = self.client.get(self.prefix + key)
+        full_at = max(float(value) if value is not None else now, now)
+        # a full bucket is at now, taking a token pushes it by one interval
+        wait = full_at + interval - now - burst * interval
+        if wait > 0:
+            return wait
+        full_at += interval
+        self.client.set(self.prefix + key, repr(full_at),
+                        ex=int(math.ceil(full_at - now)) + 1)
+        return 0
+
+
+'''
+AdmissionControl
+    admits or rejects requests before they reach the database. Rate limits
+    map a route name to (rate, burst): the requests per second and the
+    burst allowed for each client, as told by client_key(request).
+    Concurrency limits map a route name to the number of its requests
+    served at once across clients; requests beyond it are shed rather than
+    queued for a connection
+'''
+
+
+class AdmissionControl:
+
+    def __init__(self, rate_limits=None, concurrency_limits=None, store=None,
+                 client_key=None):
+        self.rate_limits = rate_limits or {}
+        self.concurrency_limits = concurrency_limits or {}
+        self.store = store or InMemoryBucketStore()
+        self.client_key = client_key or (lambda request: request.remote_addr)
+        self._lock = threading.Lock()
+        self._in_flight = defaultdict(int)
+        self.rejected = defaultdict(int)
+        self.shed = defaultdict(int)
+
+    def admit(self, name):
+        '''
+        aborts with 429 when the client exceeded the rate limit of the
+        route, with 503 when the route serves as many requests as it may.
+        Admitted requests are counted until release() is called with the
+        names the request was admitted under, kept in g.admitted
+        '''
+        if name in self.rate_limits:
+            rate, burst = self.rate_limits[name]
+            wait = self.store.take(
+                '{}:{}'.format(name, self.client_key(request)), rate, burst)
+            if wait:
+                with self._lock:
+                    self.rejected[name] += 1
+                abort(429, retry_after=int(math.ceil(wait)))
+
+        if name in self.concurrency_limits:
+            with self._lock:
+                limit = self.concurrency_limits[name]
+                admitted = self._in_flight[name] < limit
+                if admitted:
+                    self._in_flight[name] += 1
+                else:
+                    self.shed[name] += 1
+            if not admitted:
+                abort(503, retry_after=1)
+            g.setdefault('admitted', []).append(name)
+
+    def release(self, names):
+        with self._lock:
+            for name in names:
+                self._in_flight[name] -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": {name: count for name, count
+                              in self._in_flight.items() if count},
+                "rejected": dict(self.rejected),
+                "shed": dict(self.shed)
+            }
+
+
+'''
+init_admission_control(app)
+    applies the RATE_LIMITS and CONCURRENCY_LIMITS of the app config to the
+    endpoints they name. Buckets are kept in RATE_LIMIT_STORE, a redis
+    client to share them across workers, or in memory. Routes serving
+    several operations call admit() with a name of their own
+'''
+
+
+def init_admission_control(app):
+    store = None
+    if app.config.get('RATE_LIMIT_STORE') is not None:
+        store = KeyValueBucketStore(app.config['RATE_LIMIT_STORE'])
+
+    admission = AdmissionControl(
+        app.config.get('RATE_LIMITS', RATE_LIMITS),
+        app.config.get('CONCURRENCY_LIMITS', CONCURRENCY_LIMITS),
+        store, app.config.get('RATE_LIMIT_KEY'))
+
+    @app.before_request
+    def admit_request():
+        if request.endpoint is not None:
+            admission.admit(request.endpoint)
+
+    @app.after_request
+    def release_after_response(response):
+        # a streamed body is still served from the view once it returns
+        names = g.pop('admitted', [])
+        if response.is_streamed:
+            response.call_on_close(lambda: admission.release(names))
+        else:
+            admission.release(names)
+        return response
+
+    @app.teardown_request
+    def release_request(error=None):
+        # requests that failed without a response
+        admission.release(g.pop('admitted', []))
+
+    return admission
@@ -0,0 +1,142 @@
+import asyncio
+import re
+
+from sqlalchemy.dialects.postgresql import psycopg2 as postgresql_psycopg2
+from sqlalchemy.engine.url import make_url
+
+from constants import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, \
+    DB_STATEMENT_TIMEOUT
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+PYFORMAT_PARAMETER = re.compile(r'%\(([^)]+)\)s')
+
+
+'''
+compile_statement(statement, dialect)
+    compiles a SQLAlchemy Core statement into the SQL text and positional
+    arguments asyncpg expects, with $1, $2... placeholders
+'''
+
+
+def compile_statement(statement, dialect=None):
+    compiled = statement.compile(
+        dialect=dialect or postgresql_psycopg2.dialect())
+    params = compiled.params
+    args = []
+
+    def placeholder(match):
+        args.append(params[match.group(1)])
+        return '${}'.format(len(args))
+
+    sql = PYFORMAT_PARAMETER.sub(placeholder, compiled.string)
+    return sql.replace('%%', '%'), args
+
+
+'''
+ExecutorDatabase
+    runs statements on the synchronous engine returned by get_engine in the
+    threads of an executor, so that the event loop never waits on the
+    database. The connection pool of the engine is shared with the WSGI
+    routes. Used for every driver asyncpg does not cover, e.g. SQLite
+'''
+
+
+class ExecutorDatabase:
+
+    def __init__(self, get_engine, executor):
+        self.get_engine = get_engine
+        self.executor = executor
+
+    def _fetch_all(self, statement):
+        return self.get_engine().execute(statement).fetchall()
+
+    async def fetch_all(self, statement):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, self._fetch_all, statement)
+
+    async def fetch_value(self, statement):
+        rows = await self.fetch_all(statement)
+        return rows[0][0] if rows else None
+
+    async def close(self):
+        pass
+
+
+'''
+AsyncpgDatabase
+    runs statements on an asyncpg pool of connections to a Postgres
+    database, created on first use in the running event loop. The pool is
+    sized like the synchronous one: up to DB_POOL_SIZE + DB_MAX_OVERFLOW
+    connections, waiting at most DB_POOL_TIMEOUT seconds for one
+'''
+
+
+class AsyncpgDatabase:
+
+    def __init__(self, database_path, config):
+        url = make_url(database_path)
+        url.drivername = 'postgresql'
+        self.dsn = str(url)
+        self.min_size = config.get('DB_POOL_SIZE', DB_POOL_SIZE)
+        self.max_size = self.min_size + config.get(
+            'DB_MAX_OVERFLOW', DB_MAX_OVERFLOW)
+        self.timeout = config.get('DB_POOL_TIMEOUT', DB_POOL_TIMEOUT)
+        self.server_settings = {}
+        statement_timeout = config.get(
+            'DB_STATEMENT_TIMEOUT', DB_STATEMENT_TIMEOUT)
+        if statement_timeout is not None:
+            self.server_settings['statement_timeout'] = str(
+                int(statement_timeout))
+        self._pool = None
+        self._lock = None
+
+    async def get_pool(self):
+        if self._pool is None:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(
+                        self.dsn, min_size=self.min_size,
+                        max_size=self.max_size,
+                        server_settings=self.server_settings)
+        return self._pool
+
+    async def fetch_all(self, statement):
+        sql, args = compile_statement(statement)
+        pool = await self.get_pool()
+        async with pool.acquire(timeout=self.timeout) as connection:
+            return await connection.fetch(sql, *args)
+
+    async def fetch_value(self, statement):
+        sql, args = compile_statement(statement)
+        pool = await self.get_pool()
+        async with pool.acquire(timeout=self.timeout) as connection:
+            return await connection.fetchval(sql, *args)
+
+    async def close(self):
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await pool.close()
+
+
+'''
+create_database(config, database_path, get_engine, executor)
+    returns the async database of the ASGI app: asyncpg for Postgres when it
+    is installed, unless ASYNC_DATABASE is set to 'executor', and an
+    ExecutorDatabase otherwise
+'''
+
+
+def create_database(config, database_path, get_engine, executor):
+    backend = config.get('ASYNC_DATABASE', 'auto')
+    drivername = make_url(database_path).drivername
+    if backend == 'asyncpg' or (backend == 'auto' and asyncpg is not None and
+                                drivername.startswith('postgres')):
+        return AsyncpgDatabase(database_path, config)
+    return ExecutorDatabase(get_engine, executor)
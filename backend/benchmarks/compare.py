@@ -0,0 +1,66 @@
+'''
+Benchmark comparison
+    compares two JSON results of the same benchmark, e.g. of two commits,
+    printing every rate and latency of the baseline next to the candidate
+    with the relative change. Run from the backend directory:
+
+        python -m benchmarks.compare old.json new.json
+'''
+import argparse
+import json
+
+METRICS = ('rate', 'p50_ms', 'p99_ms', 'seconds')
+
+
+'''
+flatten(results, prefix)
+    yields (name, metric, value) for every metric of nested results
+'''
+
+
+def flatten(results, prefix=''):
+    for key, value in sorted(results.items()):
+        if not isinstance(value, dict):
+            continue
+        name = prefix + key
+        for metric in METRICS:
+            if isinstance(value.get(metric), (int, float)):
+                yield name, metric, value[metric]
+        yield from flatten(value, name + '.')
+
+
+def compare(baseline, candidate):
+    candidate_values = {(name, metric): value for name, metric, value
+                        in flatten(candidate['results'])}
+    rows = []
+    for name, metric, value in flatten(baseline['results']):
+        other = candidate_values.get((name, metric))
+        if other is None:
+            continue
+        change = (other - value) / value * 100 if value else None
+        rows.append((name, metric, value, other, change))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares two benchmark results.')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline_file, \
+            open(args.candidate) as candidate_file:
+        baseline = json.load(baseline_file)
+        candidate = json.load(candidate_file)
+
+    print('{} {} -> {}'.format(
+        baseline['benchmark'], baseline['commit'], candidate['commit']))
+    for name, metric, value, other, change in compare(baseline, candidate):
+        print('  {:<40} {:<7} {:>12.3f} {:>12.3f} {:>8}'.format(
+            name, metric, value, other,
+            '{:+.1f}%'.format(change) if change is not None else '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+'''
+Insert benchmark
+    drives POST /questions with --concurrency clients for --duration
+    seconds, once committing every question on its own, as Question.insert
+    does, and once through the GROUP_COMMIT writer, and reports the inserts
+    per second, the p50/p99 latency and the questions per transaction at
+    every concurrency level. The pool holds a connection per client, so
+    that commits rather than connections are waited for. The questions are
+    deleted afterwards. Results are saved as JSON. Run from the backend
+    directory against a scratch database:
+
+        python -m benchmarks.inserts --concurrency 1 4 16 64 --duration 10
+'''
+import argparse
+import json
+import os
+import threading
+import time
+
+from flaskr import create_app
+from models import db, database_path, Question
+from benchmarks.results import save_results, summarize
+
+MODES = (
+    ('per_row', {}),
+    ('group_commit', {"GROUP_COMMIT": True}),
+)
+
+QUESTION = {
+    "question": 'Which planet has a moon named Phobos?',
+    "answer": 'Mars',
+    "difficulty": 3,
+    "category": 1
+}
+
+
+def run_inserts(app, concurrency, duration):
+    '''
+    returns the latencies of the inserts, the ids of the created questions
+    and the elapsed seconds
+    '''
+    deadline = time.perf_counter() + duration
+    lock = threading.Lock()
+    latencies = []
+    created_ids = []
+
+    def client_loop():
+        client = app.test_client()
+        while time.perf_counter() < deadline:
+            started_at = time.perf_counter()
+            response = client.post('/questions', json=QUESTION)
+            latency = time.perf_counter() - started_at
+            if response.status_code == 200:
+                with lock:
+                    latencies.append(latency)
+                    created_ids.append(
+                        json.loads(response.data)['created']['id'])
+
+    threads = [threading.Thread(target=client_loop)
+               for _ in range(concurrency)]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, created_ids, time.perf_counter() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times POST /questions with and without group commit.')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 4, 16, 64], help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds of every run')
+    parser.add_argument('--output', help='path of the JSON results')
+    args = parser.parse_args()
+
+    path = os.environ.get('DATABASE_PATH', database_path)
+    results = {}
+    for concurrency in args.concurrency:
+        for name, config in MODES:
+            app = create_app(dict(
+                config, DATABASE_PATH=path, DB_CREATE_ALL=False,
+                DB_POOL_SIZE=concurrency))
+            latencies, created_ids, elapsed = run_inserts(
+                app, concurrency, args.duration)
+
+            result = summarize(latencies, elapsed)
+            writer = app.extensions['trivia']['question_writer']
+            batches = writer.stats()['batches'] if writer is not None \
+                else len(created_ids)
+            result['questions_per_commit'] = \
+                len(created_ids) / batches if batches else None
+            results.setdefault(str(concurrency), {})[name] = result
+
+            with app.app_context():
+                Question.delete_all(created_ids)
+                db.get_engine(app).dispose()
+
+            print('{:>4} clients {:<13} {:>9.1f} inserts/s  p50 {:>8.2f}ms'
+                  '  p99 {:>8.2f}ms  {:>6.1f} per commit'.format(
+                      concurrency, name, result['rate'] or 0,
+                      result['p50_ms'] or 0, result['p99_ms'] or 0,
+                      result['questions_per_commit'] or 0))
+
+    print('saved to ' + save_results('inserts', results, args.output))
+
+
+if __name__ == '__main__':
+    main()
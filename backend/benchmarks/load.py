@@ -0,0 +1,186 @@
+'''
+Load driver
+    drives the app in process with --concurrency clients for --duration
+    seconds over a weighted mix of requests: listings at random pages,
+    the category list, category listings, searches and quiz turns. It
+    reports the p50/p99 latency, the rate and the status codes of every
+    endpoint against DATABASE_PATH (the local trivia database by default),
+    preferably filled by benchmarks.seed. --mode asgi runs the clients as
+    coroutines against flaskr.asgi instead of threads against the WSGI app.
+    Results are saved as JSON. Run from the backend directory:
+
+        python -m benchmarks.load --concurrency 32 --duration 30
+'''
+import argparse
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+from flaskr import create_app
+from flaskr.asgi import TriviaASGI
+from models import db, database_path, Question, Category
+from quiz import ALL_CATEGORIES
+from benchmarks.results import save_results, summarize
+from benchmarks.seed import make_vocabulary
+from constants import QUESTIONS_PER_PAGE
+
+# relative weights of the endpoints in the mix
+MIX = (
+    ('GET /questions', 30),
+    ('GET /categories', 10),
+    ('GET /categories/<id>/questions', 20),
+    ('POST /questions (search)', 15),
+    ('POST /quizzes', 25),
+)
+
+
+'''
+RequestMix
+    draws the requests of the mix: (endpoint, method, path, json body)
+'''
+
+
+class RequestMix:
+
+    def __init__(self, total_questions, category_ids, vocabulary):
+        self.pages = max(total_questions // QUESTIONS_PER_PAGE, 1)
+        self.category_ids = category_ids or [ALL_CATEGORIES]
+        self.terms = vocabulary[:200]
+        self.endpoints = [endpoint for endpoint, _ in MIX]
+        self.weights = [weight for _, weight in MIX]
+
+    def draw(self, rng):
+        endpoint = rng.choices(self.endpoints, self.weights)[0]
+        if endpoint == 'GET /questions':
+            return endpoint, 'GET', '/questions?page={}'.format(
+                rng.randint(1, self.pages)), None
+        if endpoint == 'GET /categories':
+            return endpoint, 'GET', '/categories', None
+        if endpoint == 'GET /categories/<id>/questions':
+            return endpoint, 'GET', '/categories/{}/questions'.format(
+                rng.choice(self.category_ids)), None
+        if endpoint == 'POST /questions (search)':
+            return endpoint, 'POST', '/questions', {
+                "search_term": rng.choice(self.terms)}
+        return endpoint, 'POST', '/quizzes', {
+            "quiz_category": {"id": rng.choice(
+                self.category_ids + [ALL_CATEGORIES])},
+            "previous_questions": []}
+
+
+'''
+Recorder
+    collects the latency and status code of every request per endpoint
+'''
+
+
+class Recorder:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint, latency, status):
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            self.statuses[endpoint][status] += 1
+
+    def results(self, elapsed):
+        endpoints = {}
+        for endpoint, latencies in self.latencies.items():
+            statuses = {str(status): count for status, count
+                        in self.statuses[endpoint].items()}
+            endpoints[endpoint] = dict(summarize(latencies, elapsed),
+                                       statuses=statuses)
+        every_latency = [latency for latencies in self.latencies.values()
+                         for latency in latencies]
+        return {"total": summarize(every_latency, elapsed),
+                "endpoints": endpoints}
+
+
+def run_threads(app, mix, concurrency, duration, recorder, seed):
+    deadline = time.perf_counter() + duration
+
+    def client_loop(index):
+        rng = random.Random(seed + index)
+        client = app.test_client()
+        while time.perf_counter() < deadline:
+            endpoint, method, path, body = mix.draw(rng)
+            started_at = time.perf_counter()
+            response = client.open(path, method=method, json=body)
+            recorder.record(endpoint, time.perf_counter() - started_at,
+                            response.status_code)
+
+    threads = [threading.Thread(target=client_loop, args=(index,))
+               for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_coroutines(app, mix, concurrency, duration, recorder, seed):
+    client = TriviaASGI(app).test_client()
+    deadline = time.perf_counter() + duration
+
+    async def client_loop(index):
+        rng = random.Random(seed + index)
+        while time.perf_counter() < deadline:
+            endpoint, method, path, body = mix.draw(rng)
+            started_at = time.perf_counter()
+            response = await client.open_async(path, method=method, json=body)
+            recorder.record(endpoint, time.perf_counter() - started_at,
+                            response.status_code)
+
+    async def run():
+        await asyncio.gather(*[client_loop(index)
+                               for index in range(concurrency)])
+
+    try:
+        client.loop.run_until_complete(run())
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Drives the app with a mix of requests.')
+    parser.add_argument('--mode', choices=('wsgi', 'asgi'), default='wsgi')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed given to benchmarks.seed, for search terms')
+    parser.add_argument('--output', help='path of the JSON results')
+    args = parser.parse_args()
+
+    app = create_app({
+        "DATABASE_PATH": os.environ.get('DATABASE_PATH', database_path)
+    })
+    with app.app_context():
+        mix = RequestMix(
+            Question.query.count(),
+            [category_id for category_id, in db.session.query(Category.id)],
+            make_vocabulary(random.Random(args.seed)))
+
+    run = run_threads if args.mode == 'wsgi' else run_coroutines
+    recorder = Recorder()
+    started_at = time.perf_counter()
+    run(app, mix, args.concurrency, args.duration, recorder, args.seed)
+    results = recorder.results(time.perf_counter() - started_at)
+    results.update({"mode": args.mode, "concurrency": args.concurrency})
+
+    for endpoint, result in sorted(results['endpoints'].items()) + [
+            ('total', results['total'])]:
+        print('{:<32} {:>8.1f}/s  p50 {:>8.2f}ms  p99 {:>8.2f}ms'.format(
+            endpoint, result['rate'], result['p50_ms'], result['p99_ms']))
+
+    print('saved to ' + save_results(
+        'load-{}'.format(args.mode), results, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+'''
+Micro-benchmarks
+    times the building blocks of the hot endpoints against DATABASE_PATH
+    (the local trivia database by default), preferably filled by
+    benchmarks.seed: get_paginated_questions on the first page, on a deep
+    page by number and by cursor and within a category, search through the
+    in-process index (and the tsvector backend on Postgres), and quiz
+    selection early and late in a game, through the database and through
+    a quiz deck. Each case is called repeatedly for --duration seconds;
+    results are saved as JSON. Run from the backend directory:
+
+        python -m benchmarks.micro --duration 2
+'''
+import argparse
+import os
+import random
+import time
+
+from flask import request
+
+from flaskr import create_app
+from models import db, database_path, Question
+from helpers import encode_cursor, get_paginated_questions
+from quiz import ALL_CATEGORIES, question_index, select_random_question
+from decks import DeckStore
+from search import PostgresSearchBackend, search_index, search_question_ids
+from benchmarks.results import save_results, summarize
+from benchmarks.seed import make_vocabulary
+from constants import QUESTIONS_PER_PAGE
+
+
+def time_calls(function, duration):
+    '''
+    calls function once to warm up, then as often as it can in duration
+    seconds, and summarizes the latency of the calls
+    '''
+    function()
+    latencies = []
+    started_at = time.perf_counter()
+    deadline = started_at + duration
+    while True:
+        call_started_at = time.perf_counter()
+        function()
+        finished_at = time.perf_counter()
+        latencies.append(finished_at - call_started_at)
+        if finished_at >= deadline:
+            break
+    return summarize(latencies, finished_at - started_at)
+
+
+def time_once(function):
+    started_at = time.perf_counter()
+    function()
+    return {"seconds": time.perf_counter() - started_at}
+
+
+def paginate(app, path, condition=None):
+    def call():
+        with app.test_request_context(path):
+            return get_paginated_questions(request, condition)
+    return call
+
+
+def benchmark_pagination(app, duration):
+    total = Question.query.count()
+    page = max(total // QUESTIONS_PER_PAGE // 2, 1)
+    # the id the cursor of the same page starts after
+    after = db.session.query(Question.id).order_by(Question.id).offset(
+        max((page - 1) * QUESTIONS_PER_PAGE - 1, 0)).limit(1).scalar() or 0
+    category = db.session.query(Question.category).order_by(
+        Question.id).limit(1).scalar()
+
+    cases = {
+        'first_page': paginate(app, '/questions'),
+        'deep_page': paginate(app, '/questions?page={}'.format(page)),
+        'deep_cursor': paginate(app, '/questions?cursor={}'.format(
+            encode_cursor({'after': after}))),
+        'category_first_page': paginate(
+            app, '/questions', Question.category == category)
+    }
+    return {name: time_calls(call, duration) for name, call in cases.items()}
+
+
+def benchmark_search(duration, vocabulary, postgres):
+    terms = {
+        'common_term': vocabulary[0],
+        'rare_term': vocabulary[-1],
+        'prefix': vocabulary[0][:3],
+        'two_terms': '{} {}'.format(vocabulary[0], vocabulary[1])
+    }
+    backends = {'index': search_index}
+    if postgres:
+        backends['postgres'] = PostgresSearchBackend()
+
+    results = {'index_load': time_once(search_index.load)}
+    for backend_name, backend in backends.items():
+        for name, term in terms.items():
+            results['{}_{}'.format(backend_name, name)] = time_calls(
+                lambda: search_question_ids(
+                    term, 0, QUESTIONS_PER_PAGE, backend), duration)
+    return results
+
+
+def benchmark_quiz(duration):
+    results = {'index_load': time_once(question_index.load)}
+    ids = question_index.ids(ALL_CATEGORIES)
+    played = random.sample(ids, int(len(ids) * 0.9))
+
+    def select(previous_questions):
+        def call():
+            select_random_question(ALL_CATEGORIES, previous_questions)
+            # as in a new request, which starts with an empty session
+            db.session.expunge_all()
+        return call
+
+    results['first_turn'] = time_calls(select([]), duration)
+    results['late_turn'] = time_calls(select(played), duration)
+
+    decks = DeckStore()
+    results['deck_load'] = time_once(decks.ensure_loaded)
+    results['deck_first_turn'] = time_calls(
+        lambda: select_random_question(ALL_CATEGORIES, [], decks.draw),
+        duration)
+    results['deck_late_turn'] = time_calls(
+        lambda: select_random_question(ALL_CATEGORIES, played, decks.draw),
+        duration)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times pagination, search and quiz selection.')
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='seconds spent on each case')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed given to benchmarks.seed, for search terms')
+    parser.add_argument('--output', help='path of the JSON results')
+    args = parser.parse_args()
+
+    path = os.environ.get('DATABASE_PATH', database_path)
+    app = create_app({"DATABASE_PATH": path})
+    vocabulary = make_vocabulary(random.Random(args.seed))
+
+    with app.app_context():
+        results = {
+            "questions": Question.query.count(),
+            "pagination": benchmark_pagination(app, args.duration),
+            "search": benchmark_search(
+                args.duration, vocabulary,
+                db.engine.dialect.name == 'postgresql'),
+            "quiz": benchmark_quiz(args.duration)
+        }
+
+    for group in ('pagination', 'search', 'quiz'):
+        print(group)
+        for name, result in results[group].items():
+            if 'seconds' in result:
+                print('  {:<24} {:>10.3f}s'.format(name, result['seconds']))
+            else:
+                print('  {:<24} {:>10.0f}/s  p50 {:.3f}ms  p99 {:.3f}ms'
+                      .format(name, result['rate'], result['p50_ms'],
+                              result['p99_ms']))
+
+    print('saved to ' + save_results('micro', results, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''
+Benchmark results
+    latency summaries and the JSON files runs are saved to, named after the
+    benchmark and the commit they ran on so that runs can be compared with
+    benchmarks.compare
+'''
+import datetime
+import json
+import math
+import os
+import platform
+import subprocess
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(__file__), 'results')
+
+
+'''
+percentile(sorted_values, fraction)
+    nearest-rank percentile of values sorted in ascending order
+'''
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # the smallest value with at least fraction of the values at or below it
+    rank = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+'''
+summarize(latencies, elapsed)
+    summarizes latencies in seconds measured over elapsed seconds into
+    milliseconds percentiles and a rate per second
+'''
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "rate": len(latencies) / elapsed if elapsed else None,
+        "mean_ms": sum(latencies) / len(latencies) * 1000
+        if latencies else None,
+        "p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "max_ms": latencies[-1] * 1000 if latencies else None
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+'''
+save_results(name, results, output)
+    writes results with the commit, date and platform of the run to output,
+    by default benchmarks/results/<name>-<commit>.json, and returns the path
+'''
+
+
+def save_results(name, results, output=None):
+    commit = git_commit()
+    if output is None:
+        os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+        output = os.path.join(RESULTS_DIRECTORY, '{}-{}.json'.format(
+            name, commit))
+
+    with open(output, 'w') as results_file:
+        json.dump({
+            "benchmark": name,
+            "commit": commit,
+            "date": datetime.datetime.utcnow().isoformat() + 'Z',
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results
+        }, results_file, indent=2, sort_keys=True)
+        results_file.write('\n')
+    return output
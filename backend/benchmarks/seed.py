@@ -0,0 +1,173 @@
+'''
+Synthetic question bank
+    fills DATABASE_PATH (the local trivia database by default) with
+    generated categories and questions for the benchmarks. Postgres is
+    loaded with COPY, other databases with batched inserts. Generation is
+    seeded, so the same arguments always produce the same bank. Run from the
+    backend directory:
+
+        python -m benchmarks.seed --categories 50 --questions 2000000
+'''
+import argparse
+import io
+import os
+import random
+import time
+
+from sqlalchemy import create_engine, text
+
+from models import database_path, Question, Category, DataChange
+
+COPY_BATCH_SIZE = 100000
+INSERT_BATCH_SIZE = 10000
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'zu', 'pe',
+             'dra', 'gor', 'lin', 'mar', 'tos', 'quel', 'bri', 'fen')
+TEMPLATES = ('Which {} is known as the {} of {}?',
+             'What is the {} {} of {}?',
+             'Who discovered the {} {} in {}?',
+             'In which year was the {} of {} {}?')
+
+'''
+make_vocabulary(rng, size)
+    returns size distinct made-up words, so that search terms hit a
+    controlled share of the questions
+'''
+
+
+def make_vocabulary(rng, size=5000):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES)
+                          for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+'''
+generate_questions(rng, vocabulary, count, category_ids)
+    yields (question, answer, difficulty, category) rows. Words are drawn
+    with a skewed distribution, like natural text
+'''
+
+
+def generate_questions(rng, vocabulary, count, category_ids):
+    for _ in range(count):
+        words = [vocabulary[min(int(rng.paretovariate(1.2)) - 1,
+                                len(vocabulary) - 1)]
+                 if rng.random() < 0.5 else rng.choice(vocabulary)
+                 for _ in range(4)]
+        yield (rng.choice(TEMPLATES).format(*words[:3]).capitalize(),
+               words[3].capitalize(), rng.randint(1, 5),
+               rng.choice(category_ids))
+
+
+def escape_copy_value(value):
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(connection, table, columns, rows):
+    '''
+    streams rows to a Postgres table with COPY, one batch at a time
+    '''
+    cursor = connection.cursor()
+    statement = 'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns))
+    batch = io.StringIO()
+    count = 0
+    for row in rows:
+        batch.write('\t'.join(escape_copy_value(value) for value in row))
+        batch.write('\n')
+        count += 1
+        if count % COPY_BATCH_SIZE == 0:
+            batch.seek(0)
+            cursor.copy_expert(statement, batch)
+            batch = io.StringIO()
+    batch.seek(0)
+    cursor.copy_expert(statement, batch)
+    cursor.close()
+
+
+def insert_rows(connection, table, columns, rows):
+    '''
+    inserts rows in batches of INSERT_BATCH_SIZE through the DB-API, for
+    databases without COPY
+    '''
+    statement = table.insert()
+    batch = []
+    for row in rows:
+        batch.append(dict(zip(columns, row)))
+        if len(batch) == INSERT_BATCH_SIZE:
+            connection.execute(statement, batch)
+            batch = []
+    if batch:
+        connection.execute(statement, batch)
+
+
+def seed(engine, categories, questions, seed_value=0, reset=False):
+    rng = random.Random(seed_value)
+    vocabulary = make_vocabulary(rng)
+    Question.__table__.metadata.create_all(
+        engine, tables=[Category.__table__, Question.__table__,
+                        DataChange.__table__])
+    postgres = engine.dialect.name == 'postgresql'
+
+    with engine.begin() as connection:
+        if reset:
+            connection.execute(Question.__table__.delete())
+            connection.execute(Category.__table__.delete())
+
+        first_id = connection.execute(text(
+            'SELECT COALESCE(MAX(id), 0) FROM categories')).scalar() + 1
+        category_ids = list(range(first_id, first_id + categories))
+        category_rows = [(category_id, 'Category {}'.format(category_id))
+                         for category_id in category_ids]
+        rows = generate_questions(rng, vocabulary, questions, category_ids)
+
+        if postgres:
+            raw_connection = connection.connection
+            copy_rows(raw_connection, 'categories', ('id', 'type'),
+                      category_rows)
+            copy_rows(raw_connection, 'questions',
+                      ('question', 'answer', 'difficulty', 'category'), rows)
+            connection.execute(text(
+                "SELECT setval(pg_get_serial_sequence('categories', 'id'), "
+                "(SELECT MAX(id) FROM categories))"))
+        else:
+            insert_rows(connection, Category.__table__, ('id', 'type'),
+                        category_rows)
+            insert_rows(connection, Question.__table__,
+                        ('question', 'answer', 'difficulty', 'category'), rows)
+
+        # running workers drop what they derived from the data
+        connection.execute(DataChange.__table__.insert(), [
+            {"name": name, "action": 'reset'}
+            for name in ('questions', 'categories')])
+
+    if postgres:
+        with engine.connect() as connection:
+            connection.execution_options(
+                isolation_level='AUTOCOMMIT').execute(
+                text('ANALYZE categories, questions'))
+
+    return vocabulary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Seeds a synthetic question bank.')
+    parser.add_argument('--categories', type=int, default=50)
+    parser.add_argument('--questions', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reset', action='store_true',
+                        help='delete the existing questions and categories')
+    args = parser.parse_args()
+
+    engine = create_engine(os.environ.get('DATABASE_PATH', database_path))
+    started_at = time.perf_counter()
+    seed(engine, args.categories, args.questions, args.seed, args.reset)
+    print('seeded {} categories and {} questions in {:.1f}s'.format(
+        args.categories, args.questions, time.perf_counter() - started_at))
+
+
+if __name__ == '__main__':
+    main()
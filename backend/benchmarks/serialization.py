@@ -0,0 +1,104 @@
+'''
+Serialization benchmark
+    compares the listing path before and after the fast serializer: ORM
+    objects formatted with Question.format() and encoded by jsonify, against
+    column tuples encoded by each encoder of serializers. It times pages of
+    pure serialization, then GET /questions end to end, as it was and as it
+    is, against DATABASE_PATH (the local trivia database by default). The
+    end to end gain grows with the size of the questions table. Run from the
+    backend directory:
+
+        python -m benchmarks.serialization
+'''
+import os
+import timeit
+
+from flask import jsonify, request
+
+from flaskr import create_app
+from models import database_path, Question, Category
+from serializers import encoders, format_question_row
+from constants import QUESTIONS_PER_PAGE
+
+
+def make_rows(count):
+    return [(index, 'Question number {}?'.format(index),
+             'Answer {}'.format(index), index % 6 + 1, index % 5 + 1)
+            for index in range(count)]
+
+
+def benchmark_serialization(app, sizes=(QUESTIONS_PER_PAGE, 1000),
+                            repeat=200):
+    results = {}
+    with app.test_request_context():
+        for size in sizes:
+            rows = make_rows(size)
+            objects = []
+            for row in rows:
+                question = Question(question=row[1], answer=row[2],
+                                    category=row[3], difficulty=row[4])
+                question.id = row[0]
+                objects.append(question)
+
+            def legacy():
+                return jsonify({"questions": [question.format()
+                                              for question in objects]}).data
+
+            timings = {'legacy': timeit.timeit(legacy, number=repeat)}
+            for name, encode in encoders.items():
+                def fast():
+                    return encode({"questions": [format_question_row(row)
+                                                 for row in rows]})
+                assert fast() == legacy()
+                timings[name] = timeit.timeit(fast, number=repeat)
+
+            results[size] = {name: repeat / seconds
+                             for name, seconds in timings.items()}
+    return results
+
+
+def benchmark_endpoint(app, repeat=500):
+    # GET /questions as it was before query-level pagination and the fast
+    # serializer
+    @app.route('/benchmark/legacy-questions')
+    def get_legacy_questions():
+        page = request.args.get('page', 1, type=int)
+        start = (page - 1) * QUESTIONS_PER_PAGE
+        questions = Question.query.all()
+        formatted_questions = [question.format() for question in questions]
+        categories = Category.query.all()
+        return jsonify({
+            "success": True,
+            "questions": formatted_questions[start:start + QUESTIONS_PER_PAGE],
+            "total_questions": len(questions),
+            "categories": [category.format() for category in categories],
+            "current_category": None
+        })
+
+    client = app.test_client()
+    results = {}
+    for name, path in [('legacy', '/benchmark/legacy-questions'),
+                       ('fast', '/questions')]:
+        client.get(path)
+        seconds = timeit.timeit(lambda: client.get(path), number=repeat)
+        results[name] = repeat / seconds
+    return results
+
+
+def main():
+    app = create_app({
+        "DATABASE_PATH": os.environ.get('DATABASE_PATH', database_path)
+    })
+
+    print('serialization, pages per second')
+    for size, results in benchmark_serialization(app).items():
+        print('  {} rows: {}'.format(size, ', '.join(
+            '{} {:.0f}'.format(name, rate) for name, rate in results.items())))
+
+    print('GET /questions, requests per second')
+    for name, rate in benchmark_endpoint(app).items():
+        print('  {}: {:.0f}'.format(name, rate))
+
+
+if __name__ == '__main__':
+    main()
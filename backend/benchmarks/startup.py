@@ -0,0 +1,82 @@
+'''
+Startup benchmark
+    times create_app against DATABASE_PATH (the local trivia database by
+    default) with db.create_all() on startup, without it, and without it
+    but with DB_WARM_UP connections opened up front, then the first request
+    each app serves, which pays for whatever startup left out. Every
+    repetition builds a fresh app and engine, as a booting worker does.
+    Results are saved as JSON. Run from the backend directory:
+
+        python -m benchmarks.startup --repeat 20
+'''
+import argparse
+import os
+import time
+
+from flaskr import create_app
+from models import db, database_path
+from benchmarks.results import save_results, summarize
+from constants import DB_POOL_SIZE
+
+MODES = (
+    ('create_all', {"DB_CREATE_ALL": True}),
+    ('lazy', {"DB_CREATE_ALL": False}),
+    ('lazy_warm_up', {"DB_CREATE_ALL": False, "DB_WARM_UP": DB_POOL_SIZE}),
+)
+
+
+def time_startup(path, config, repeat):
+    '''
+    summarizes the time spent in create_app and in the first request
+    '''
+    startups = []
+    first_requests = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        app = create_app(dict(config, DATABASE_PATH=path))
+        created_at = time.perf_counter()
+        app.test_client().get('/categories')
+        startups.append(created_at - started_at)
+        first_requests.append(time.perf_counter() - created_at)
+        with app.app_context():
+            db.get_engine(app).dispose()
+
+    return {
+        "create_app": summarize(startups, sum(startups)),
+        "first_request": summarize(first_requests, sum(first_requests)),
+        "ready": summarize([startup + first_request for startup, first_request
+                            in zip(startups, first_requests)],
+                           sum(startups) + sum(first_requests))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times app startup with and without create_all.')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='apps created in each mode')
+    parser.add_argument('--output', help='path of the JSON results')
+    args = parser.parse_args()
+
+    path = os.environ.get('DATABASE_PATH', database_path)
+    # imports, the dialect and the mappers are loaded once, as they are
+    # before a worker forks
+    time_startup(path, MODES[0][1], 1)
+    results = {name: time_startup(path, config, args.repeat)
+               for name, config in MODES}
+
+    baseline = results['create_all']['create_app']['p50_ms']
+    for name, result in results.items():
+        print('{:<14} create_app p50 {:>8.2f}ms  first request p50 {:>8.2f}ms'
+              '  ready p50 {:>8.2f}ms'.format(
+                  name, result['create_app']['p50_ms'],
+                  result['first_request']['p50_ms'],
+                  result['ready']['p50_ms']))
+    print('create_app is {:.1f}x faster without create_all'.format(
+        baseline / results['lazy']['create_app']['p50_ms']))
+
+    print('saved to ' + save_results('startup', results, args.output))
+
+
+if __name__ == '__main__':
+    main()
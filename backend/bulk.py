@@ -0,0 +1,214 @@
+import csv
+import io
+import json
+
+from sqlalchemy import exc
+
+from models import db, Question, Category
+from helpers import is_valid_question
+from constants import BULK_BATCH_SIZE, BULK_MAX_REPORTED_ERRORS, \
+    MESSAGE_UNPROCESSABLE
+
+EXPORT_FIELDS = ['id', 'question', 'answer', 'category', 'difficulty']
+INTEGER_FIELDS = ['difficulty', 'category']
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+'''
+read_ndjson_rows(stream)
+    yields (line number, row) for every non-blank line of a stream of
+    newline-delimited JSON, row being None when the line is not valid JSON
+'''
+
+
+def read_ndjson_rows(stream):
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line.decode('utf-8'))
+        except ValueError:
+            yield line_number, None
+
+
+'''
+read_csv_rows(stream)
+    yields (line number, row) for every record of a CSV stream with a header
+    line, converting the integer columns and giving None for bad records:
+    malformed CSV, text that is not UTF-8 and integer columns that are not
+    integers
+'''
+
+
+def read_csv_rows(stream):
+    # undecodable bytes are kept as surrogates, so that the record holding
+    # them is rejected rather than the rest of the stream
+    reader = csv.DictReader(io.TextIOWrapper(
+        stream, encoding='utf-8', errors='surrogateescape'))
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error:
+            # DictReader only counts the lines of the records it returns
+            yield reader.reader.line_num, None
+            continue
+
+        try:
+            for value in row.values():
+                if isinstance(value, str):
+                    value.encode('utf-8')
+            for key in INTEGER_FIELDS:
+                if row.get(key):
+                    row[key] = int(row[key])
+        except ValueError:
+            row = None
+        yield reader.line_num, row
+
+
+'''
+is_valid_import_row(row, category_ids)
+    validates a row like POST /questions does, and that its question and
+    answer are text and its difficulty and category integers, the category
+    being one of category_ids
+'''
+
+
+def is_valid_import_row(row, category_ids):
+    if not is_valid_question(row):
+        return False
+    return type(row['question']) is str and type(row['answer']) is str and \
+        type(row['difficulty']) is int and type(row['category']) is int and \
+        row['category'] in category_ids
+
+
+def insert_batch(batch):
+    '''
+    inserts the (line number, question) pairs of batch in one transaction
+    and returns the number of inserted questions and the line numbers of
+    those the database rejected. When the transaction fails, the questions
+    are inserted one per transaction
+    '''
+    try:
+        return len(Question.insert_all(
+            [question for _, question in batch])), []
+    except (exc.IntegrityError, exc.DataError):
+        db.session.rollback()
+    if len(batch) == 1:
+        return 0, [batch[0][0]]
+
+    inserted = 0
+    failed = []
+    for line_number, question in batch:
+        try:
+            Question.insert_all([Question(
+                question=question.question, answer=question.answer,
+                difficulty=question.difficulty, category=question.category)])
+            inserted += 1
+        except (exc.IntegrityError, exc.DataError):
+            db.session.rollback()
+            failed.append(line_number)
+    return inserted, failed
+
+
+'''
+import_questions(rows, batch_size, progress)
+    validates rows with is_valid_import_row and inserts the valid ones in
+    transactions of BULK_BATCH_SIZE questions. A transaction the database
+    rejects is retried one question per transaction. Returns the number of
+    imported questions, the number of rejected rows and the errors of the
+    first rejected rows. progress(rows, imported, rejected, errors), if
+    given, is called after every committed transaction with the rows read
+    so far
+'''
+
+
+def import_questions(rows, batch_size=BULK_BATCH_SIZE, progress=None):
+    imported = 0
+    rejected = 0
+    errors = []
+    batch = []
+    read = 0
+    category_ids = set(
+        category_id for category_id, in db.session.query(Category.id))
+
+    def reject(line_number):
+        if len(errors) < BULK_MAX_REPORTED_ERRORS:
+            errors.append({
+                "line": line_number,
+                "error": 422,
+                "message": MESSAGE_UNPROCESSABLE
+            })
+
+    def flush():
+        inserted, failed = insert_batch(batch)
+        for line_number in failed:
+            reject(line_number)
+        return inserted, len(failed)
+
+    for line_number, row in rows:
+        read += 1
+        if not is_valid_import_row(row, category_ids):
+            rejected += 1
+            reject(line_number)
+            continue
+
+        batch.append((line_number, Question(
+            question=row['question'],
+            answer=row['answer'],
+            difficulty=row['difficulty'],
+            category=row['category'],
+        )))
+        if len(batch) >= batch_size:
+            inserted, failed = flush()
+            imported += inserted
+            rejected += failed
+            batch = []
+            if progress is not None:
+                progress(read, imported, rejected, errors)
+
+    if batch:
+        inserted, failed = flush()
+        imported += inserted
+        rejected += failed
+    if progress is not None:
+        progress(read, imported, rejected, errors)
+
+    return imported, rejected, errors
+
+
+'''
+export_questions(export_format)
+    yields every question, ordered by id, as chunks of newline-delimited JSON
+    or CSV. Rows are read through a server-side cursor BULK_BATCH_SIZE at a
+    time, so the table is never loaded at once
+'''
+
+
+def export_questions(export_format='ndjson'):
+    rows = db.session.query(
+        *[getattr(Question, field) for field in EXPORT_FIELDS]
+    ).order_by(Question.id).execution_options(
+        stream_results=True).yield_per(BULK_BATCH_SIZE)
+
+    buffer = io.StringIO()
+    if export_format == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        write = writer.writerow
+    else:
+        def write(row):
+            buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, row)),
+                                    sort_keys=True, separators=(',', ':')))
+            buffer.write('\n')
+
+    for row in rows:
+        write(row)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,214 @@
+import json
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import select
+
+from models import db, category_listeners, question_listeners
+from replicas import primary_reads
+from serializers import CATEGORY_COLUMNS, format_category_row, get_encoder
+from constants import CACHE_MAX_ENTRIES, CATEGORY_CACHE_TTL
+
+MISSING = object()
+
+
+'''
+LRUCache
+    in-process cache evicting the least recently used entry once maxsize
+    entries are stored. Entries expire ttl seconds after they are set
+'''
+
+
+class LRUCache:
+
+    def __init__(self, maxsize=CACHE_MAX_ENTRIES, ttl=CATEGORY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries)
+            }
+
+
+'''
+KeyValueCache
+    cache kept in a key-value store shared by all workers, e.g. a redis client
+    or kvstore.LocalKeyValueStore. Bytes are stored as is and other values as
+    JSON. clear() bumps a generation counter that is part of every key, so it
+    does not have to enumerate the keys of the store
+'''
+
+
+class KeyValueCache:
+
+    def __init__(self, client, ttl=CATEGORY_CACHE_TTL, prefix='cache:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        generation = self.client.get(self.prefix + 'generation') or b'0'
+        return '{}{}:{}'.format(
+            self.prefix, generation.decode('ascii'), key)
+
+    def get(self, key, default=MISSING):
+        raw = self.client.get(self._key(key))
+        if raw is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        if raw[:1] == b'b':
+            return raw[1:]
+        return json.loads(raw[1:].decode('utf-8'))
+
+    def set(self, key, value):
+        if isinstance(value, bytes):
+            raw = b'b' + value
+        else:
+            raw = b'j' + json.dumps(value).encode('utf-8')
+        self.client.set(self._key(key), raw, ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        self.client.incr(self.prefix + 'generation')
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+'''
+read_through(cache, key, loader)
+    returns the cached value of key, calling loader and caching its result
+    on a miss
+'''
+
+
+def read_through(cache, key, loader):
+    value = cache.get(key)
+    if value is MISSING:
+        # kept past the request, so not read from a lagging replica
+        with primary_reads():
+            value = loader()
+        cache.set(key, value)
+    return value
+
+
+'''
+category caches
+    caches holding the category list, registered by create_app. They are
+    cleared whenever categories are committed or the database is rebound,
+    and can be cleared explicitly with invalidate_categories()
+'''
+category_caches = weakref.WeakSet()
+
+
+def invalidate_categories():
+    for cache in list(category_caches):
+        cache.clear()
+
+
+def on_question_change(action, questions):
+    if action == 'reset':
+        invalidate_categories()
+
+
+category_listeners.append(invalidate_categories)
+question_listeners.append(on_question_change)
+
+
+'''
+select_categories()
+    builds the statement reading the rows of CATEGORY_COLUMNS ordered by id
+'''
+
+
+def select_categories():
+    return select(list(CATEGORY_COLUMNS)).order_by(CATEGORY_COLUMNS[0])
+
+
+'''
+get_formatted_categories(cache)
+    returns all categories formatted, read through the given cache
+'''
+
+
+def get_formatted_categories(cache):
+    return read_through(cache, 'categories', lambda: [
+        format_category_row(row)
+        for row in db.session.execute(select_categories())])
+
+
+'''
+encode_categories_body(categories, encode)
+    serializes the body of GET /categories holding the formatted categories
+    with the given encoder
+'''
+
+
+def encode_categories_body(categories, encode):
+    return encode({
+        "success": True,
+        "categories": categories,
+        "total_categories": len(categories)
+    })
+
+
+'''
+get_categories_body(cache)
+    returns the serialized body of GET /categories, read through the given
+    cache. The bytes match what jsonify produces for the same payload
+'''
+
+
+def get_categories_body(cache):
+    def load():
+        encode = get_encoder(current_app.config.get('SERIALIZER', 'auto'))
+        return encode_categories_body(get_formatted_categories(cache), encode)
+
+    return read_through(cache, 'categories.json', load)
@@ -0,0 +1,266 @@
+import threading
+import time
+
+from sqlalchemy import func, select
+
+from models import db, DataChange, Question, QuestionRecord, \
+    data_change_listeners, notify_question_listeners, \
+    notify_category_listeners
+from replicas import primary_reads
+from constants import BULK_BATCH_SIZE, DATA_CHANGES_CHECK_INTERVAL, \
+    DATA_CHANGES_HOLE_TIMEOUT, DATA_CHANGES_KEPT
+
+# versions missing from data_changes waited for at once, beyond which this
+# process resets instead of catching up
+MAX_HOLES = 1000
+
+
+'''
+DataChanges
+    the changes of the data_changes table this process caught up with.
+    Every commit that changes questions or categories appends them there,
+    see models.log_data_changes. check() reads the changes appended since
+    the last check at most every check_interval seconds, and tells
+    question_listeners and category_listeners of those committed by other
+    processes, a `python jobs.py` worker or a web worker alike, see
+    notify_question_changes. Changes committed by this process are skipped,
+    its listeners were told of them already.
+
+    Versions come from a sequence, in the order transactions appended their
+    changes rather than the order they committed in, so a version missing
+    once a later one is read is waited for: its transaction may still be
+    committing. A version still missing after hole_timeout seconds, or more
+    than MAX_HOLES of them, is a change this process missed: it then resets
+    the state derived from the data, as setup_db does. The table keeps the
+    latest kept changes, older ones are pruned
+'''
+
+
+class DataChanges:
+
+    def __init__(self, hole_timeout=DATA_CHANGES_HOLE_TIMEOUT,
+                 kept=DATA_CHANGES_KEPT):
+        self.hole_timeout = hole_timeout
+        self.kept = kept
+        self._lock = threading.Lock()
+        self.reset()
+        data_change_listeners.append(self.on_commit)
+
+    def reset(self):
+        '''
+        forgets the changes, the next check starts from the latest one
+        '''
+        with self._lock:
+            self._checked_at = None
+            self._position = None
+            self._pruned_at = None
+            # when each version missing below the position was found missing
+            self._holes = {}
+            # versions committed by this process, not read back yet
+            self._own = set()
+            # latest version of each name below the first hole, and the
+            # names of the versions caught up with above it
+            self._settled = {}
+            self._unsettled = {}
+
+    def due(self, check_interval=DATA_CHANGES_CHECK_INTERVAL):
+        checked_at = self._checked_at
+        if checked_at is None:
+            return True
+        return check_interval is not None and \
+            time.monotonic() - checked_at >= check_interval
+
+    def check(self, check_interval=DATA_CHANGES_CHECK_INTERVAL):
+        '''
+        reads the changes appended since the last check once check_interval
+        seconds passed since then, and catches up with those committed by
+        other processes. A check_interval of None only reads them once
+        '''
+        if not self.due(check_interval):
+            return
+        self._checked_at = time.monotonic()
+        table = DataChange.__table__
+        with primary_reads():
+            if self._position is None:
+                self._start(db.session.execute(select([
+                    table.c.name, func.max(table.c.version)]).group_by(
+                    table.c.name)).fetchall())
+                return
+            rows = db.session.execute(select([
+                table.c.version, table.c.name, table.c.record_id,
+                table.c.action]).where(
+                table.c.version > self._low()).order_by(
+                table.c.version)).fetchall()
+
+        changes, missed = self._catch_up(rows)
+        if missed:
+            notify_question_listeners('reset')
+            notify_category_listeners()
+        else:
+            self._apply(changes)
+        self._prune()
+
+    def version(self, name):
+        '''
+        the version of name, the same in every process that caught up with
+        the same changes
+        '''
+        if self._position is None:
+            self.check()
+        with self._lock:
+            versions = [self._settled.get(name, 0)] + sorted(
+                version for version, changed in self._unsettled.items()
+                if changed == name)
+        return '+'.join(str(version) for version in versions)
+
+    def on_commit(self, changes):
+        with self._lock:
+            if self._position is None:
+                return
+            for version, name in changes:
+                if version in self._holes:
+                    del self._holes[version]
+                elif version > self._position:
+                    self._own.add(version)
+                self._unsettled[version] = name
+            self._settle()
+
+    def _start(self, rows):
+        with self._lock:
+            if self._position is not None:
+                return
+            # whatever is loaded from now on is at least this recent
+            self._settled = dict(rows)
+            self._position = max(self._settled.values(), default=0)
+
+    def _low(self):
+        with self._lock:
+            if self._holes:
+                return min(self._holes) - 1
+            return self._position
+
+    def _catch_up(self, rows):
+        '''
+        takes the rows read from data_changes, returns the changes of other
+        processes among them as (name, record_id, action), and whether this
+        process missed some
+        '''
+        changes = []
+        with self._lock:
+            if self._position is None:
+                return changes, False
+            now = time.monotonic()
+            for version, name, record_id, action in rows:
+                if version in self._holes:
+                    del self._holes[version]
+                elif version > self._position:
+                    for missing in range(self._position + 1, min(
+                            version, self._position + MAX_HOLES + 2)):
+                        if missing not in self._own:
+                            self._holes[missing] = now
+                    self._position = version
+                else:
+                    # caught up with already
+                    continue
+                self._unsettled[version] = name
+                if version in self._own:
+                    self._own.discard(version)
+                else:
+                    changes.append((name, record_id, action))
+
+            missed = len(self._holes) > MAX_HOLES or any(
+                now - found >= self.hole_timeout
+                for found in self._holes.values())
+            if missed:
+                names = set(self._settled) | set(self._unsettled.values())
+                self._holes = {}
+                self._unsettled = {}
+                self._settled = {name: self._position for name in names}
+            self._settle()
+        return changes, missed
+
+    def _settle(self):
+        low = min(self._holes) - 1 if self._holes else self._position
+        for version in sorted(self._unsettled):
+            if version > low:
+                break
+            name = self._unsettled.pop(version)
+            self._settled[name] = max(self._settled.get(name, 0), version)
+
+    def _apply(self, changes):
+        question_ids = set()
+        reset = set()
+        for name, record_id, action in changes:
+            if name == 'questions' and action != 'reset':
+                question_ids.add(record_id)
+            else:
+                # categories are cached whole
+                reset.add(name)
+
+        if 'questions' in reset:
+            notify_question_listeners('reset')
+        elif question_ids:
+            notify_question_changes(sorted(question_ids))
+        if 'categories' in reset:
+            notify_category_listeners()
+
+    def _prune(self):
+        with self._lock:
+            position = self._position
+            if position is None or self._pruned_at is not None and \
+                    position - self._pruned_at < self.kept:
+                return
+            self._pruned_at = position
+        if position > self.kept:
+            table = DataChange.__table__
+            with db.get_engine().begin() as connection:
+                connection.execute(table.delete().where(
+                    table.c.version <= position - self.kept))
+
+
+'''
+notify_question_changes(question_ids)
+    tells question_listeners of the questions of the given ids changed by
+    another process, as read from the primary: those that are gone as
+    'delete', with records that only hold their id, then the others as
+    'update'
+'''
+
+
+def notify_question_changes(question_ids):
+    records = []
+    with primary_reads():
+        for start in range(0, len(question_ids), BULK_BATCH_SIZE):
+            batch = question_ids[start:start + BULK_BATCH_SIZE]
+            records.extend(QuestionRecord(*row) for row in db.session.query(
+                Question.id, Question.question, Question.answer,
+                Question.category, Question.difficulty).filter(
+                Question.id.in_(batch)))
+
+    found = set(record.id for record in records)
+    deleted = [QuestionRecord(question_id, None, None, None, None)
+               for question_id in question_ids if question_id not in found]
+    if deleted:
+        notify_question_listeners('delete', deleted)
+    # also after deletes alone: the counts do not know the category and
+    # difficulty of those records, and reload on 'update'
+    notify_question_listeners('update', records)
+
+
+'''
+select_position()
+    selects the latest version of data_changes, e.g. to tell how far a
+    replica replayed them
+'''
+
+
+def select_position():
+    return select([func.max(DataChange.__table__.c.version)])
+
+
+'''
+data_changes
+    the DataChanges of this process, checked before every request of
+    create_app every DATA_CHANGES_CHECK_INTERVAL seconds
+'''
+data_changes = DataChanges()
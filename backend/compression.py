@@ -0,0 +1,132 @@
+import gzip
+import hashlib
+import zlib
+
+from flask import request
+
+from cache import LRUCache
+from constants import COMPRESSION_MIN_SIZE, COMPRESSION_LEVEL, \
+    COMPRESSION_BROTLI_QUALITY, COMPRESSION_CACHE_ENTRIES, \
+    COMPRESSION_CACHE_TTL
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson',
+                          'text/csv', 'text/plain')
+
+
+'''
+choose_encoding(accept_encodings)
+    returns the preferred content coding the client accepts: br when brotli
+    is installed, then gzip, or None
+'''
+
+
+def choose_encoding(accept_encodings):
+    if brotli is not None and accept_encodings['br'] > 0:
+        return 'br'
+    if accept_encodings['gzip'] > 0:
+        return 'gzip'
+    return None
+
+
+'''
+compress(data, encoding, level, brotli_quality)
+    compresses a whole response body
+'''
+
+
+def compress(data, encoding, level=COMPRESSION_LEVEL,
+             brotli_quality=COMPRESSION_BROTLI_QUALITY):
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, compresslevel=level)
+
+
+'''
+compress_stream(chunks, encoding, level, brotli_quality)
+    compresses a streamed response body chunk by chunk
+'''
+
+
+def compress_stream(chunks, encoding, level=COMPRESSION_LEVEL,
+                    brotli_quality=COMPRESSION_BROTLI_QUALITY):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=brotli_quality)
+        compress_chunk, finish = compressor.process, compressor.finish
+    else:
+        # wbits 31 writes the gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        compress_chunk, finish = compressor.compress, compressor.flush
+
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compress_chunk(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+'''
+init_compression(app)
+    compresses the responses of the app with the content coding negotiated
+    through Accept-Encoding. Bodies smaller than COMPRESSION_MIN_SIZE bytes
+    are sent as is. Responses carrying an ETag, which repeat until their
+    content changes, are compressed once per coding and body and served from
+    a cache afterwards. The cache is keyed on a digest of the body rather
+    than the ETag, which may be the same for different bodies, e.g. pages of
+    one listing
+'''
+
+
+def init_compression(app, cache=None):
+    min_size = app.config.get('COMPRESSION_MIN_SIZE', COMPRESSION_MIN_SIZE)
+    level = app.config.get('COMPRESSION_LEVEL', COMPRESSION_LEVEL)
+    brotli_quality = app.config.get(
+        'COMPRESSION_BROTLI_QUALITY', COMPRESSION_BROTLI_QUALITY)
+    cache = cache or LRUCache(maxsize=COMPRESSION_CACHE_ENTRIES,
+                              ttl=COMPRESSION_CACHE_TTL)
+
+    @app.after_request
+    def compress_response(response):
+        if request.method == 'HEAD' or response.status_code != 200 or \
+                response.direct_passthrough or \
+                'Content-Encoding' in response.headers or \
+                response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(
+                response.response, encoding, level, brotli_quality)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < min_size:
+                return response
+
+            etag, _ = response.get_etag()
+            if etag is not None:
+                digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+                key = '{}:{}'.format(encoding, digest)
+                compressed = cache.get(key, None)
+                if compressed is None:
+                    compressed = compress(
+                        data, encoding, level, brotli_quality)
+                    cache.set(key, compressed)
+            else:
+                compressed = compress(data, encoding, level, brotli_quality)
+            response.set_data(compressed)
+
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    return cache
@@ -1,5 +1,117 @@
 QUESTIONS_PER_PAGE = 10
 
+QUIZ_SESSION_TTL = 60 * 60
+QUIZ_SESSION_LIMIT = 100000
+
+# difficulties of the adaptive quiz
+QUIZ_MIN_DIFFICULTY = 1
+QUIZ_MAX_DIFFICULTY = 5
+QUIZ_START_DIFFICULTY = 2
+
+# seconds after which a quiz deck is rebuilt, to catch up on changes made
+# by other workers, and between looks at the deck file they share
+QUIZ_DECK_REFRESH_INTERVAL = 60
+QUIZ_DECK_FILE_CHECK_INTERVAL = 1
+
+# seconds between looks at the data_changes table, appended to by every
+# commit changing questions or categories, to catch up with the changes of
+# other processes. Seconds a missing version is waited for before the state
+# derived from the data is reset, and changes kept before older ones are
+# pruned
+DATA_CHANGES_CHECK_INTERVAL = 1
+DATA_CHANGES_HOLE_TIMEOUT = 10
+DATA_CHANGES_KEPT = 100000
+
+CACHE_MAX_ENTRIES = 1024
+CATEGORY_CACHE_TTL = 5 * 60
+
+# seconds after which cached question counts are reloaded from the database
+COUNTS_RECONCILE_INTERVAL = 60
+
+BULK_BATCH_SIZE = 1000
+BULK_MAX_REPORTED_ERRORS = 100
+
+# connection pool, overridden by the same keys in the app config
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+DB_POOL_TIMEOUT = 30
+DB_POOL_RECYCLE = -1
+DB_POOL_PRE_PING = False
+DB_STATEMENT_TIMEOUT = None
+
+# db.create_all() on startup, which connects and looks up every table. Off
+# in production, where trivia.psql and migrations.py manage the schema
+DB_CREATE_ALL = True
+# connections opened on startup so that the first requests find them in
+# the pool
+DB_WARM_UP = 0
+
+# seconds before a replica that failed is checked again, and during which a
+# client that wrote reads from the primary, as told by REPLICA_PIN_COOKIE
+REPLICA_RETRY_INTERVAL = 5
+REPLICA_PIN_SECONDS = 5
+REPLICA_PIN_COOKIE = 'trivia_primary_until'
+
+# route name -> (requests per second, burst) allowed for each client, and
+# route name -> requests served at once. Searches leave connections of the
+# pool to the other routes. 'search_questions' names searches, which share
+# POST /questions with creation
+RATE_LIMITS = {}
+CONCURRENCY_LIMITS = {'search_questions': 4}
+RATE_LIMIT_MAX_KEYS = 100000
+
+# group commit of POST /questions: seconds a batch waits for more questions
+# once the previous batch committed, and questions per transaction
+GROUP_COMMIT_WINDOW = 0
+GROUP_COMMIT_MAX_BATCH = 100
+
+# background jobs: worker threads of each process, started with its first
+# job, attempts before a job fails, seconds before the first retry, doubled
+# on every attempt, seconds a worker holds a job without reporting progress
+# before another one takes it over, seconds between looks for jobs enqueued
+# by other processes, and finished jobs kept by the in-memory store.
+# Background imports are staged in JOB_UPLOAD_DIRECTORY, a directory of the
+# system temporary directory when None, and answered with 413 beyond
+# JOB_UPLOAD_MAX_BYTES
+JOB_WORKERS = 2
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 5
+JOB_LEASE_SECONDS = 5 * 60
+JOB_POLL_INTERVAL = 1
+JOB_HISTORY = 1000
+JOB_UPLOAD_DIRECTORY = None
+JOB_UPLOAD_MAX_BYTES = 100 * 1024 * 1024
+
+# threads of flaskr.asgi running the WSGI routes and, for drivers without
+# an async client, the statements of the native routes
+ASGI_THREADS = 32
+
+# requests slower than this many seconds are logged with their statements
+SLOW_REQUEST_THRESHOLD = 0.5
+SLOW_REQUEST_MAX_STATEMENTS = 50
+
+# profiling sessions started without limits stop after this many requests
+# or seconds. Stacks are sampled every PROFILING_SAMPLE_INTERVAL seconds and
+# the call statistics list the PROFILING_STATS_LIMIT costliest functions
+PROFILING_REQUESTS = 100
+PROFILING_SECONDS = 30
+PROFILING_SAMPLE_INTERVAL = 0.005
+PROFILING_STATS_LIMIT = 50
+
+# Cache-Control max-age and s-maxage of the read endpoints, in seconds
+READ_CACHE_MAX_AGE = 0
+READ_CACHE_SHARED_MAX_AGE = None
+
+# responses smaller than COMPRESSION_MIN_SIZE bytes are sent uncompressed
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5
+COMPRESSION_CACHE_ENTRIES = 256
+COMPRESSION_CACHE_TTL = 60 * 60
+
 MESSAGE_NOT_FOUND = 'resource not found.'
 MESSAGE_UNPROCESSABLE = 'unprocessable.'
 MESSAGE_SERVER_ERROR = 'internal server error'
+MESSAGE_TOO_LARGE = 'request entity too large.'
+MESSAGE_TOO_MANY_REQUESTS = 'too many requests.'
+MESSAGE_SERVICE_UNAVAILABLE = 'service unavailable.'
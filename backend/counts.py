@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import func
+
+from models import db, Question, question_listeners
+from replicas import primary_reads
+from constants import COUNTS_RECONCILE_INTERVAL
+
+logger = logging.getLogger('trivia.counts')
+
+
+'''
+QuestionCounts
+    number of questions in total, per category and per difficulty, kept in
+    memory so that listings do not count the questions table. Loaded lazily
+    with one grouped query and kept in sync through question_listeners.
+    Once reconcile_interval seconds have passed since the last load, the
+    next read reloads them in the background, which catches up on changes
+    committed by other workers or outside the app
+'''
+
+
+class QuestionCounts:
+
+    def __init__(self, reconcile_interval=COUNTS_RECONCILE_INTERVAL):
+        self.reconcile_interval = reconcile_interval
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._reconciling = False
+        self._total = 0
+        self._categories = Counter()
+        self._difficulties = Counter()
+
+    def reset(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def reconcile(self):
+        '''
+        reloads the counts from the database
+        '''
+        with primary_reads():
+            rows = db.session.query(
+                Question.category, Question.difficulty,
+                func.count(Question.id)).group_by(
+                Question.category, Question.difficulty).all()
+
+        total = 0
+        categories = Counter()
+        difficulties = Counter()
+        for category, difficulty, count in rows:
+            total += count
+            if category is not None:
+                categories[category] += count
+            if difficulty is not None:
+                difficulties[difficulty] += count
+
+        with self._lock:
+            self._total = total
+            self._categories = categories
+            self._difficulties = difficulties
+            self._loaded_at = time.monotonic()
+
+    def _reconcile_in_background(self):
+        try:
+            self.reconcile()
+        except Exception:
+            # the counts stay as they are until the next attempt
+            logger.exception('reconciling question counts failed')
+        finally:
+            db.session.remove()
+            with self._lock:
+                self._reconciling = False
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None:
+            self.reconcile()
+            return
+
+        with self._lock:
+            stale = not self._reconciling and \
+                time.monotonic() - self._loaded_at >= self.reconcile_interval
+            if stale:
+                self._reconciling = True
+        if stale:
+            threading.Thread(target=self._reconcile_in_background,
+                             daemon=True).start()
+
+    @property
+    def loaded(self):
+        return self._loaded_at is not None
+
+    def total(self):
+        self._ensure_loaded()
+        with self._lock:
+            return self._total
+
+    def category(self, category_id):
+        self._ensure_loaded()
+        with self._lock:
+            return max(self._categories.get(category_id, 0), 0)
+
+    def difficulty(self, difficulty):
+        self._ensure_loaded()
+        with self._lock:
+            return max(self._difficulties.get(difficulty, 0), 0)
+
+    def snapshot(self):
+        '''
+        returns the total and the non-zero counts per category and per
+        difficulty
+        '''
+        self._ensure_loaded()
+        with self._lock:
+            return (self._total,
+                    {key: count for key, count in self._categories.items()
+                     if count > 0},
+                    {key: count for key, count in self._difficulties.items()
+                     if count > 0})
+
+    def on_question_change(self, action, questions):
+        if action in ('reset', 'update'):
+            # the previous category and difficulty of updated questions are
+            # unknown, reload on the next read
+            self.reset()
+            return
+
+        step = 1 if action == 'insert' else -1
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            for question in questions:
+                self._total += step
+                if question.category is not None:
+                    self._categories[int(question.category)] += step
+                if question.difficulty is not None:
+                    self._difficulties[int(question.difficulty)] += step
+
+
+question_counts = QuestionCounts()
+question_listeners.append(question_counts.on_question_change)
@@ -0,0 +1,134 @@
+import threading
+import time
+
+from sqlalchemy import exc, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from constants import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, \
+    DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_STATEMENT_TIMEOUT
+
+
+'''
+InstrumentedQueuePool
+    QueuePool recording how long callers wait for a connection and how
+    often the pool runs out of connections
+'''
+
+
+class InstrumentedQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+
+    def recreate(self):
+        # pre-ping and invalidation replace the pool, keep its counters
+        pool = super(InstrumentedQueuePool, self).recreate()
+        pool.checkouts = self.checkouts
+        pool.wait_time = self.wait_time
+        pool.max_wait_time = self.max_wait_time
+        pool.timeouts = self.timeouts
+        return pool
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started_at
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "class": type(self).__name__,
+                "size": self.size(),
+                "checked_in": self.checkedin(),
+                "checked_out": self.checkedout(),
+                "overflow": max(self.overflow(), 0),
+                "max_overflow": self._max_overflow,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_time_total": self.wait_time,
+                "wait_time_max": self.max_wait_time
+            }
+
+
+'''
+get_pool_stats(pool)
+    returns live statistics of a connection pool. Only the class is known
+    for pools other than InstrumentedQueuePool
+'''
+
+
+def get_pool_stats(pool):
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.stats()
+    return {"class": type(pool).__name__}
+
+
+'''
+warm_up_pool(engine, connections)
+    opens that many connections at once, checks each with SELECT 1 and
+    returns them to the pool
+'''
+
+
+def warm_up_pool(engine, connections):
+    opened = []
+    try:
+        for _ in range(connections):
+            connection = engine.connect()
+            opened.append(connection)
+            connection.execute(text('SELECT 1'))
+    finally:
+        for connection in opened:
+            connection.close()
+    return len(opened)
+
+
+'''
+get_engine_options(config, database_path)
+    builds SQLALCHEMY_ENGINE_OPTIONS from the DB_* settings of the app config,
+    falling back to the defaults in constants
+'''
+
+
+def get_engine_options(config, database_path):
+    drivername = make_url(database_path).drivername
+    options = {
+        "pool_pre_ping": config.get('DB_POOL_PRE_PING', DB_POOL_PRE_PING),
+        "pool_recycle": config.get('DB_POOL_RECYCLE', DB_POOL_RECYCLE)
+    }
+
+    # Flask-SQLAlchemy picks the right pool for SQLite files and memory
+    if drivername.startswith('sqlite'):
+        return options
+
+    options.update({
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": config.get('DB_POOL_SIZE', DB_POOL_SIZE),
+        "max_overflow": config.get('DB_MAX_OVERFLOW', DB_MAX_OVERFLOW),
+        "pool_timeout": config.get('DB_POOL_TIMEOUT', DB_POOL_TIMEOUT)
+    })
+
+    statement_timeout = config.get(
+        'DB_STATEMENT_TIMEOUT', DB_STATEMENT_TIMEOUT)
+    if statement_timeout is not None and drivername.startswith('postgres'):
+        options["connect_args"] = {
+            "options": "-c statement_timeout={}".format(int(statement_timeout))
+        }
+
+    return options
@@ -0,0 +1,405 @@
+import logging
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+import weakref
+from array import array
+
+from models import db, Question, QuestionRecord, question_listeners
+from replicas import primary_reads
+from quiz import ALL_CATEGORIES, MAX_SAMPLE_ATTEMPTS
+from constants import QUIZ_DECK_REFRESH_INTERVAL, \
+    QUIZ_DECK_FILE_CHECK_INTERVAL
+
+logger = logging.getLogger('trivia.decks')
+
+# magic, records, ranges and size of the text, followed by the arrays
+DECK_HEADER = struct.Struct('<4sIII')
+DECK_MAGIC = b'TQD1'
+# stands for a missing category or difficulty in the int arrays
+NONE = -1
+# orderings the ranges of a deck index into
+RECORD_ORDER, DIFFICULTY_ORDER = 0, 1
+
+
+class DeckQuestion(QuestionRecord):
+    __slots__ = ()
+
+    def format(self):
+        return dict(self._asdict())
+
+
+'''
+build_deck(rows)
+    packs (id, question, answer, category, difficulty) rows into the bytes
+    of a deck: int32 arrays of the ids, categories and difficulties sorted
+    by category, difficulty and id, the offsets of the texts in one UTF-8
+    blob, two permutations ordering the records by difficulty and by id,
+    and the ranges of every category, difficulty and category and
+    difficulty within those orderings
+'''
+
+
+def build_deck(rows):
+    rows = sorted(
+        ((question_id, question or '', answer or '',
+          NONE if category is None else int(category),
+          NONE if difficulty is None else int(difficulty))
+         for question_id, question, answer, category, difficulty in rows),
+        key=lambda row: (row[3], row[4], row[0]))
+
+    ids, categories, difficulties = array('i'), array('i'), array('i')
+    text_offsets, text = array('I', [0]), bytearray()
+    for question_id, question, answer, category, difficulty in rows:
+        ids.append(question_id)
+        categories.append(category)
+        difficulties.append(difficulty)
+        for value in (question, answer):
+            text += value.encode('utf-8')
+            text_offsets.append(len(text))
+
+    records = range(len(rows))
+    by_difficulty = array('i', sorted(
+        records, key=lambda index: (difficulties[index], ids[index])))
+    by_id = array('i', sorted(records, key=lambda index: ids[index]))
+
+    spans = {}
+    if rows:
+        spans[(ALL_CATEGORIES, NONE, RECORD_ORDER)] = [0, len(rows)]
+
+    def extend(key, position):
+        spans.setdefault(key, [position, position])[1] = position + 1
+
+    for index in records:
+        if categories[index] not in (NONE, ALL_CATEGORIES):
+            extend((categories[index], NONE, RECORD_ORDER), index)
+            if difficulties[index] != NONE:
+                extend((categories[index], difficulties[index], RECORD_ORDER),
+                       index)
+    # questions of a difficulty across categories are contiguous in
+    # by_difficulty only
+    for position, index in enumerate(by_difficulty):
+        if difficulties[index] != NONE:
+            extend((ALL_CATEGORIES, difficulties[index], DIFFICULTY_ORDER),
+                   position)
+
+    ranges = array('i')
+    for (category, difficulty, ordering), (start, end) in sorted(
+            spans.items()):
+        ranges.extend([category, difficulty, start, end, ordering])
+
+    return b''.join([
+        DECK_HEADER.pack(DECK_MAGIC, len(rows), len(ranges) // 5, len(text)),
+        ids.tobytes(), categories.tobytes(), difficulties.tobytes(),
+        text_offsets.tobytes(), by_difficulty.tobytes(), by_id.tobytes(),
+        ranges.tobytes(), bytes(text)])
+
+
+'''
+Deck
+    read-only view of the bytes of build_deck, e.g. a bytes object built
+    before the workers fork or a memory-mapped file. The arrays are
+    memoryviews of the buffer, so workers share its pages instead of
+    copying them, and a deck never changes once built
+'''
+
+
+class Deck:
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        magic, size, range_count, text_size = DECK_HEADER.unpack_from(view)
+        if magic != DECK_MAGIC:
+            raise ValueError('not a quiz deck')
+
+        offset = DECK_HEADER.size
+
+        def take(count, typecode):
+            nonlocal offset
+            length = count * array(typecode).itemsize
+            part = view[offset:offset + length].cast(typecode)
+            offset += length
+            return part
+
+        self.buffer = buffer
+        self.ids = take(size, 'i')
+        self.categories = take(size, 'i')
+        self.difficulties = take(size, 'i')
+        self.text_offsets = take(2 * size + 1, 'I')
+        self.by_difficulty = take(size, 'i')
+        self.by_id = take(size, 'i')
+        ranges = take(5 * range_count, 'i')
+        self.text = view[offset:offset + text_size]
+        self.ranges = {}
+        for start in range(0, len(ranges), 5):
+            category, difficulty, first, end, ordering = \
+                ranges[start:start + 5]
+            self.ranges[(category, None if difficulty == NONE
+                         else difficulty)] = (first, end, ordering)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _text(self, position):
+        return str(self.text[self.text_offsets[position]:
+                             self.text_offsets[position + 1]], 'utf-8')
+
+    def question(self, index):
+        category = self.categories[index]
+        difficulty = self.difficulties[index]
+        return DeckQuestion(
+            self.ids[index], self._text(2 * index), self._text(2 * index + 1),
+            None if category == NONE else category,
+            None if difficulty == NONE else difficulty)
+
+    def get(self, question_id):
+        '''
+        returns the question of the given id, or None
+        '''
+        low, high = 0, len(self.by_id)
+        while low < high:
+            middle = (low + high) // 2
+            if self.ids[self.by_id[middle]] < question_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.by_id) and self.ids[self.by_id[low]] == question_id:
+            return self.question(self.by_id[low])
+        return None
+
+    def count(self, category_id, difficulty=None):
+        start, end, _ = self.ranges.get(
+            (category_id, difficulty), (0, 0, RECORD_ORDER))
+        return end - start
+
+    def draw(self, category_id, excluded=frozenset(), difficulty=None):
+        '''
+        returns a uniformly random question of the category, of the given
+        difficulty if any, whose id is not in excluded, or None
+        '''
+        start, end, ordering = self.ranges.get(
+            (category_id, difficulty), (0, 0, RECORD_ORDER))
+        if start == end:
+            return None
+
+        if ordering == DIFFICULTY_ORDER:
+            indexes = self.by_difficulty[start:end]
+        else:
+            indexes = range(start, end)
+
+        for _ in range(MAX_SAMPLE_ATTEMPTS):
+            index = indexes[random.randrange(len(indexes))]
+            if self.ids[index] not in excluded:
+                return self.question(index)
+
+        # most of the category has been played, draw from what is left
+        remaining = [index for index in indexes
+                     if self.ids[index] not in excluded]
+        return self.question(random.choice(remaining)) if remaining else None
+
+
+'''
+write_deck(path, buffer)
+    replaces the deck file at path at once, so that readers map either the
+    previous deck or the new one
+'''
+
+
+def write_deck(path, buffer):
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'wb') as deck_file:
+        deck_file.write(buffer)
+        deck_file.flush()
+        os.fsync(deck_file.fileno())
+    os.replace(temporary_path, path)
+
+
+def file_identity(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+'''
+DeckStore
+    serves quiz turns from the current Deck of every question. The deck is
+    built from the database on first use and rebuilt, by one request while
+    the others keep drawing from the previous deck, after questions change
+    in this process or refresh_interval seconds after it was built, which
+    catches up on other workers. Deleted questions are left out of draws
+    right away. After a reset, e.g. when this process missed changes of
+    other workers, the previous deck keeps being drawn from while a thread
+    of its own rebuilds it. With a path, the deck is written to that file and
+    memory-mapped, so workers share one copy and map each other's rebuilds
+'''
+
+
+class DeckStore:
+
+    def __init__(self, path=None, refresh_interval=QUIZ_DECK_REFRESH_INTERVAL,
+                 file_check_interval=QUIZ_DECK_FILE_CHECK_INTERVAL):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.file_check_interval = file_check_interval
+        self._lock = threading.Lock()
+        self._refreshing = threading.Lock()
+        self._deck = None
+        self._loaded_at = 0.0
+        self._identity = None
+        self._checked_at = 0.0
+        self._changes = 0
+        self._built_changes = 0
+        self._reset_changes = 0
+        self._deleted = {}
+
+    @property
+    def loaded(self):
+        return self._deck is not None
+
+    def _fresh(self, check_file):
+        if self._deck is None or self._changes != self._built_changes:
+            return False
+        if time.time() - self._loaded_at >= self.refresh_interval:
+            return False
+        return not check_file or file_identity(self.path) == self._identity
+
+    def refresh_due(self):
+        '''
+        whether the deck is missing, out of date or, looked up at most every
+        file_check_interval seconds, replaced in the deck file
+        '''
+        check_file = False
+        if self.path is not None:
+            now = time.time()
+            if now - self._checked_at >= self.file_check_interval:
+                self._checked_at = now
+                check_file = True
+        return not self._fresh(check_file)
+
+    def refresh(self):
+        '''
+        maps the deck file when another worker replaced it, builds a new
+        deck otherwise. Returns at once while another thread refreshes a
+        loaded deck
+        '''
+        if not self._refreshing.acquire(blocking=self._deck is None):
+            return
+        try:
+            if self._fresh(self.path is not None):
+                # refreshed by another thread in the meantime
+                return
+            if not self._map_file():
+                self._build()
+        finally:
+            self._refreshing.release()
+
+    def ensure_loaded(self):
+        if self._deck is None:
+            self.refresh()
+
+    def _map_file(self):
+        if self.path is None or self._changes != self._built_changes:
+            return False
+        identity = file_identity(self.path)
+        if identity is None or identity == self._identity:
+            return False
+        with open(self.path, 'rb') as deck_file:
+            loaded_at = os.fstat(deck_file.fileno()).st_mtime
+            if time.time() - loaded_at >= self.refresh_interval:
+                return False
+            deck = Deck(mmap.mmap(deck_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ))
+        self._swap(deck, loaded_at, self._changes, identity)
+        return True
+
+    def _build(self):
+        changes = self._changes
+        with primary_reads():
+            buffer = build_deck(db.session.query(
+                Question.id, Question.question, Question.answer,
+                Question.category, Question.difficulty))
+
+        identity = None
+        deck = Deck(buffer)
+        if self.path is not None:
+            write_deck(self.path, buffer)
+            identity = file_identity(self.path)
+        self._swap(deck, time.time(), changes, identity)
+
+    def _swap(self, deck, loaded_at, changes, identity):
+        with self._lock:
+            self._deck = deck
+            self._loaded_at = loaded_at
+            self._identity = identity
+            self._built_changes = changes
+            # deletions before the build are left out of the deck itself
+            self._deleted = {question_id: change for question_id, change
+                             in self._deleted.items() if change > changes}
+
+    def _rebuild_in_background(self):
+        try:
+            self._build()
+        except Exception:
+            # the previous deck is drawn from until the next attempt
+            logger.exception('rebuilding the quiz deck failed')
+        finally:
+            db.session.remove()
+            self._refreshing.release()
+
+    def _current(self):
+        rebuild = False
+        if self.refresh_due():
+            if self._deck is not None and \
+                    self._reset_changes > self._built_changes:
+                rebuild = self._refreshing.acquire(blocking=False)
+            else:
+                self.refresh()
+        with self._lock:
+            current = self._deck, self._deleted
+        if rebuild:
+            threading.Thread(target=self._rebuild_in_background,
+                             daemon=True).start()
+        return current
+
+    def draw(self, category_id, excluded=frozenset(), difficulty=None):
+        deck, deleted = self._current()
+        if deleted:
+            excluded = set(excluded).union(deleted)
+        return deck.draw(category_id, excluded, difficulty)
+
+    def get(self, question_id):
+        deck, deleted = self._current()
+        if question_id in deleted:
+            return None
+        return deck.get(question_id)
+
+    def on_question_change(self, action, questions):
+        with self._lock:
+            self._changes += 1
+            if action == 'reset':
+                # rebuilt rather than mapped from the deck file, which may
+                # miss the same changes
+                self._reset_changes = self._changes
+            elif action == 'delete':
+                for question in questions:
+                    self._deleted[question.id] = self._changes
+
+
+'''
+deck_stores
+    DeckStores registered by create_app, notified of question changes
+'''
+deck_stores = weakref.WeakSet()
+
+
+def notify_deck_stores(action, questions):
+    for store in list(deck_stores):
+        store.on_question_change(action, questions)
+
+
+question_listeners.append(notify_deck_stores)
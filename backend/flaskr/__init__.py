@@ -1,21 +1,155 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import random
 
-from models import setup_db, Question, Category
-from helpers import get_paginated_questions
-from constants import MESSAGE_NOT_FOUND, MESSAGE_UNPROCESSABLE, MESSAGE_SERVER_ERROR
+from models import db, database_path, setup_db, Question, Category
+from changes import data_changes
+from db_pool import get_pool_stats
+from replicas import init_replicas
+from admission import init_admission_control
+from profiling import init_profiling
+from jobs import init_jobs, job_accepted, stage_upload
+from group_commit import GroupCommitWriter
+from instrumentation import init_instrumentation, pool_collector, \
+    cache_collector
+from helpers import get_paginated_questions, get_requested_offset, \
+    get_offset_cursor, is_valid_question, read_quiz_request
+from counts import question_counts
+from quiz import ALL_CATEGORIES, question_index, draw_question, \
+    select_random_question, select_adaptive_question
+from decks import DeckStore, deck_stores
+from quiz_sessions import InMemorySessionStore
+from cache import LRUCache, category_caches, get_categories_body, \
+    get_formatted_categories
+from bulk import read_csv_rows, read_ndjson_rows, import_questions, \
+    export_questions, is_valid_import_row
+from compression import init_compression
+from versioning import DataVersions, conditional, data_version_sets
+from serializers import QUESTION_COLUMNS, format_question_row, json_response
+from search import PostgresSearchBackend, search_index, search_question_ids, \
+    tokenize
+from constants import QUESTIONS_PER_PAGE, QUIZ_DECK_REFRESH_INTERVAL, \
+    DATA_CHANGES_CHECK_INTERVAL, DATA_CHANGES_HOLE_TIMEOUT, \
+    GROUP_COMMIT_WINDOW, GROUP_COMMIT_MAX_BATCH, \
+    MESSAGE_NOT_FOUND, MESSAGE_UNPROCESSABLE, MESSAGE_SERVER_ERROR, \
+    MESSAGE_TOO_LARGE, MESSAGE_TOO_MANY_REQUESTS, \
+    MESSAGE_SERVICE_UNAVAILABLE
 
 
 def create_app(test_config=None):
 
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    # e.g. DB_CREATE_ALL = False in the file TRIVIA_SETTINGS points to
+    app.config.from_envvar('TRIVIA_SETTINGS', silent=True)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    setup_db(app, app.config.get('DATABASE_PATH', database_path))
     cors = CORS(app, resources={r"/*": {"origin": "*"}})
 
+    # opt-in cProfile statistics and sampled stacks of the requests of a
+    # session started at POST /profiling. Registered first, so that the
+    # other hooks are profiled too
+    if app.config.get('PROFILING'):
+        init_profiling(app)
+
+    # per client rate limits and per route concurrency limits, answered
+    # with 429 and 503 before any query, so registered before the hooks
+    # that query
+    admission = init_admission_control(app)
+
+    # indexes, counts, decks and caches of this process catch up with the
+    # changes committed by other workers. Checked on the primary, before
+    # reads are routed to a replica
+    data_changes.reset()
+    data_changes.hole_timeout = app.config.get('DATA_CHANGES_HOLE_TIMEOUT',
+                                               DATA_CHANGES_HOLE_TIMEOUT)
+    check_interval = app.config.get('DATA_CHANGES_CHECK_INTERVAL',
+                                    DATA_CHANGES_CHECK_INTERVAL)
+
+    @app.before_request
+    def check_data_changes():
+        data_changes.check(check_interval)
+
+    # GET routes and quiz turns read from REPLICA_DATABASE_PATHS, if any
+    init_replicas(app, read_endpoints=('get_guesses',))
+
+    # bulk writes and maintenance run by background workers, see
+    # POST /jobs. JOB_STORE = 'database' keeps jobs in the jobs table for
+    # `python jobs.py` workers
+    jobs = init_jobs(app)
+
+    # questions created at once by concurrent requests are committed in
+    # one transaction
+    question_writer = None
+    if app.config.get('GROUP_COMMIT'):
+        question_writer = GroupCommitWriter(
+            app.config.get('GROUP_COMMIT_WINDOW', GROUP_COMMIT_WINDOW),
+            app.config.get('GROUP_COMMIT_MAX_BATCH', GROUP_COMMIT_MAX_BATCH))
+
+    # in-process by default, e.g. a KeyValueSessionStore to share sessions
+    # across workers
+    quiz_sessions = app.config.get('QUIZ_SESSION_STORE') or \
+        InMemorySessionStore()
+
+    # quiz turns drawn from a deck of every question kept in memory instead
+    # of the database. QUIZ_DECK_PATH shares one memory-mapped deck between
+    # workers, QUIZ_DECK_PRELOAD builds it before a preloading server forks
+    quiz_decks = None
+    if app.config.get('QUIZ_DECKS'):
+        quiz_decks = DeckStore(
+            app.config.get('QUIZ_DECK_PATH'),
+            app.config.get('QUIZ_DECK_REFRESH_INTERVAL',
+                           QUIZ_DECK_REFRESH_INTERVAL))
+        deck_stores.add(quiz_decks)
+        if app.config.get('QUIZ_DECK_PRELOAD'):
+            with app.app_context():
+                quiz_decks.ensure_loaded()
+    draw = quiz_decks.draw if quiz_decks is not None else draw_question
+
+    # e.g. a KeyValueCache to share the category list across workers
+    category_cache = app.config.get('CATEGORY_CACHE') or LRUCache()
+    category_caches.add(category_cache)
+
+    # validators of the read endpoints, from the versions of data_changes
+    # unless DATA_VERSION_STORE holds a key-value store
+    data_versions = DataVersions(app.config.get('DATA_VERSION_STORE'))
+    data_version_sets.add(data_versions)
+
+    # 'postgres' searches through the tsvector GIN index of the database
+    # instead of the in-process index
+    search_backend = search_index
+    if app.config.get('SEARCH_BACKEND') == 'postgres':
+        search_backend = PostgresSearchBackend()
+
+    # shared with the native routes of flaskr.asgi
+    app.extensions['trivia'] = {
+        "quiz_sessions": quiz_sessions,
+        "quiz_decks": quiz_decks,
+        "category_cache": category_cache,
+        "data_versions": data_versions,
+        "jobs": jobs,
+        "question_writer": question_writer
+    }
+
+    # opt-in per route latency, SQL and response size metrics at /metrics
+    if app.config.get('INSTRUMENTATION'):
+        metrics = init_instrumentation(app)
+        metrics.collectors.append(
+            pool_collector(lambda: db.get_engine(app).pool))
+        metrics.collectors.append(
+            cache_collector('categories', category_cache))
+
+    # gzip/brotli negotiated through Accept-Encoding, on by default
+    compression_cache = None
+    if app.config.get('COMPRESSION', True):
+        compression_cache = init_compression(app)
+        if app.config.get('INSTRUMENTATION'):
+            metrics.collectors.append(cache_collector(
+                'compressed_responses', compression_cache))
+
     # CORS Headers
     @app.after_request
     def after_request(response):
@@ -24,50 +158,83 @@ def create_app(test_config=None):
                              'GET, PATCH, POST, DELETE, OPTIONS')
         return response
 
-    @app.route('/categories', methods=['GET'])
-    def get_categories():
-        categories = Category.query.all()
-        formatted_categories = [category.format() for category in categories]
+    @app.route('/health/pool', methods=['GET'])
+    def get_pool_health():
         return jsonify({
             "success": True,
-            "categories": formatted_categories,
-            "total_categories": len(formatted_categories)
+            "pool": get_pool_stats(db.get_engine(app).pool)
         })
 
+    @app.route('/health/admission', methods=['GET'])
+    def get_admission_health():
+        return jsonify(dict(admission.stats(), success=True))
+
+    @app.route('/categories', methods=['GET'])
+    @conditional(data_versions, 'categories')
+    def get_categories():
+        return app.response_class(
+            get_categories_body(category_cache),
+            mimetype=app.config['JSONIFY_MIMETYPE'])
+
+    @app.route('/cache/stats', methods=['GET'])
+    def get_cache_stats():
+        stats = {
+            "success": True,
+            "categories": category_cache.stats()
+        }
+        if compression_cache is not None:
+            stats["compressed_responses"] = compression_cache.stats()
+        return jsonify(stats)
+
     @app.route('/categories/<int:category_id>/questions', methods=['GET'])
+    @conditional(data_versions, 'questions')
     def get_questions_in_category(category_id):
-        questions = Question.query.filter(
-            Question.category == category_id).all()
-        paginated_questions = get_paginated_questions(request, questions)
+        paginated_questions, total_questions, next_cursor = \
+            get_paginated_questions(request, Question.category == category_id,
+                                    question_counts.category(category_id))
 
         if len(paginated_questions) < 1:
             return abort(404)
 
-        return jsonify({
+        return json_response({
             "success": True,
             "questions": paginated_questions,
-            "total_questions": len(questions),
+            "total_questions": total_questions,
+            "next_cursor": next_cursor,
             "current_category": category_id
         })
 
     @app.route('/questions', methods=['GET'])
+    @conditional(data_versions, 'questions', 'categories')
     def get_questions():
-        questions = Question.query.all()
-        paginated_questions = get_paginated_questions(request, questions)
-
-        categories = Category.query.all()
+        paginated_questions, total_questions, next_cursor = \
+            get_paginated_questions(request, total=question_counts.total())
 
         if len(paginated_questions) < 1:
             return abort(404)
 
-        return jsonify({
+        return json_response({
             "success": True,
             "questions": paginated_questions,
-            "total_questions": len(questions),
-            "categories": [category.format() for category in categories],
+            "total_questions": total_questions,
+            "next_cursor": next_cursor,
+            "categories": get_formatted_categories(category_cache),
             "current_category": None
         })
 
+    @app.route('/questions/counts', methods=['GET'])
+    def get_question_counts():
+        total_questions, categories, difficulties = \
+            question_counts.snapshot()
+        return jsonify({
+            "success": True,
+            "total_questions": total_questions,
+            "categories": {str(category_id): count
+                           for category_id, count in categories.items()},
+            "difficulties": {str(difficulty): count
+                             for difficulty, count in difficulties.items()}
+        })
+
     @app.route('/questions/<int:question_id>', methods=['DELETE'])
     def delete_question(question_id):
         question = Question.query.filter(
@@ -81,6 +248,85 @@ def create_app(test_config=None):
             "deleted": question_id
         })
 
+    @app.route('/questions', methods=['DELETE'])
+    def delete_questions():
+        body = request.get_json()
+
+        if body is None or type(body.get('ids')) is not list or any(
+                type(question_id) is not int for question_id in body['ids']):
+            return abort(422)
+
+        if request.args.get('background') == 'true':
+            return job_accepted(jobs, 'delete_questions', {"ids": body['ids']})
+
+        deleted_ids = set(
+            record.id for record in Question.delete_all(body['ids']))
+
+        # an id repeated in the request is deleted once, like two
+        # DELETE /questions/<id> would
+        reported_ids = set()
+        results = []
+        for question_id in body['ids']:
+            if question_id in deleted_ids and question_id not in reported_ids:
+                reported_ids.add(question_id)
+                results.append({
+                    "success": True,
+                    "deleted": question_id
+                })
+            else:
+                results.append({
+                    "success": False,
+                    "error": 404,
+                    "message": MESSAGE_NOT_FOUND
+                })
+
+        return jsonify({
+            "success": True,
+            "results": results,
+            "total_deleted": len(deleted_ids)
+        })
+
+    @app.route('/questions/batch', methods=['POST'])
+    def create_questions():
+        body = request.get_json()
+
+        if not isinstance(body, dict) or \
+                type(body.get('questions')) is not list:
+            return abort(422)
+
+        # typed and of an existing category, like the rows of an import
+        category_ids = set(
+            category_id for category_id, in db.session.query(Category.id))
+        valid = [is_valid_import_row(item, category_ids)
+                 for item in body['questions']]
+        questions = [Question(
+            question=item['question'],
+            answer=item['answer'],
+            difficulty=item['difficulty'],
+            category=item['category'],
+        ) for item, is_valid in zip(body['questions'], valid) if is_valid]
+        created = iter(Question.insert_all(questions) if questions else [])
+
+        results = []
+        for is_valid in valid:
+            if is_valid:
+                results.append({
+                    "success": True,
+                    "created": next(created)._asdict()
+                })
+            else:
+                results.append({
+                    "success": False,
+                    "error": 422,
+                    "message": MESSAGE_UNPROCESSABLE
+                })
+
+        return jsonify({
+            "success": True,
+            "results": results,
+            "total_created": len(questions)
+        })
+
     @app.route('/questions', methods=['POST'])
     def create_question():
         body = request.get_json()
@@ -88,52 +334,168 @@ def create_app(test_config=None):
         if 'search_term' in body.keys():
             return search_questions(request, body['search_term'])
 
-        for key in ['question', 'answer', 'difficulty', 'category']:
-            if key not in body.keys() or body[key] == None or body[key] == '':
-                return abort(422)
+        if not is_valid_question(body):
+            return abort(422)
 
-        question = Question(
+        values = dict(
             question=body['question'],
             answer=body['answer'],
             difficulty=body['difficulty'],
             category=body['category'],
         )
-        question.insert()
+        if question_writer is not None:
+            created = question_writer.insert(values)._asdict()
+        else:
+            question = Question(**values)
+            question.insert()
+            created = question.format()
+
+        return jsonify({
+            "success": True,
+            "created": created
+        })
+
+    @app.route('/questions/import', methods=['POST'])
+    def import_questions_file():
+        upload_format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+        if request.args.get('background') == 'true':
+            # the job reads the upload from disk rather than its payload
+            return job_accepted(jobs, 'import_questions', {
+                "file": stage_upload(request.stream, upload_format)})
+
+        if upload_format == 'csv':
+            rows = read_csv_rows(request.stream)
+        else:
+            rows = read_ndjson_rows(request.stream)
+
+        imported, rejected, errors = import_questions(rows)
 
         return jsonify({
             "success": True,
-            "created": question.format()
+            "imported": imported,
+            "rejected": rejected,
+            "errors": errors
         })
 
+    @app.route('/questions/export', methods=['GET'])
+    def export_questions_file():
+        export_format = request.args.get('format', 'ndjson')
+        mimetypes = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+        if export_format not in mimetypes:
+            return abort(422)
+
+        return app.response_class(
+            stream_with_context(export_questions(export_format)),
+            mimetype=mimetypes[export_format])
+
     def search_questions(request, search_term):
-        questions = Question.query.filter(
-            Question.question.ilike('%'+search_term+'%')
-        ).all()
-        paginated_questions = get_paginated_questions(request, questions)
+        if type(search_term) is not str:
+            return abort(422)
 
-        if len(questions) > 0 and len(paginated_questions) < 1:
+        admission.admit('search_questions')
+
+        if not tokenize(search_term):
+            # nothing to match on, like an empty substring
+            paginated_questions, total_questions, next_cursor = \
+                get_paginated_questions(request, total=question_counts.total())
+        else:
+            offset = get_requested_offset(request)
+            question_ids, total_questions = search_question_ids(
+                search_term, offset, QUESTIONS_PER_PAGE, search_backend)
+            questions = db.session.query(*QUESTION_COLUMNS).filter(
+                Question.id.in_(question_ids)).all() if question_ids else []
+            # keep the ranking of the search
+            ranks = {question_id: rank
+                     for rank, question_id in enumerate(question_ids)}
+            questions.sort(key=lambda question: ranks[question.id])
+            paginated_questions = [format_question_row(question)
+                                   for question in questions]
+            next_cursor = get_offset_cursor(
+                offset, QUESTIONS_PER_PAGE, total_questions)
+
+        if total_questions > 0 and len(paginated_questions) < 1:
             return abort(404)
 
-        return jsonify({
+        return json_response({
             "success": True,
             "questions": paginated_questions,
-            "total_questions": len(questions),
+            "total_questions": total_questions,
+            "next_cursor": next_cursor,
             "current_category": None
         })
 
-    @app.route('/quizzes', methods=['POST'])
-    def get_guesses():
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def create_quiz_session():
         body = request.get_json()
 
         if body == None or 'quiz_category' not in body.keys():
             return abort(422)
 
-        previous_questions = []
-        if 'previous_questions' in body.keys():
-            previous_questions = body['previous_questions']
+        category_id = body['quiz_category'].get('id', ALL_CATEGORIES)
+        if type(category_id) is not int:
+            return abort(422)
 
-        question = Question.query.filter(
-            Question.category == body['quiz_category']['id'], Question.id.notin_(previous_questions)).first()
+        question_ids = question_index.ids(category_id)
+        return jsonify({
+            "success": True,
+            "session_id": quiz_sessions.create(category_id, question_ids),
+            "total_questions": len(question_ids)
+        })
+
+    @app.route('/quizzes/sessions/<session_id>', methods=['DELETE'])
+    def delete_quiz_session(session_id):
+        if not quiz_sessions.delete(session_id):
+            return abort(404)
+
+        return jsonify({
+            "success": True,
+            "deleted": session_id
+        })
+
+    def get_session_guess(session_id):
+        question = None
+        while question is None:
+            try:
+                turn = quiz_sessions.next_turn(session_id)
+            except KeyError:
+                return abort(404)
+
+            if turn is None:
+                break
+            category_id, question_id = turn
+            # skips the ids of the session span that are not questions of
+            # its category, e.g. deleted since the session started
+            if not question_index.contains(category_id, question_id):
+                continue
+            if quiz_decks is not None:
+                question = quiz_decks.get(question_id)
+            else:
+                question = Question.query.get(question_id)
+
+        return jsonify({
+            "success": True,
+            "question": question.format() if question != None else None
+        })
+
+    @app.route('/quizzes', methods=['POST'])
+    def get_guesses():
+        session_id, category_id, previous_questions, target_difficulty = \
+            read_quiz_request(request.get_json())
+
+        if session_id is not None:
+            return get_session_guess(session_id)
+
+        if target_difficulty is not None:
+            question = select_adaptive_question(
+                category_id, previous_questions, target_difficulty, draw)
+            return jsonify({
+                "success": True,
+                "question": None if question is None else question.format(),
+                "target_difficulty": target_difficulty
+            })
+
+        question = select_random_question(
+            category_id, previous_questions, draw)
 
         return jsonify({
             "success": True,
@@ -156,6 +518,35 @@ def create_app(test_config=None):
             "message": MESSAGE_UNPROCESSABLE
         }), 422
 
+    @app.errorhandler(413)
+    def too_large(error):
+        return jsonify({
+            "success": False,
+            "error": 413,
+            "message": MESSAGE_TOO_LARGE
+        }), 413
+
+    def retry_after_headers(error):
+        if getattr(error, 'retry_after', None) is None:
+            return {}
+        return {"Retry-After": str(error.retry_after)}
+
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return jsonify({
+            "success": False,
+            "error": 429,
+            "message": MESSAGE_TOO_MANY_REQUESTS
+        }), 429, retry_after_headers(error)
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": MESSAGE_SERVICE_UNAVAILABLE
+        }), 503, retry_after_headers(error)
+
     @app.errorhandler(500)
     def unprocessable(error):
         return jsonify({
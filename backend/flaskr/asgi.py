@@ -0,0 +1,671 @@
+import asyncio
+import contextvars
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import abort, g, request
+from flask.ctx import RequestContext
+from flask.signals import request_started
+from sqlalchemy import select
+from werkzeug.exceptions import ClientDisconnected, HTTPException
+from werkzeug.test import EnvironBuilder
+
+from flaskr import create_app
+from models import db, Question
+from async_db import create_database
+from cache import MISSING, encode_categories_body, select_categories
+from helpers import get_page_position, select_question_page, \
+    select_question_count, read_question_page, read_quiz_request
+from changes import select_position
+from counts import question_counts
+from quiz import difficulty_band, question_index
+from serializers import QUESTION_COLUMNS, format_category_row, \
+    format_question_row, get_encoder, json_response
+from versioning import set_validators
+from constants import ASGI_THREADS
+
+# async database of the replica init_replicas chose for the current request
+replica_database = contextvars.ContextVar('replica_database', default=None)
+
+
+'''
+RequestBody
+    wsgi.input of an ASGI http request, receiving its body as it is read.
+    Only read from threads of the executor: every read that runs out of
+    data waits for the event loop to receive the next message
+'''
+
+
+class RequestBody(io.RawIOBase):
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.pending = b''
+        self.more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending and self.more_body:
+            message = asyncio.run_coroutine_threadsafe(
+                self.receive(), self.loop).result()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected()
+            self.pending = message.get('body', b'')
+            self.more_body = message.get('more_body', False)
+
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+'''
+build_environ(scope, body)
+    builds the WSGI environ of an ASGI http request whose body is read from
+    the body stream
+'''
+
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode(
+            'latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # read up to the last message, whether or not it was sent chunked
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+'''
+start_message(status, headers)
+    builds the ASGI message starting a response from a WSGI status line and
+    header list
+'''
+
+
+def start_message(status, headers):
+    return {
+        'type': 'http.response.start',
+        'status': int(status.split(' ', 1)[0]),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers]
+    }
+
+
+'''
+TriviaASGI
+    serves a trivia app built by create_app over ASGI. The listings, the
+    category list and the quiz turns are native coroutines reading through
+    an async database (async_db.create_database) shared by every request of
+    the process, so that waiting on the database does not hold a thread.
+    Every other route runs the WSGI app in a thread of the executor.
+
+    Flask keeps the request context in a thread local, which coroutines
+    sharing the thread of the event loop would overwrite, so native routes
+    only push it around the synchronous steps, run in the executor since
+    hooks may query or read the body: before_request hooks, then, once the
+    data is read, rendering, error handlers and after_request hooks.
+    Responses, validators and errors stay the same as in WSGI mode, and so
+    does the replica reads are routed to
+'''
+
+
+class TriviaASGI:
+
+    def __init__(self, flask_app, executor=None):
+        self.flask_app = flask_app
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=flask_app.config.get('ASGI_THREADS', ASGI_THREADS),
+            thread_name_prefix='trivia-asgi')
+        self.extension = flask_app.extensions['trivia']
+        self.handlers = {
+            'get_categories': self.get_categories,
+            'get_questions': self.get_questions,
+            'get_questions_in_category': self.get_questions_in_category,
+            'get_guesses': self.get_guesses
+        }
+        self._database = None
+        self._replica_databases = {}
+        self._test_client = None
+
+    @property
+    def database(self):
+        replica = replica_database.get()
+        if replica is not None:
+            return replica
+        return self.primary_database
+
+    @property
+    def primary_database(self):
+        # created on first use, after setup_db may have rebound the app
+        if self._database is None:
+            app = self.flask_app
+            self._database = create_database(
+                app.config, app.config['SQLALCHEMY_DATABASE_URI'],
+                lambda: db.get_engine(app), self.executor)
+        return self._database
+
+    def get_replica_database(self, replica):
+        if replica not in self._replica_databases:
+            self._replica_databases[replica] = create_database(
+                self.flask_app.config, replica.database_path,
+                lambda: replica.engine, self.executor)
+        return self._replica_databases[replica]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise NotImplementedError(
+                'unsupported ASGI scope type: ' + scope['type'])
+
+        loop = asyncio.get_event_loop()
+        environ = build_environ(scope, io.BufferedReader(
+            RequestBody(receive, loop)))
+        handler, view_args = self.match(environ)
+        if handler is None:
+            await loop.run_in_executor(
+                self.executor, self.call_wsgi, environ, send, loop)
+            return
+
+        status, headers, body = await self.dispatch(
+            handler, view_args, environ)
+        await send(start_message(status, headers))
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def close(self):
+        if self._database is not None:
+            await self._database.close()
+            self._database = None
+        for database in self._replica_databases.values():
+            await database.close()
+        self._replica_databases = {}
+
+    def match(self, environ):
+        app = self.flask_app
+        adapter = app.create_url_adapter(app.request_class(environ))
+        try:
+            rule, view_args = adapter.match(return_rule=True)
+        except HTTPException:
+            # not found, redirects and the like are left to Flask
+            return None, None
+        return self.handlers.get(rule.endpoint), view_args
+
+    def call_wsgi(self, environ, send, loop):
+        '''
+        runs the WSGI app, streamed bodies included, in the calling thread:
+        the request context of a streamed response lives as long as its body
+        '''
+        response_start = []
+
+        def start_response(status, headers, exc_info=None):
+            response_start[:] = [status, headers]
+
+        def push(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        result = self.flask_app(environ, start_response)
+        try:
+            started = False
+            for chunk in result:
+                if not chunk:
+                    continue
+                if not started:
+                    push(start_message(*response_start))
+                    started = True
+                push({'type': 'http.response.body', 'body': chunk,
+                      'more_body': True})
+            if not started:
+                push(start_message(*response_start))
+            push({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    async def dispatch(self, handler, view_args, environ):
+        loop = asyncio.get_event_loop()
+        rv, current_request, state = await loop.run_in_executor(
+            self.executor, self.preprocess, environ)
+
+        replica = state.get('read_replica')
+        replica_database.set(self.get_replica_database(replica)
+                             if replica is not None else None)
+
+        if rv is None:
+            try:
+                payload, etag = await handler(current_request, **view_args)
+                rv = NativeResult(self.flask_app, payload, etag)
+            except Exception as error:
+                rv = error
+
+        return await loop.run_in_executor(
+            self.executor, self.finalize, environ, current_request, state, rv)
+
+    def preprocess(self, environ):
+        '''
+        runs the before_request hooks of a native route and reads its body,
+        returning what the hooks returned or raised, the request and the
+        state they left in g
+        '''
+        app = self.flask_app
+        with app.request_context(environ):
+            try:
+                app.try_trigger_before_first_request_functions()
+                request_started.send(app)
+                rv = app.preprocess_request()
+                if rv is None and request.method == 'POST':
+                    # parsed here, where a malformed body can be reported
+                    request.get_json()
+            except Exception as error:
+                rv = error
+            state = dict(g.__dict__)
+            # admission is released once the response is made, not as this
+            # context ends
+            g.pop('admitted', None)
+            return rv, request._get_current_object(), state
+
+    def finalize(self, environ, current_request, state, rv):
+        '''
+        turns what a native route returned or raised into a response, through
+        the error handlers and after_request hooks of the app, and returns
+        its status, headers and body
+        '''
+        app = self.flask_app
+        with RequestContext(app, environ, request=current_request):
+            g.__dict__.update(state)
+            try:
+                try:
+                    if isinstance(rv, Exception):
+                        raise rv
+                    if isinstance(rv, NativeResult):
+                        rv = rv.render()
+                except Exception as error:
+                    rv = app.handle_user_exception(error)
+                response = app.finalize_request(rv)
+            except Exception as error:
+                response = app.handle_exception(error)
+
+            app_iter, status, headers = response.get_wsgi_response(environ)
+            try:
+                return status, headers, b''.join(app_iter)
+            finally:
+                response.close()
+
+    async def call_in_app_context(self, function, *args):
+        def call():
+            with self.flask_app.app_context():
+                return function(*args)
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, call)
+
+    async def fetch_formatted_categories(self):
+        cache = self.extension['category_cache']
+        categories = cache.get('categories')
+        if categories is MISSING:
+            # kept past the request, so not read from a lagging replica
+            categories = [format_category_row(row) for row in
+                          await self.primary_database.fetch_all(
+                              select_categories())]
+            cache.set('categories', categories)
+        return categories
+
+    async def count_questions(self, category_id=None):
+        if not question_counts.loaded:
+            await self.call_in_app_context(question_counts.reconcile)
+        if category_id is None:
+            return question_counts.total()
+        return question_counts.category(category_id)
+
+    async def fetch_paginated_questions(self, request, condition=None,
+                                        total=None):
+        after, start = get_page_position(request.args)
+
+        rows = await self.database.fetch_all(
+            select_question_page(condition, after, start))
+        formatted_questions, total_questions, next_cursor = \
+            read_question_page(list(rows), start)
+
+        if total_questions is None:
+            total_questions = total
+        if total_questions is None:
+            total_questions = await self.database.fetch_value(
+                select_question_count(condition))
+
+        return formatted_questions, total_questions, next_cursor
+
+    async def fetch_question(self, question_id):
+        rows = await self.database.fetch_all(select(list(
+            QUESTION_COLUMNS)).where(Question.id == question_id))
+        return format_question_row(rows[0]) if rows else None
+
+    async def etag(self, request, *resources):
+        replica_position = None
+        if replica_database.get() is not None:
+            replica_position = await self.database.fetch_value(
+                select_position()) or 0
+        return self.extension['data_versions'].etag(
+            resources, request.full_path, replica_position)
+
+    async def get_categories(self, request):
+        etag = await self.etag(request, 'categories')
+        if request.if_none_match.contains_weak(etag):
+            return None, etag
+
+        cache = self.extension['category_cache']
+        body = cache.get('categories.json')
+        if body is MISSING:
+            body = encode_categories_body(
+                await self.fetch_formatted_categories(),
+                get_encoder(self.flask_app.config.get('SERIALIZER', 'auto')))
+            cache.set('categories.json', body)
+
+        return body, etag
+
+    async def get_questions_in_category(self, request, category_id):
+        etag = await self.etag(request, 'questions')
+        if request.if_none_match.contains_weak(etag):
+            return None, etag
+
+        paginated_questions, total_questions, next_cursor = \
+            await self.fetch_paginated_questions(
+                request, Question.category == category_id,
+                await self.count_questions(category_id))
+
+        if len(paginated_questions) < 1:
+            return abort(404)
+
+        return {
+            "success": True,
+            "questions": paginated_questions,
+            "total_questions": total_questions,
+            "next_cursor": next_cursor,
+            "current_category": category_id
+        }, etag
+
+    async def get_questions(self, request):
+        etag = await self.etag(request, 'questions', 'categories')
+        if request.if_none_match.contains_weak(etag):
+            return None, etag
+
+        paginated_questions, total_questions, next_cursor = \
+            await self.fetch_paginated_questions(
+                request, total=await self.count_questions())
+
+        if len(paginated_questions) < 1:
+            return abort(404)
+
+        return {
+            "success": True,
+            "questions": paginated_questions,
+            "total_questions": total_questions,
+            "next_cursor": next_cursor,
+            "categories": await self.fetch_formatted_categories(),
+            "current_category": None
+        }, etag
+
+    async def refresh_decks(self):
+        quiz_decks = self.extension['quiz_decks']
+        if quiz_decks is not None and quiz_decks.refresh_due():
+            await self.call_in_app_context(quiz_decks.refresh)
+        return quiz_decks
+
+    async def get_session_question(self, session_id):
+        quiz_sessions = self.extension['quiz_sessions']
+        quiz_decks = await self.refresh_decks()
+        if not question_index.loaded:
+            await self.call_in_app_context(question_index.ensure_loaded)
+
+        while True:
+            try:
+                turn = quiz_sessions.next_turn(session_id)
+            except KeyError:
+                return abort(404)
+
+            if turn is None:
+                return None
+            category_id, question_id = turn
+            # skips the ids of the session span that are not questions of
+            # its category, e.g. deleted since the session started
+            if not question_index.contains(category_id, question_id):
+                continue
+            if quiz_decks is not None:
+                question = quiz_decks.get(question_id)
+                if question is not None:
+                    question = question.format()
+            else:
+                question = await self.fetch_question(question_id)
+            if question is not None:
+                return question
+
+    async def draw_question(self, category_id, excluded, difficulty=None):
+        quiz_decks = await self.refresh_decks()
+        if quiz_decks is not None:
+            # without a round trip, on the event loop
+            question = quiz_decks.draw(category_id, excluded, difficulty)
+            return question.format() if question is not None else None
+
+        if not question_index.loaded:
+            await self.call_in_app_context(question_index.ensure_loaded)
+
+        while True:
+            question_id = question_index.choose(
+                category_id, excluded, difficulty)
+            if question_id is None:
+                return None
+
+            question = await self.fetch_question(question_id)
+            if question is not None:
+                return question
+
+            if replica_database.get() is not None:
+                # maybe not replayed on the replica yet
+                excluded = set(excluded) | {question_id}
+            else:
+                # deleted behind our back, e.g. by another worker
+                question_index.remove(question_id)
+
+    async def get_guesses(self, request):
+        session_id, category_id, previous_questions, target_difficulty = \
+            read_quiz_request(request.get_json())
+
+        if session_id is not None:
+            question = await self.get_session_question(session_id)
+        elif target_difficulty is not None:
+            excluded = set(previous_questions)
+            for difficulty in difficulty_band(target_difficulty):
+                question = await self.draw_question(
+                    category_id, excluded, difficulty)
+                if question is not None:
+                    break
+            return {
+                "success": True,
+                "question": question,
+                "target_difficulty": target_difficulty
+            }, None
+        else:
+            question = await self.draw_question(
+                category_id, set(previous_questions))
+
+        return {
+            "success": True,
+            "question": question
+        }, None
+
+    def test_client(self):
+        if self._test_client is None:
+            self._test_client = ASGITestClient(self)
+        return self._test_client
+
+
+'''
+NativeResult
+    what a native route returns: a payload (a dict, or bytes already
+    serialized) and its validator, rendered once the request context is
+    pushed again since jsonify needs it in debug mode. No payload means 304
+    Not Modified
+'''
+
+
+class NativeResult:
+
+    def __init__(self, app, payload, etag):
+        self.app = app
+        self.payload = payload
+        self.etag = etag
+
+    def render(self):
+        app = self.app
+        if self.payload is None:
+            response = app.response_class(status=304)
+        elif isinstance(self.payload, bytes):
+            response = app.response_class(
+                self.payload, mimetype=app.config['JSONIFY_MIMETYPE'])
+        else:
+            response = json_response(self.payload)
+
+        if self.etag is not None:
+            set_validators(response, self.etag, app.config)
+        return response
+
+
+'''
+ASGITestClient
+    sends requests to an ASGI app from synchronous code, taking the same
+    arguments as the test client of Flask and returning the same response
+    objects. Requests run one at a time on an event loop of the client, which
+    keeps the asyncpg pool of the app usable across requests
+'''
+
+
+class ASGITestClient:
+
+    def __init__(self, app):
+        self.app = app
+        self.loop = asyncio.new_event_loop()
+
+    def open(self, path, method='GET', **kwargs):
+        response = self.loop.run_until_complete(
+            self.open_async(path, method, **kwargs))
+        # like the Flask test client, whose requests end the session of the
+        # calling thread on teardown
+        db.session.remove()
+        return response
+
+    async def open_async(self, path, method='GET', **kwargs):
+        '''
+        sends a request from a coroutine running on the loop of the client,
+        e.g. to have many requests in flight at once
+        '''
+        builder = EnvironBuilder(path, method=method, **kwargs)
+        try:
+            environ = builder.get_environ()
+            body = environ['wsgi.input'].read()
+        finally:
+            builder.close()
+
+        headers = []
+        for key, value in environ.items():
+            if key in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                continue
+            if key.startswith('HTTP_'):
+                headers.append((key[5:].replace('_', '-').lower(), value))
+            elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH') and value:
+                headers.append((key.replace('_', '-').lower(), value))
+
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': environ['REQUEST_METHOD'],
+            'scheme': environ['wsgi.url_scheme'],
+            'path': environ['PATH_INFO'].encode('latin-1').decode('utf-8'),
+            'query_string': environ['QUERY_STRING'].encode('latin-1'),
+            'root_path': '',
+            'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers],
+            'server': (environ['SERVER_NAME'], int(environ['SERVER_PORT'])),
+            'client': ('127.0.0.1', 0)
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        await self.app(scope, receive, send)
+
+        start = messages[0]
+        return self.app.flask_app.response_class(
+            b''.join(message.get('body', b'') for message in messages[1:]),
+            status=start['status'],
+            headers=[(name.decode('latin-1'), value.decode('latin-1'))
+                     for name, value in start['headers']])
+
+    def get(self, path, **kwargs):
+        return self.open(path, method='GET', **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, method='POST', **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open(path, method='DELETE', **kwargs)
+
+    def head(self, path, **kwargs):
+        return self.open(path, method='HEAD', **kwargs)
+
+    def close(self):
+        self.loop.run_until_complete(self.app.close())
+        self.loop.close()
+
+
+'''
+create_asgi_app(test_config)
+    builds the app of create_app and serves it over ASGI, e.g. with
+    `uvicorn --factory flaskr.asgi:create_asgi_app`
+'''
+
+
+def create_asgi_app(test_config=None):
+    return TriviaASGI(create_app(test_config))
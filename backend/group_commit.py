@@ -0,0 +1,120 @@
+import threading
+import time
+
+from flask import g, has_app_context
+
+from models import db, Question, QuestionRecord, notify_question_listeners
+from constants import GROUP_COMMIT_WINDOW, GROUP_COMMIT_MAX_BATCH
+
+
+class PendingInsert:
+
+    __slots__ = ('values', 'record', 'error', 'done', 'ready')
+
+    def __init__(self, values):
+        self.values = values
+        self.record = None
+        self.error = None
+        self.done = False
+        # set when the insert is written, or when this caller is to lead
+        # the next batch
+        self.ready = threading.Event()
+
+
+'''
+GroupCommitWriter
+    inserts questions of concurrent callers in shared transactions. The
+    first caller to arrive leads a batch: once the batch committed before
+    it is done, and window seconds later if any, it inserts every question
+    queued in the meantime, up to max_batch, in one transaction on its own
+    session and hands the next batch to the first caller left waiting. The
+    others wait for their row. A batch that fails is retried one question
+    per transaction, so that every caller gets its own record or error
+'''
+
+
+class GroupCommitWriter:
+
+    def __init__(self, window=GROUP_COMMIT_WINDOW,
+                 max_batch=GROUP_COMMIT_MAX_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._committing = threading.Lock()
+        self._pending = []
+        self.batches = 0
+        self.inserts = 0
+
+    def insert(self, values):
+        '''
+        inserts a question of the given column values and returns its
+        QuestionRecord once committed, or raises the error of its insert
+        '''
+        entry = PendingInsert(values)
+        with self._lock:
+            self._pending.append(entry)
+            leads = len(self._pending) == 1
+        if not leads:
+            entry.ready.wait()
+        if not entry.done:
+            self._lead()
+
+        if entry.error is not None:
+            raise entry.error
+        if has_app_context():
+            # the row is on the primary, whichever session wrote it
+            g.wrote_primary = True
+        return entry.record
+
+    def _lead(self):
+        with self._committing:
+            if self.window:
+                time.sleep(self.window)
+            with self._lock:
+                batch = self._pending[:self.max_batch]
+                self._pending = self._pending[self.max_batch:]
+                follower = self._pending[0] if self._pending else None
+
+            try:
+                self._commit(batch)
+            finally:
+                for entry in batch:
+                    if entry.record is None and entry.error is None:
+                        entry.error = RuntimeError('insert not written')
+                    entry.done = True
+                    entry.ready.set()
+                # waits for this batch to be released before leading
+                if follower is not None:
+                    follower.ready.set()
+
+    def _commit(self, batch):
+        try:
+            questions = [Question(**entry.values) for entry in batch]
+            db.session.add_all(questions)
+            db.session.flush()
+            records = [QuestionRecord(**question.format())
+                       for question in questions]
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            if len(batch) == 1:
+                batch[0].error = error
+                return
+            for entry in batch:
+                self._commit([entry])
+            return
+
+        with self._lock:
+            self.batches += 1
+            self.inserts += len(batch)
+        for entry, record in zip(batch, records):
+            entry.record = record
+        notify_question_listeners('insert', records)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "inserts": self.inserts,
+                "pending": len(self._pending)
+            }
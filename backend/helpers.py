@@ -1,16 +1,249 @@
-from flask import request, abort
+import base64
+import binascii
+import json
+
+from flask import abort
+from sqlalchemy import func, select
+
+from models import db, Question
+from serializers import QUESTION_COLUMNS, format_question_row
+from quiz import ALL_CATEGORIES, next_target_difficulty
 from constants import QUESTIONS_PER_PAGE
 
+QUESTION_FIELDS = ['question', 'answer', 'difficulty', 'category']
 
-def get_paginated_questions(request, selection):
-    page = request.args.get('page', 1, type=int)
 
+'''
+encode_cursor(position)
+    serializes a pagination position into an opaque, url-safe cursor
+'''
+
+
+def encode_cursor(position):
+    raw = json.dumps(position, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+'''
+decode_cursor(cursor)
+    parses a cursor created by encode_cursor, aborting with 422 when it is
+    malformed
+'''
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        position = json.loads(raw.decode('utf-8'))
+    except (binascii.Error, ValueError):
+        return abort(422)
+
+    if not isinstance(position, dict):
+        return abort(422)
+
+    return position
+
+
+'''
+get_page_position(args)
+    returns the position of the requested page of questions as (after,
+    start): the id following a `cursor` argument for keyset pagination, or
+    the offset of a `page` argument
+'''
+
+
+def get_page_position(args):
+    cursor = args.get('cursor')
+
+    if cursor is not None:
+        position = decode_cursor(cursor)
+        after = position.get('after')
+        if type(after) is not int:
+            return abort(422)
+        return after, None
+
+    page = args.get('page', 1, type=int)
+    if page < 1:
+        return abort(422)
+
+    return None, (page - 1) * QUESTIONS_PER_PAGE
+
+
+'''
+select_question_page(condition, after, start)
+select_question_count(condition)
+    build the statements reading a page of the questions matching condition
+    (all questions when None) and their count. The page holds one extra row,
+    which tells whether another page follows
+'''
+
+
+def select_question_page(condition, after, start):
+    statement = select(list(QUESTION_COLUMNS))
+    if condition is not None:
+        statement = statement.where(condition)
+
+    if after is not None:
+        statement = statement.where(Question.id > after)
+    statement = statement.order_by(Question.id)
+    if start is not None:
+        statement = statement.offset(start)
+
+    return statement.limit(QUESTIONS_PER_PAGE + 1)
+
+
+def select_question_count(condition):
+    statement = select([func.count(Question.id)])
+    if condition is not None:
+        statement = statement.where(condition)
+    return statement
+
+
+'''
+read_question_page(rows, start)
+    turns the rows read by select_question_page into the formatted questions
+    on the page, the total count when the rows already tell it (None
+    otherwise) and the cursor of the next page (None on the last page)
+'''
+
+
+def read_question_page(rows, start):
+    has_next = len(rows) > QUESTIONS_PER_PAGE
+    rows = rows[:QUESTIONS_PER_PAGE]
+    formatted_questions = [format_question_row(row) for row in rows]
+
+    # the first page already tells the total when nothing follows it
+    total_questions = None
+    if start == 0 and not has_next:
+        total_questions = len(rows)
+
+    next_cursor = None
+    if has_next:
+        next_cursor = encode_cursor({'after': rows[-1][0]})
+
+    return formatted_questions, total_questions, next_cursor
+
+
+'''
+get_paginated_questions(request, condition, total)
+    fetches one page of the questions matching condition (all questions when
+    None) ordered by id, either by page number (LIMIT/OFFSET) or, when a
+    `cursor` argument is given, by keyset on Question.id. Returns the
+    formatted questions on the page, the total count and the cursor of the
+    next page (None on the last page). The total is counted unless the page
+    tells it or it is given, e.g. by counts.question_counts
+'''
+
+
+def get_paginated_questions(request, condition=None, total=None):
+    after, start = get_page_position(request.args)
+
+    rows = db.session.execute(
+        select_question_page(condition, after, start)).fetchall()
+    formatted_questions, total_questions, next_cursor = \
+        read_question_page(rows, start)
+
+    if total_questions is None:
+        total_questions = total
+    if total_questions is None:
+        total_questions = db.session.execute(
+            select_question_count(condition)).scalar()
+
+    return formatted_questions, total_questions, next_cursor
+
+
+'''
+get_requested_offset(request)
+    returns the offset of the requested page of a ranked result, given either
+    by page number or by a `cursor` argument created by get_offset_cursor
+'''
+
+
+def get_requested_offset(request):
+    cursor = request.args.get('cursor')
+
+    if cursor is not None:
+        offset = decode_cursor(cursor).get('offset')
+        if type(offset) is not int or offset < 0:
+            return abort(422)
+        return offset
+
+    page = request.args.get('page', 1, type=int)
     if page < 1:
         return abort(422)
 
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    formatted_questions = [question.format()
-                           for question in selection]
+    return (page - 1) * QUESTIONS_PER_PAGE
+
+
+'''
+get_offset_cursor(offset, page_size, total)
+    returns the cursor of the page following the one at offset, None on the
+    last page
+'''
+
+
+def get_offset_cursor(offset, page_size, total):
+    if offset + page_size >= total:
+        return None
+    return encode_cursor({'offset': offset + page_size})
+
+
+'''
+is_valid_question(body)
+    tells whether body holds every field required to create a question
+'''
+
+
+def is_valid_question(body):
+    if not isinstance(body, dict):
+        return False
+
+    for key in QUESTION_FIELDS:
+        if key not in body.keys() or body[key] is None or body[key] == '':
+            return False
+
+    return True
+
+
+'''
+read_quiz_request(body)
+    validates the body of POST /quizzes, returning (session_id, None, None,
+    None) for a turn of a quiz session and (None, category_id,
+    previous_questions, target_difficulty) otherwise. target_difficulty is
+    None unless the body holds an `adaptive` object, with the previous
+    `target` and whether the last answer was `correct`, if any. Aborts with
+    422 when it is malformed
+'''
+
+
+def read_quiz_request(body):
+    if not isinstance(body, dict):
+        return abort(422)
+    if 'session_id' in body.keys():
+        if type(body['session_id']) is not str:
+            return abort(422)
+        return body['session_id'], None, None, None
+
+    if 'quiz_category' not in body.keys() or \
+            not isinstance(body['quiz_category'], dict):
+        return abort(422)
+
+    previous_questions = []
+    if 'previous_questions' in body.keys():
+        previous_questions = body['previous_questions']
+
+    category_id = body['quiz_category'].get('id', ALL_CATEGORIES)
+    if type(category_id) is not int or type(previous_questions) is not list:
+        return abort(422)
+
+    target_difficulty = None
+    if body.get('adaptive') is not None:
+        adaptive = body['adaptive']
+        if not isinstance(adaptive, dict) or \
+                type(adaptive.get('target', 0)) is not int or \
+                type(adaptive.get('correct', False)) is not bool:
+            return abort(422)
+        target_difficulty = next_target_difficulty(
+            adaptive.get('target'), adaptive.get('correct'))
 
-    return formatted_questions[start:end]
+    return None, category_id, previous_questions, target_difficulty
@@ -0,0 +1,272 @@
+import logging
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from db_pool import get_pool_stats
+from constants import SLOW_REQUEST_THRESHOLD, SLOW_REQUEST_MAX_STATEMENTS
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+slow_request_logger = logging.getLogger('trivia.slow_requests')
+
+
+'''
+Histogram
+    cumulative histogram in the Prometheus sense: each bucket counts the
+    observations less than or equal to its upper bound
+'''
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+'''
+format_labels(labels)
+    renders a dict of labels in the Prometheus text format
+'''
+
+
+def format_labels(labels):
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in sorted(labels.items())) + '}'
+
+
+'''
+Metrics
+    per route request metrics rendered in the Prometheus text exposition
+    format. Collectors are callables returning extra (name, type, help,
+    [(labels, value)]) metric families, read when the metrics are rendered
+'''
+
+
+class Metrics:
+
+    histograms = [
+        ('trivia_request_duration_seconds', LATENCY_BUCKETS,
+         'Time spent handling the request.'),
+        ('trivia_request_sql_duration_seconds', LATENCY_BUCKETS,
+         'Time spent executing SQL statements during the request.'),
+        ('trivia_request_sql_statements', STATEMENT_BUCKETS,
+         'Number of SQL statements executed during the request.'),
+        ('trivia_response_size_bytes', SIZE_BUCKETS,
+         'Size of the response body, streamed responses excluded.'),
+    ]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._histograms = {name: {} for name, _, _ in self.histograms}
+        self.collectors = []
+
+    def observe(self, name, labels, value):
+        key = tuple(sorted(labels.items()))
+        buckets = next(buckets for histogram, buckets, _ in self.histograms
+                       if histogram == name)
+        with self._lock:
+            histogram = self._histograms[name].get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def count_request(self, labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+    def render(self):
+        lines = [
+            '# HELP trivia_requests_total Requests handled.',
+            '# TYPE trivia_requests_total counter',
+        ]
+        with self._lock:
+            for key, value in sorted(self._requests.items()):
+                lines.append('trivia_requests_total{} {}'.format(
+                    format_labels(dict(key)), value))
+
+            for name, _, description in self.histograms:
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} histogram'.format(name))
+                for key, histogram in sorted(self._histograms[name].items()):
+                    labels = dict(key)
+                    for bound, count in zip(histogram.buckets,
+                                            histogram.counts):
+                        lines.append('{}_bucket{} {}'.format(
+                            name, format_labels(dict(labels, le=bound)),
+                            count))
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(dict(labels, le='+Inf')),
+                        histogram.count))
+                    lines.append('{}_sum{} {}'.format(
+                        name, format_labels(labels), histogram.sum))
+                    lines.append('{}_count{} {}'.format(
+                        name, format_labels(labels), histogram.count))
+
+        for collector in self.collectors:
+            for name, metric_type, description, samples in collector():
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+                for labels, value in samples:
+                    lines.append('{}{} {}'.format(
+                        name, format_labels(labels), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+'''
+pool_collector(get_pool)
+    collector exporting the statistics of the connection pool returned by
+    get_pool, see db_pool.get_pool_stats
+'''
+
+
+def pool_collector(get_pool):
+    def collect():
+        stats = get_pool_stats(get_pool())
+        return [
+            ('trivia_db_pool_' + name, 'counter' if name in (
+                'checkouts', 'timeouts', 'wait_time_total') else 'gauge',
+             'Connection pool {}.'.format(name.replace('_', ' ')),
+             [({}, value)])
+            for name, value in sorted(stats.items())
+            if isinstance(value, (int, float))
+        ]
+    return collect
+
+
+'''
+cache_collector(name, cache)
+    collector exporting the hit and miss counters of a cache
+'''
+
+
+def cache_collector(name, cache):
+    def collect():
+        stats = cache.stats()
+        return [
+            ('trivia_cache_' + counter + '_total', 'counter',
+             'Cache {}.'.format(counter), [({"cache": name}, stats[counter])])
+            for counter in ('hits', 'misses')
+        ]
+    return collect
+
+
+'''
+SQL statement tracking
+    engine events recording the statements of the current request, if it is
+    instrumented. They are registered once for every engine on the first
+    call to init_instrumentation
+'''
+_sql_events_registered = False
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if has_request_context() and 'instrumentation' in g:
+        conn.info.setdefault('query_started_at', []).append(
+            time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started_at = conn.info.get('query_started_at')
+    if not started_at or not has_request_context() or \
+            'instrumentation' not in g:
+        return
+
+    duration = time.perf_counter() - started_at.pop()
+    state = g.instrumentation
+    state['sql_statements'] += 1
+    state['sql_time'] += duration
+    if len(state['statements']) < SLOW_REQUEST_MAX_STATEMENTS:
+        state['statements'].append((duration, statement))
+
+
+def register_sql_events():
+    global _sql_events_registered
+    if not _sql_events_registered:
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        _sql_events_registered = True
+
+
+'''
+init_instrumentation(app, metrics)
+    records latency, SQL statements, SQL time and response size of every
+    request of the app, serves them at GET /metrics and logs requests slower
+    than SLOW_REQUEST_THRESHOLD seconds with their statements
+'''
+
+
+def init_instrumentation(app, metrics=None):
+    metrics = metrics or Metrics()
+    threshold = app.config.get('SLOW_REQUEST_THRESHOLD',
+                               SLOW_REQUEST_THRESHOLD)
+    register_sql_events()
+
+    @app.before_request
+    def start_instrumentation():
+        g.instrumentation = {
+            "started_at": time.perf_counter(),
+            "sql_statements": 0,
+            "sql_time": 0.0,
+            "statements": []
+        }
+
+    @app.after_request
+    def record_instrumentation(response):
+        state = g.pop('instrumentation', None)
+        if state is None:
+            return response
+
+        duration = time.perf_counter() - state['started_at']
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = {"method": request.method, "route": route}
+
+        metrics.count_request(dict(labels, status=response.status_code))
+        metrics.observe('trivia_request_duration_seconds', labels, duration)
+        metrics.observe('trivia_request_sql_duration_seconds', labels,
+                        state['sql_time'])
+        metrics.observe('trivia_request_sql_statements', labels,
+                        state['sql_statements'])
+        if not response.is_streamed:
+            metrics.observe('trivia_response_size_bytes', labels,
+                            response.calculate_content_length() or 0)
+
+        if duration >= threshold:
+            slow_request_logger.warning(
+                'slow request %s %s: %.3fs, %d SQL statements in %.3fs\n%s',
+                request.method, request.full_path, duration,
+                state['sql_statements'], state['sql_time'],
+                '\n'.join('  {:.3f}s {}'.format(statement_duration, statement)
+                          for statement_duration, statement
+                          in state['statements']))
+
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return app.response_class(
+            metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    return metrics
@@ -0,0 +1,606 @@
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import abort, current_app, jsonify, request
+from sqlalchemy import and_, select
+
+from models import db, database_path, mark_changed, Job, Question
+from bulk import import_questions, read_csv_rows, read_ndjson_rows
+from counts import question_counts
+from search import search_index
+from constants import BULK_BATCH_SIZE, BULK_MAX_REPORTED_ERRORS, \
+    JOB_WORKERS, JOB_MAX_ATTEMPTS, JOB_RETRY_DELAY, JOB_LEASE_SECONDS, \
+    JOB_POLL_INTERVAL, JOB_HISTORY, JOB_UPLOAD_DIRECTORY, \
+    JOB_UPLOAD_MAX_BYTES
+
+logger = logging.getLogger('trivia.jobs')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+'''
+JobRecord
+    copy of a job as read from a job store
+'''
+
+
+class JobRecord(namedtuple('JobRecord', [
+        'id', 'kind', 'payload', 'status', 'attempts', 'progress_done',
+        'progress_total', 'result', 'error', 'created_at', 'updated_at'])):
+    __slots__ = ()
+
+    def format(self):
+        # the payload may hold the ids of a whole delete, it is left out
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts,
+            'progress': {
+                'done': self.progress_done,
+                'total': self.progress_total
+            },
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat()
+        }
+
+
+'''
+InMemoryJobStore
+    jobs of the current process, lost when it exits. The max_finished most
+    recently finished jobs are kept for their status
+'''
+
+
+class InMemoryJobStore:
+
+    def __init__(self, max_finished=JOB_HISTORY):
+        self.max_finished = max_finished
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._jobs = OrderedDict()
+        self._finished = OrderedDict()
+
+    def _record(self, job):
+        return JobRecord(**{field: job[field] for field in JobRecord._fields})
+
+    def create(self, kind, payload):
+        now = utcnow()
+        with self._lock:
+            job_id = next(self._ids)
+            self._jobs[job_id] = {
+                'id': job_id, 'kind': kind, 'payload': payload,
+                'status': QUEUED, 'attempts': 0, 'progress_done': 0,
+                'progress_total': None, 'result': None, 'error': None,
+                'created_at': now, 'updated_at': now, 'available_at': now
+            }
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._record(job) if job is not None else None
+
+    def claim(self, lease_seconds):
+        now = utcnow()
+        with self._lock:
+            for job in self._jobs.values():
+                if job['status'] in (QUEUED, RUNNING) and \
+                        job['available_at'] <= now:
+                    job.update(
+                        status=RUNNING, attempts=job['attempts'] + 1,
+                        updated_at=now, available_at=now +
+                        datetime.timedelta(seconds=lease_seconds))
+                    return self._record(job)
+        return None
+
+    def update(self, job_id, attempts, values):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['attempts'] != attempts:
+                return False
+            job.update(values)
+            if job['status'] in (SUCCEEDED, FAILED):
+                self._finished[job_id] = True
+                while len(self._finished) > self.max_finished:
+                    finished_id, _ = self._finished.popitem(last=False)
+                    del self._jobs[finished_id]
+        return True
+
+
+'''
+DatabaseJobStore
+    jobs kept in the jobs table, shared by every process using the
+    database, e.g. web workers enqueueing jobs and `python jobs.py` running
+    them. Workers claim a job with SELECT ... FOR UPDATE SKIP LOCKED on
+    Postgres, and the claim only goes through when the job is still
+    claimable, so two workers never run the same attempt
+'''
+
+
+class DatabaseJobStore:
+
+    table = Job.__table__
+
+    def _record(self, row):
+        return JobRecord(
+            row.id, row.kind, json.loads(row.payload), row.status,
+            row.attempts, row.progress_done, row.progress_total,
+            json.loads(row.result) if row.result is not None else None,
+            row.error, row.created_at, row.updated_at)
+
+    def create(self, kind, payload):
+        now = utcnow()
+        job_id = db.session.execute(self.table.insert().values(
+            kind=kind, payload=json.dumps(payload), status=QUEUED,
+            attempts=0, progress_done=0, created_at=now, updated_at=now,
+            available_at=now)).inserted_primary_key[0]
+        db.session.commit()
+        return job_id
+
+    def get(self, job_id):
+        row = db.session.execute(select([self.table]).where(
+            self.table.c.id == job_id)).first()
+        return self._record(row) if row is not None else None
+
+    def claim(self, lease_seconds):
+        now = utcnow()
+        claimable = and_(self.table.c.status.in_([QUEUED, RUNNING]),
+                         self.table.c.available_at <= now)
+        job_id = db.session.execute(
+            select([self.table.c.id]).where(claimable).order_by(
+                self.table.c.available_at, self.table.c.id).limit(1)
+            .with_for_update(skip_locked=True)).scalar()
+        if job_id is None:
+            db.session.commit()
+            return None
+
+        claimed = db.session.execute(self.table.update().where(and_(
+            self.table.c.id == job_id, claimable)).values(
+            status=RUNNING, attempts=self.table.c.attempts + 1,
+            updated_at=now,
+            available_at=now + datetime.timedelta(seconds=lease_seconds))
+        ).rowcount
+        db.session.commit()
+        # another worker claimed it between the two statements
+        return self.get(job_id) if claimed else None
+
+    def update(self, job_id, attempts, values):
+        values = dict(values)
+        if 'result' in values:
+            values['result'] = json.dumps(values['result'])
+        updated = db.session.execute(self.table.update().where(and_(
+            self.table.c.id == job_id,
+            self.table.c.attempts == attempts)).values(**values)).rowcount
+        db.session.commit()
+        return updated == 1
+
+
+'''
+job_kinds
+    the jobs a JobQueue runs, registered with @job_kind(name, is_valid,
+    finished): run(job, progress) returns the JSON result of the job and may
+    call progress(done, total, result) to report how far it is and the
+    result so far, which a retried attempt finds in job.progress_done and
+    job.result. is_valid(payload) tells the payloads enqueue() accepts, and
+    finished(job), if any, is called once the job succeeded or failed for
+    good
+'''
+JobKind = namedtuple('JobKind', ['run', 'is_valid', 'finished'])
+job_kinds = {}
+
+
+def job_kind(name, is_valid=lambda payload: True, finished=None):
+    def register(run):
+        job_kinds[name] = JobKind(run, is_valid, finished)
+        return run
+    return register
+
+
+class LeaseLost(Exception):
+    '''
+    the job was claimed by another worker after the lease of this one
+    expired
+    '''
+
+
+'''
+JobQueue
+    runs the jobs of a store in the background, on worker threads started
+    with the first job enqueued in this process, or on those of `python
+    jobs.py`. A failed attempt is retried after retry_delay seconds, doubled
+    on every attempt, until max_attempts attempts failed. A worker holds a
+    job for lease_seconds, renewed whenever it reports progress, after which
+    another worker takes the job over as a new attempt
+'''
+
+
+class JobQueue:
+
+    def __init__(self, app, store=None, workers=JOB_WORKERS,
+                 max_attempts=JOB_MAX_ATTEMPTS, retry_delay=JOB_RETRY_DELAY,
+                 lease_seconds=JOB_LEASE_SECONDS,
+                 poll_interval=JOB_POLL_INTERVAL):
+        self.app = app
+        self.store = store or InMemoryJobStore()
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def enqueue(self, kind, payload=None):
+        '''
+        stores a job and returns its record. Raises ValueError for unknown
+        kinds and invalid payloads
+        '''
+        payload = {} if payload is None else payload
+        if kind not in job_kinds or type(payload) is not dict or \
+                not job_kinds[kind].is_valid(payload):
+            raise ValueError('invalid job')
+
+        job_id = self.store.create(kind, payload)
+        if self.workers:
+            self.start()
+            self._wakeup.set()
+        return self.store.get(job_id)
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping.clear()
+            for number in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, daemon=True,
+                    name='trivia-jobs-{}'.format(number))
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in threads:
+            thread.join(timeout)
+
+    def _work(self):
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            try:
+                ran = self.run_next()
+            except Exception:
+                logger.exception('claiming a job failed')
+                ran = False
+            if not ran:
+                self._wakeup.wait(self.poll_interval)
+
+    def run_next(self):
+        '''
+        claims a job and runs it, returns whether there was one
+        '''
+        with self.app.app_context():
+            job = self.store.claim(self.lease_seconds)
+            if job is None:
+                return False
+            self._run(job)
+        return True
+
+    def run_pending(self):
+        '''
+        runs the claimable jobs on the calling thread, including retries
+        that are due at once, and returns the number of attempts
+        '''
+        attempts = 0
+        while self.run_next():
+            attempts += 1
+        return attempts
+
+    def _run(self, job):
+        def progress(done, total=None, result=None):
+            now = utcnow()
+            if not self.store.update(job.id, job.attempts, {
+                    'progress_done': done, 'progress_total': total,
+                    'result': result, 'updated_at': now,
+                    'available_at': now + datetime.timedelta(
+                        seconds=self.lease_seconds)}):
+                raise LeaseLost()
+
+        kind = job_kinds[job.kind]
+        try:
+            result = kind.run(job, progress)
+        except LeaseLost:
+            db.session.rollback()
+            logger.warning('job %s was taken over by another worker', job.id)
+            return
+        except Exception as error:
+            db.session.rollback()
+            logger.exception('job %s (%s) failed', job.id, job.kind)
+            now = utcnow()
+            values = {
+                'error': '{}: {}'.format(type(error).__name__, error),
+                'updated_at': now
+            }
+            if job.attempts >= self.max_attempts:
+                values['status'] = FAILED
+            else:
+                values['status'] = QUEUED
+                values['available_at'] = now + datetime.timedelta(
+                    seconds=self.retry_delay * 2 ** (job.attempts - 1))
+            if self.store.update(job.id, job.attempts, values) and \
+                    values['status'] == FAILED:
+                self._finish(kind, job)
+            return
+
+        if self.store.update(job.id, job.attempts, {
+                'status': SUCCEEDED, 'result': result, 'error': None,
+                'updated_at': utcnow()}):
+            self._finish(kind, job)
+
+    def _finish(self, kind, job):
+        if kind.finished is None:
+            return
+        try:
+            kind.finished(job)
+        except Exception:
+            logger.exception('finishing job %s (%s) failed', job.id, job.kind)
+
+
+'''
+upload_directory(config)
+    directory of the files staged for import_questions jobs,
+    JOB_UPLOAD_DIRECTORY or a directory of the system temporary directory.
+    `python jobs.py` workers on other hosts need it shared with the web
+    workers
+'''
+
+
+def upload_directory(config):
+    return config.get('JOB_UPLOAD_DIRECTORY', JOB_UPLOAD_DIRECTORY) or \
+        os.path.join(tempfile.gettempdir(), 'trivia-uploads')
+
+
+UPLOAD_NAME_PATTERN = re.compile(r'^[0-9a-f]{32}\.(csv|ndjson)$')
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+'''
+stage_upload(stream, upload_format)
+    copies an upload of the given format, 'csv' or 'ndjson', to a new file
+    of the upload directory of the current app, and returns its name for
+    the payload of an import_questions job. Aborts with 413 once the upload
+    exceeds JOB_UPLOAD_MAX_BYTES, removing what was copied
+'''
+
+
+def stage_upload(stream, upload_format):
+    max_bytes = current_app.config.get('JOB_UPLOAD_MAX_BYTES',
+                                       JOB_UPLOAD_MAX_BYTES)
+    if request.content_length is not None and \
+            request.content_length > max_bytes:
+        return abort(413)
+
+    directory = upload_directory(current_app.config)
+    os.makedirs(directory, exist_ok=True)
+    name = '{}.{}'.format(secrets.token_hex(16), upload_format)
+    path = os.path.join(directory, name)
+    copied = 0
+    with open(path, 'wb') as upload:
+        # chunked uploads tell no length up front
+        for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+            copied += len(chunk)
+            if copied > max_bytes:
+                break
+            upload.write(chunk)
+    if copied > max_bytes:
+        os.remove(path)
+        return abort(413)
+    return name
+
+
+def upload_path(job):
+    return os.path.join(upload_directory(current_app.config),
+                        job.payload['file'])
+
+
+def is_valid_import(payload):
+    name = payload.get('file')
+    return type(name) is str and UPLOAD_NAME_PATTERN.match(name) is not None
+
+
+def remove_upload(job):
+    try:
+        os.remove(upload_path(job))
+    except FileNotFoundError:
+        pass
+
+
+@job_kind('import_questions', is_valid_import, remove_upload)
+def run_import(job, progress):
+    '''
+    payload {"file": name of a file of stage_upload}, read and imported
+    like POST /questions/import does. A retry skips the rows committed
+    before. The file is removed once the job succeeded or failed
+    '''
+    done = job.progress_done
+    previous = job.result or {"imported": 0, "rejected": 0, "errors": []}
+    result = dict(previous)
+
+    def report(read, imported, rejected, errors):
+        result.update({
+            "imported": previous['imported'] + imported,
+            "rejected": previous['rejected'] + rejected,
+            "errors": (previous['errors'] + errors)[:BULK_MAX_REPORTED_ERRORS]
+        })
+        progress(done + read, None, result)
+
+    path = upload_path(job)
+    read_rows = read_csv_rows if path.endswith('.csv') else read_ndjson_rows
+    with open(path, 'rb') as upload:
+        import_questions(itertools.islice(read_rows(upload), done, None),
+                         progress=report)
+    return result
+
+
+def is_valid_delete(payload):
+    ids = payload.get('ids')
+    return type(ids) is list and \
+        all(type(question_id) is int for question_id in ids)
+
+
+@job_kind('delete_questions', is_valid_delete)
+def run_delete(job, progress):
+    '''
+    payload {"ids": [...]}, deleted BULK_BATCH_SIZE ids per transaction
+    '''
+    ids = job.payload['ids']
+    deleted = list((job.result or {}).get('deleted', []))
+    for start in range(job.progress_done, len(ids), BULK_BATCH_SIZE):
+        deleted.extend(record.id for record in Question.delete_all(
+            ids[start:start + BULK_BATCH_SIZE]))
+        progress(min(start + BULK_BATCH_SIZE, len(ids)), len(ids),
+                 {"deleted": deleted, "total_deleted": len(deleted)})
+    return {"deleted": sorted(deleted), "total_deleted": len(deleted)}
+
+
+def reset_other_processes():
+    '''
+    logs a reset of the questions, so that every other process drops the
+    state it derived from them, see changes.DataChanges
+    '''
+    mark_changed(db.session, 'questions')
+    db.session.commit()
+
+
+# the search index and the counts live in memory: these rebuild those of
+# the process running the job, and the others rebuild theirs on first use
+@job_kind('reindex_search')
+def run_reindex(job, progress):
+    search_index.load()
+    reset_other_processes()
+    return {"indexed": len(search_index)}
+
+
+@job_kind('reconcile_counts')
+def run_reconcile(job, progress):
+    question_counts.reconcile()
+    reset_other_processes()
+    return {"total_questions": question_counts.total()}
+
+
+'''
+init_jobs(app)
+    creates the JobQueue of the app from the JOB_* settings, keeping jobs in
+    the jobs table when JOB_STORE is 'database' and in memory otherwise, and
+    adds POST /jobs and GET /jobs/<id>
+'''
+
+
+def init_jobs(app):
+    store = None
+    if app.config.get('JOB_STORE') == 'database':
+        store = DatabaseJobStore()
+
+    jobs = JobQueue(
+        app, store,
+        workers=app.config.get('JOB_WORKERS', JOB_WORKERS),
+        max_attempts=app.config.get('JOB_MAX_ATTEMPTS', JOB_MAX_ATTEMPTS),
+        retry_delay=app.config.get('JOB_RETRY_DELAY', JOB_RETRY_DELAY),
+        lease_seconds=app.config.get('JOB_LEASE_SECONDS', JOB_LEASE_SECONDS),
+        poll_interval=app.config.get('JOB_POLL_INTERVAL', JOB_POLL_INTERVAL))
+
+    @app.route('/jobs', methods=['POST'])
+    def create_job():
+        body = request.get_json()
+        if not isinstance(body, dict):
+            return abort(422)
+        return job_accepted(jobs, body.get('kind'), body.get('payload'))
+
+    @app.route('/jobs/<int:job_id>', methods=['GET'])
+    def get_job(job_id):
+        job = jobs.get(job_id)
+        if job is None:
+            return abort(404)
+
+        return jsonify({
+            "success": True,
+            "job": job.format()
+        })
+
+    return jobs
+
+
+'''
+job_accepted(jobs, kind, payload)
+    enqueues a job and answers 202 with it and its status URL, or aborts
+    with 422 when the job is invalid
+'''
+
+
+def job_accepted(jobs, kind, payload):
+    try:
+        job = jobs.enqueue(kind, payload)
+    except ValueError:
+        return abort(422)
+
+    response = jsonify({
+        "success": True,
+        "job": job.format()
+    })
+    response.status_code = 202
+    response.headers['Location'] = '/jobs/{}'.format(job.id)
+    return response
+
+
+def main():
+    from flaskr import create_app
+
+    parser = argparse.ArgumentParser(
+        description='Runs the jobs of the jobs table.')
+    parser.add_argument('--workers', type=int, default=JOB_WORKERS,
+                        help='jobs run at once')
+    args = parser.parse_args()
+
+    app = create_app({
+        "DATABASE_PATH": os.environ.get('DATABASE_PATH', database_path),
+        "JOB_STORE": 'database',
+        "JOB_WORKERS": args.workers
+    })
+    jobs = app.extensions['trivia']['jobs']
+    jobs.start()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        jobs.stop()
+
+
+if __name__ == '__main__':
+    main()
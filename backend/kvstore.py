@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+'''
+LocalKeyValueStore
+    in-process stand-in for a shared key-value store such as Redis. It
+    implements the subset of the redis-py client API the backend relies on
+    (get, set with expiry, delete, incr, getrange), so a real client can be
+    passed anywhere this store is accepted. Values are stored as bytes and
+    expired keys are evicted lazily, oldest first once max_keys is reached
+'''
+
+
+class LocalKeyValueStore:
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+
+    def _expired(self, key, now):
+        _, expires_at = self._values[key]
+        return expires_at is not None and expires_at <= now
+
+    def _get(self, key):
+        if key not in self._values:
+            return None
+        if self._expired(key, time.monotonic()):
+            del self._values[key]
+            return None
+        return self._values[key][0]
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [key for key in self._values if self._expired(key, now)]:
+            del self._values[key]
+        while len(self._values) > self.max_keys:
+            self._values.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key, value, ex=None):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        elif isinstance(value, int):
+            value = str(value).encode('ascii')
+
+        with self._lock:
+            expires_at = time.monotonic() + ex if ex is not None else None
+            self._values.pop(key, None)
+            self._values[key] = (value, expires_at)
+            if len(self._values) > self.max_keys:
+                self._evict()
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            deleted = 0
+            for key in keys:
+                if self._get(key) is not None:
+                    del self._values[key]
+                    deleted += 1
+            return deleted
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            value = int(self._get(key) or 0) + amount
+            expires_at = self._values[key][1] if key in self._values else None
+            self._values[key] = (str(value).encode('ascii'), expires_at)
+            return value
+
+    def getrange(self, key, start, end):
+        with self._lock:
+            value = self._get(key) or b''
+            return value[start:end + 1 if end != -1 else None]
@@ -0,0 +1,200 @@
+import argparse
+import datetime
+import os
+from collections import namedtuple
+
+from sqlalchemy import create_engine, text
+
+from models import database_path, Job, DataChange
+
+# key of the advisory lock keeping two runs of the migrations apart
+MIGRATION_LOCK_KEY = 4857
+
+'''
+Migration
+    a versioned schema change. apply(connection) is called once, in order
+    of version, and the version is then recorded in schema_migrations. On
+    Postgres the connection is in autocommit mode so that indexes can be
+    built concurrently
+'''
+Migration = namedtuple('Migration', ['version', 'name', 'apply'])
+
+
+def drop_invalid_index(connection, name):
+    '''
+    drops what an interrupted CREATE INDEX CONCURRENTLY left behind: an
+    index that exists but is not valid, which IF NOT EXISTS would keep
+    '''
+    invalid = connection.execute(text(
+        'SELECT 1 FROM pg_index JOIN pg_class '
+        'ON pg_class.oid = pg_index.indexrelid '
+        'WHERE pg_class.relname = :name AND NOT pg_index.indisvalid'),
+        name=name).scalar()
+    if invalid:
+        connection.execute(text(
+            'DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name)))
+
+
+'''
+create_index(name, table, expression, using, postgresql_only)
+    returns a migration step building an index. Postgres builds it with
+    CREATE INDEX CONCURRENTLY, which keeps the table readable and writable
+    while it scans it. Other databases build it in place, unless it is
+    postgresql_only
+'''
+
+
+def create_index(name, table, expression, using='btree',
+                 postgresql_only=False):
+    def apply(connection):
+        if connection.dialect.name == 'postgresql':
+            drop_invalid_index(connection, name)
+            connection.execute(text(
+                'CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} '
+                'USING {} ({})'.format(name, table, using, expression)))
+        elif not postgresql_only:
+            connection.execute(text(
+                'CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                    name, table, expression)))
+    return apply
+
+
+def create_jobs_table(connection):
+    '''
+    the table of the background jobs run by jobs.JobQueue with
+    JOB_STORE = 'database'
+    '''
+    Job.__table__.create(connection, checkfirst=True)
+
+
+def create_data_changes_table(connection):
+    '''
+    the log of the changes to questions and categories read by
+    changes.DataChanges
+    '''
+    DataChange.__table__.create(connection, checkfirst=True)
+
+
+def convert_category_to_integer(connection):
+    '''
+    databases created by db.create_all() before Question.category became an
+    Integer hold the category as text, which integer comparisons cannot look
+    up through an index. trivia.psql already uses an integer, and SQLite
+    compares by column affinity, so both are left as they are. The change
+    rewrites the table under an exclusive lock
+    '''
+    if connection.dialect.name != 'postgresql':
+        return
+
+    data_type = connection.execute(text(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_name = 'questions' "
+        "AND column_name = 'category'")).scalar()
+    if data_type is not None and data_type != 'integer':
+        connection.execute(text(
+            "ALTER TABLE questions ALTER COLUMN category TYPE integer "
+            "USING NULLIF(category, '')::integer"))
+
+
+# spelled like PostgresSearchBackend.document() so that the planner matches
+# its queries to the index
+SEARCH_DOCUMENT = (
+    "setweight(to_tsvector('simple'::regconfig, coalesce(question, '')), "
+    "'A') || setweight(to_tsvector('simple'::regconfig, "
+    "coalesce(answer, '')), 'B')")
+
+MIGRATIONS = [
+    Migration(1, 'questions_category_integer', convert_category_to_integer),
+    # listings by category in id order, keyset pages and quiz draws
+    Migration(2, 'questions_category_id_index', create_index(
+        'questions_category_id_idx', 'questions', 'category, id')),
+    Migration(3, 'questions_difficulty_index', create_index(
+        'questions_difficulty_idx', 'questions', 'difficulty')),
+    Migration(4, 'questions_search_index', create_index(
+        'questions_search_idx', 'questions', '({})'.format(SEARCH_DOCUMENT),
+        using='gin', postgresql_only=True)),
+    Migration(5, 'jobs_table', create_jobs_table),
+    Migration(6, 'data_changes_table', create_data_changes_table),
+]
+
+
+def applied_versions(connection):
+    return set(version for version, in connection.execute(text(
+        'SELECT version FROM schema_migrations')))
+
+
+'''
+migrate(engine, target)
+    applies the migrations that are not recorded in schema_migrations yet,
+    up to the target version (all of them by default), and returns them.
+    Concurrent runs on Postgres wait for each other
+'''
+
+
+def migrate(engine, target=None):
+    applied = []
+    with engine.connect() as connection:
+        postgres = connection.dialect.name == 'postgresql'
+        if postgres:
+            connection = connection.execution_options(
+                isolation_level='AUTOCOMMIT')
+            connection.execute(text('SELECT pg_advisory_lock(:key)'),
+                               key=MIGRATION_LOCK_KEY)
+
+        try:
+            connection.execute(text(
+                'CREATE TABLE IF NOT EXISTS schema_migrations ('
+                'version integer PRIMARY KEY, '
+                'name varchar NOT NULL, '
+                'applied_at timestamp NOT NULL)'))
+            done = applied_versions(connection)
+
+            for migration in MIGRATIONS:
+                if migration.version in done or \
+                        (target is not None and migration.version > target):
+                    continue
+
+                migration.apply(connection)
+                connection.execute(text(
+                    'INSERT INTO schema_migrations '
+                    '(version, name, applied_at) '
+                    'VALUES (:version, :name, :applied_at)'),
+                    version=migration.version, name=migration.name,
+                    applied_at=datetime.datetime.utcnow())
+                applied.append(migration)
+        finally:
+            if postgres:
+                connection.execute(text('SELECT pg_advisory_unlock(:key)'),
+                                   key=MIGRATION_LOCK_KEY)
+
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Applies the pending schema migrations.')
+    parser.add_argument('--target', type=int,
+                        help='last version to apply, all by default')
+    parser.add_argument('--list', action='store_true',
+                        help='lists the migrations and whether they are '
+                        'applied, without applying any')
+    args = parser.parse_args()
+
+    engine = create_engine(os.environ.get('DATABASE_PATH', database_path))
+    if args.list:
+        with engine.connect() as connection:
+            has_table = engine.dialect.has_table(
+                connection, 'schema_migrations')
+            done = applied_versions(connection) if has_table else set()
+        for migration in MIGRATIONS:
+            print('{:>4} {:<32} {}'.format(
+                migration.version, migration.name,
+                'applied' if migration.version in done else 'pending'))
+        return
+
+    for migration in migrate(engine, args.target):
+        print('applied {} {}'.format(migration.version, migration.name))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,90 @@
-import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import datetime
+from collections import namedtuple
+from sqlalchemy import Column, String, Integer, Text, DateTime, Index, \
+    create_engine, event, select
+from sqlalchemy.orm import Session
 import json
 
+from db_pool import get_engine_options, warm_up_pool
+from replicas import RoutingSQLAlchemy
+from constants import BULK_BATCH_SIZE, DB_CREATE_ALL, DB_WARM_UP
+
 database_name = "trivia"
 database_user = "trivia_db_user"
 database_path = "postgres://{}@{}/{}".format(
     database_user, 'localhost:5432', database_name)
 
-db = SQLAlchemy()
+# reads go to a replica when init_replicas chose one for the request
+db = RoutingSQLAlchemy()
+
+'''
+question_listeners
+    callables notified as listener(action, questions) after question changes
+    are committed. action is one of 'insert', 'update', 'delete' or 'reset',
+    the latter meaning the database was rebound and any state derived from
+    it is stale
+'''
+question_listeners = []
+
+
+def notify_question_listeners(action, questions=()):
+    for listener in question_listeners:
+        listener(action, questions)
+
+
+'''
+category_listeners
+    callables notified without arguments after a transaction that added,
+    changed or removed categories is committed
+'''
+category_listeners = []
+
+
+def notify_category_listeners():
+    for listener in category_listeners:
+        listener()
+
+
+'''
+data_change_listeners
+    callables notified as listener(changes) after a transaction that
+    changed questions or categories is committed, with the (version, name)
+    of each change it appended to data_changes
+'''
+data_change_listeners = []
+
+
+'''
+QuestionRecord
+    detached copy of the columns of a question, handed to question_listeners
+    by bulk operations so that they do not reload expired instances
+'''
+QuestionRecord = namedtuple(
+    'QuestionRecord', ['id', 'question', 'answer', 'category', 'difficulty'])
+
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. The connection pool
+    is configured from the DB_* keys of the app config. The engine is
+    created on first use unless DB_CREATE_ALL creates the missing tables or
+    DB_WARM_UP opens connections up front
 '''
 
 
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = get_engine_options(
+        app.config, database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    if app.config.get('DB_CREATE_ALL', DB_CREATE_ALL):
+        db.create_all()
+    warm_up = app.config.get('DB_WARM_UP', DB_WARM_UP)
+    if warm_up:
+        warm_up_pool(db.get_engine(app), warm_up)
+    notify_question_listeners('reset')
 
 
 '''
@@ -36,7 +99,7 @@ class Question(db.Model):
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer)
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -48,13 +111,84 @@ class Question(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        notify_question_listeners('insert', [self])
+
+    @staticmethod
+    def insert_all(questions, batch_size=BULK_BATCH_SIZE):
+        '''
+        inserts the questions in a single transaction and returns their
+        records, in the same order. On Postgres every batch of questions is
+        inserted by one multi-row INSERT ... RETURNING statement, elsewhere
+        one row at a time
+        '''
+        table = Question.__table__
+        columns = [table.c.id, table.c.question, table.c.answer,
+                   table.c.category, table.c.difficulty]
+        rows = [{
+            "question": question.question,
+            "answer": question.answer,
+            "category": question.category,
+            "difficulty": question.difficulty
+        } for question in questions]
+        statement = table.insert()
+        bind = db.session.get_bind(Question.__mapper__, statement)
+        records = []
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            if bind.dialect.name == 'postgresql':
+                records.extend(QuestionRecord(*row) for row in
+                               db.session.execute(statement.values(
+                                   batch).returning(*columns)))
+            else:
+                records.extend(QuestionRecord(id=db.session.execute(
+                    statement, row).inserted_primary_key[0], **row)
+                    for row in batch)
+        mark_changed(db.session, 'questions', 'insert',
+                     [record.id for record in records])
+        db.session.commit()
+        notify_question_listeners('insert', records)
+        return records
 
     def update(self):
         db.session.commit()
+        notify_question_listeners('update', [self])
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+        notify_question_listeners('delete', [self])
+
+    @staticmethod
+    def delete_all(question_ids, batch_size=BULK_BATCH_SIZE):
+        '''
+        deletes the questions of the given ids, each id once, in a single
+        transaction and returns the records of the questions that existed.
+        On Postgres every batch of ids is deleted by one DELETE ... RETURNING
+        statement, elsewhere the batch is selected before it is deleted
+        '''
+        question_ids = list(dict.fromkeys(question_ids))
+        table = Question.__table__
+        columns = [table.c.id, table.c.question, table.c.answer,
+                   table.c.category, table.c.difficulty]
+        records = []
+        for start in range(0, len(question_ids), batch_size):
+            batch = question_ids[start:start + batch_size]
+            statement = table.delete().where(table.c.id.in_(batch))
+            bind = db.session.get_bind(Question.__mapper__, statement)
+            if bind.dialect.name == 'postgresql':
+                rows = db.session.execute(
+                    statement.returning(*columns)).fetchall()
+            else:
+                rows = db.session.execute(
+                    select(columns).where(table.c.id.in_(batch))).fetchall()
+                if rows:
+                    db.session.execute(statement)
+            records.extend(QuestionRecord(*row) for row in rows)
+        mark_changed(db.session, 'questions', 'delete',
+                     [record.id for record in records])
+        db.session.commit()
+        notify_question_listeners('delete', records)
+        return records
 
     def format(self):
         return {
@@ -86,3 +220,133 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
         }
+
+
+'''
+Job
+    a background job of jobs.JobQueue. payload and result are JSON. A job
+    is claimed when its status is queued or running and available_at has
+    passed: the time at which a failed attempt may be retried, or the lease
+    of the worker running it expires
+
+'''
+
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    # claimable jobs are looked up by status and available_at
+    __table_args__ = (
+        Index('jobs_status_available_at_idx', 'status', 'available_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    payload = Column(Text, nullable=False)
+    status = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    progress_done = Column(Integer, nullable=False, default=0)
+    progress_total = Column(Integer)
+    result = Column(Text)
+    error = Column(String)
+    created_at = Column(DateTime, nullable=False,
+                        default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False,
+                        default=datetime.datetime.utcnow)
+    available_at = Column(DateTime, nullable=False,
+                          default=datetime.datetime.utcnow)
+
+
+'''
+DataChange
+    a change to a question or a category, appended to data_changes by the
+    transaction of every change committed through the app, so that
+    processes find the changes committed by the others, see
+    changes.DataChanges. version comes from a sequence, record_id is the id
+    of the question or category, if any, and action is 'insert', 'update',
+    'delete' or 'reset', the latter meaning that every record may have
+    changed
+'''
+
+
+class DataChange(db.Model):
+    __tablename__ = 'data_changes'
+    # versions are never reused once the oldest changes are pruned
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    version = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    record_id = Column(Integer)
+    action = Column(String, nullable=False)
+
+
+def mark_changed(session, name, action='reset', record_ids=(None,)):
+    '''
+    records changes made by statements the session does not track, e.g.
+    bulk deletes, for log_data_changes
+    '''
+    changes = session.info.setdefault('changes', [])
+    changes.extend((name, record_id, action) for record_id in record_ids)
+
+
+'''
+Change tracking
+    records the question and category changes sessions flush, and appends
+    them to data_changes when the transaction commits. Appending only
+    inserts rows, numbered by a sequence, so that concurrent writers do not
+    wait on each other. category_listeners and data_change_listeners are
+    notified once the transaction is committed rather than when it flushes
+'''
+
+
+@event.listens_for(Session, 'after_flush')
+def track_changes(session, flush_context):
+    for action, instances in (('insert', session.new),
+                              ('update', session.dirty),
+                              ('delete', session.deleted)):
+        for instance in instances:
+            if isinstance(instance, Question):
+                mark_changed(session, 'questions', action, [instance.id])
+            elif isinstance(instance, Category):
+                mark_changed(session, 'categories', action, [instance.id])
+
+
+@event.listens_for(Session, 'before_commit')
+def log_data_changes(session):
+    session.flush()
+    changes = session.info.pop('changes', None)
+    if not changes:
+        return
+    session.info['committing'] = changes
+    table = DataChange.__table__
+    statement = table.insert()
+    bind = session.get_bind(DataChange.__mapper__, statement)
+    rows = [{"name": name, "record_id": record_id, "action": action}
+            for name, record_id, action in changes]
+    logged = []
+    for start in range(0, len(rows), BULK_BATCH_SIZE):
+        batch = rows[start:start + BULK_BATCH_SIZE]
+        if bind.dialect.name == 'postgresql':
+            logged.extend(session.execute(statement.values(batch).returning(
+                table.c.version, table.c.name)).fetchall())
+        else:
+            logged.extend((session.execute(
+                statement, row).inserted_primary_key[0], row['name'])
+                for row in batch)
+    session.info['logged'] = logged
+
+
+@event.listens_for(Session, 'after_commit')
+def notify_data_changes(session):
+    changes = session.info.pop('committing', ())
+    logged = session.info.pop('logged', None)
+    if any(name == 'categories' for name, _, _ in changes):
+        notify_category_listeners()
+    if logged:
+        for listener in data_change_listeners:
+            listener(logged)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes(session):
+    for key in ('changes', 'committing', 'logged'):
+        session.info.pop(key, None)
@@ -0,0 +1,271 @@
+import cProfile
+import hmac
+import io
+import marshal
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import abort, g, jsonify, request
+
+from constants import PROFILING_REQUESTS, PROFILING_SECONDS, \
+    PROFILING_SAMPLE_INTERVAL, PROFILING_STATS_LIMIT
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+PROFILING_ENDPOINTS = ('start_profiling', 'get_profiling', 'get_profile')
+
+
+'''
+collapse_stack(frame)
+    the stack ending at frame in the collapsed format of flame graph tools,
+    outermost call first
+'''
+
+
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(
+            code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+'''
+Profiler
+    profiles the requests of a session, started on demand for a number of
+    requests or seconds, whichever comes first. Every request of the
+    session runs under its own cProfile profile, merged into the call
+    statistics of the session, and a thread samples the stacks of the
+    requests in flight every sample_interval seconds for flame graphs.
+    Nothing is traced between sessions
+'''
+
+
+class Profiler:
+
+    def __init__(self, sample_interval=PROFILING_SAMPLE_INTERVAL):
+        self.sample_interval = sample_interval
+        self._lock = threading.Lock()
+        self._session = 0
+        self._threads = set()
+        self.active = False
+        self.max_requests = None
+        self.started_at = None
+        self.ends_at = None
+        self.stats = None
+        self.stacks = Counter()
+        self.requests = 0
+        self.untraced = 0
+        self.samples = 0
+
+    def start(self, max_requests, seconds):
+        with self._lock:
+            self._session += 1
+            self._threads = set()
+            self.active = True
+            self.max_requests = max_requests
+            self.started_at = time.time()
+            self.ends_at = time.monotonic() + seconds
+            self.stats = None
+            self.stacks = Counter()
+            self.requests = 0
+            self.untraced = 0
+            self.samples = 0
+            session = self._session
+        threading.Thread(target=self._sample, args=(session,),
+                         daemon=True).start()
+
+    def _expired(self):
+        return time.monotonic() >= self.ends_at or (
+            self.max_requests is not None and
+            self.requests >= self.max_requests)
+
+    def begin_request(self):
+        '''
+        returns the session and the enabled profile of the current request,
+        or None when no session is running
+        '''
+        with self._lock:
+            if not self.active:
+                return None
+            if self._expired():
+                self.active = False
+                return None
+            self._threads.add(threading.get_ident())
+            session = self._session
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ traces one profile at a time, the stacks of this
+            # request are still sampled
+            profile = None
+        return session, profile
+
+    def end_request(self, session, profile):
+        if profile is not None:
+            profile.disable()
+        with self._lock:
+            self._threads.discard(threading.get_ident())
+            if session != self._session:
+                return
+            self.requests += 1
+            if profile is None:
+                self.untraced += 1
+            elif self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            if self._expired():
+                self.active = False
+
+    def _sample(self, session):
+        while True:
+            time.sleep(self.sample_interval)
+            with self._lock:
+                if session != self._session or not self.active:
+                    return
+                if self._expired():
+                    self.active = False
+                    return
+                threads = set(self._threads)
+
+            frames = sys._current_frames()
+            stacks = [collapse_stack(frames[ident]) for ident in threads
+                      if ident in frames]
+            with self._lock:
+                if session != self._session:
+                    return
+                self.stacks.update(stacks)
+                self.samples += 1
+
+    def status(self):
+        with self._lock:
+            return {
+                "active": self.active and not self._expired(),
+                "started_at": self.started_at,
+                "max_requests": self.max_requests,
+                "requests": self.requests,
+                "untraced_requests": self.untraced,
+                "samples": self.samples
+            }
+
+    def call_stats(self, limit=PROFILING_STATS_LIMIT):
+        '''
+        the calls of the session taking the most cumulative time, as
+        printed by pstats, or None before any request was profiled
+        '''
+        with self._lock:
+            if self.stats is None:
+                return None
+            output = io.StringIO()
+            self.stats.stream = output
+            self.stats.sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+    def dump_stats(self):
+        '''
+        the call statistics of the session in the file format of
+        pstats.Stats.dump_stats, read by pstats and snakeviz
+        '''
+        with self._lock:
+            if self.stats is None:
+                return None
+            return marshal.dumps(self.stats.stats)
+
+    def collapsed_stacks(self):
+        with self._lock:
+            return ''.join('{} {}\n'.format(stack, count)
+                           for stack, count in sorted(self.stacks.items()))
+
+
+'''
+init_profiling(app)
+    profiles requests on demand through POST /profiling, GET /profiling and
+    GET /profiling/stats. These answer clients presenting PROFILING_TOKEN in
+    an X-Profiling-Token header, or when no token is set, local clients
+    only. The hooks are only registered by this call, so an app without
+    PROFILING does no profiling work at all
+'''
+
+
+def init_profiling(app, profiler=None):
+    profiler = profiler or Profiler(app.config.get(
+        'PROFILING_SAMPLE_INTERVAL', PROFILING_SAMPLE_INTERVAL))
+    token = app.config.get('PROFILING_TOKEN')
+
+    def authorize():
+        if token is not None:
+            allowed = hmac.compare_digest(
+                request.headers.get('X-Profiling-Token', ''), token)
+        else:
+            allowed = request.remote_addr in LOCAL_ADDRESSES
+        if not allowed:
+            # the routes are not disclosed
+            abort(404)
+
+    @app.before_request
+    def start_request_profile():
+        if profiler.active and request.endpoint not in PROFILING_ENDPOINTS:
+            profiling = profiler.begin_request()
+            if profiling is not None:
+                g.profiling = profiling
+
+    @app.teardown_request
+    def end_request_profile(error=None):
+        profiling = g.pop('profiling', None)
+        if profiling is not None:
+            profiler.end_request(*profiling)
+
+    @app.route('/profiling', methods=['POST'])
+    def start_profiling():
+        authorize()
+        body = request.get_json(silent=True) or {}
+        max_requests = body.get('requests', PROFILING_REQUESTS)
+        seconds = body.get('seconds', PROFILING_SECONDS)
+        if (max_requests is not None and type(max_requests) is not int) or \
+                type(seconds) not in (int, float) or seconds < 0:
+            return abort(422)
+
+        profiler.start(max_requests, seconds)
+        return jsonify({
+            "success": True,
+            "profiling": profiler.status()
+        })
+
+    @app.route('/profiling', methods=['GET'])
+    def get_profiling():
+        authorize()
+        return jsonify({
+            "success": True,
+            "profiling": profiler.status()
+        })
+
+    @app.route('/profiling/stats', methods=['GET'])
+    def get_profile():
+        authorize()
+        profile_format = request.args.get('format', 'text')
+        if profile_format == 'collapsed':
+            return app.response_class(profiler.collapsed_stacks(),
+                                      mimetype='text/plain')
+        if profile_format not in ('text', 'pstats'):
+            return abort(422)
+
+        if profile_format == 'pstats':
+            body = profiler.dump_stats()
+            mimetype = 'application/octet-stream'
+        else:
+            body = profiler.call_stats(app.config.get(
+                'PROFILING_STATS_LIMIT', PROFILING_STATS_LIMIT))
+            mimetype = 'text/plain'
+        if body is None:
+            return abort(404)
+        return app.response_class(body, mimetype=mimetype)
+
+    app.extensions['profiling'] = profiler
+    return profiler
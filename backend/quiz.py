@@ -0,0 +1,258 @@
+import random
+import threading
+
+from models import db, Question, question_listeners
+from replicas import primary_reads, reading_replica
+from constants import QUIZ_MIN_DIFFICULTY, QUIZ_MAX_DIFFICULTY, \
+    QUIZ_START_DIFFICULTY
+
+ALL_CATEGORIES = 0
+
+# random picks tried before falling back to scanning the remaining ids
+MAX_SAMPLE_ATTEMPTS = 8
+
+
+'''
+QuestionIdIndex
+    keeps every question id grouped by category, and by category and
+    difficulty, in memory, so that a quiz turn can draw a random question
+    without querying the questions table. The index is loaded lazily and
+    kept in sync through question_listeners, which changes.data_changes
+    also tells of the changes committed by other processes
+'''
+
+
+class QuestionIdIndex:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._ids = {}
+        self._positions = {}
+        self._keys = {}
+
+    def reset(self):
+        with self._lock:
+            self._loaded = False
+            self._ids = {}
+            self._positions = {}
+            self._keys = {}
+
+    def load(self):
+        with self._lock:
+            self.reset()
+            self._ids[ALL_CATEGORIES] = []
+            self._positions[ALL_CATEGORIES] = {}
+            with primary_reads():
+                rows = db.session.query(
+                    Question.id, Question.category, Question.difficulty).all()
+            for question_id, category, difficulty in rows:
+                self._add(question_id, category, difficulty)
+            self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def ensure_loaded(self):
+        with self._lock:
+            self._ensure_loaded()
+
+    def _add(self, question_id, category, difficulty=None):
+        if question_id in self._keys:
+            self._remove(question_id)
+
+        keys = [ALL_CATEGORIES]
+        category = int(category) if category is not None else None
+        if category is not None and category != ALL_CATEGORIES:
+            keys.append(category)
+        # buckets of the adaptive quiz, keyed by (category, difficulty)
+        if difficulty is not None:
+            keys.extend([(key, int(difficulty)) for key in keys])
+        self._keys[question_id] = keys
+
+        for key in keys:
+            ids = self._ids.setdefault(key, [])
+            self._positions.setdefault(key, {})[question_id] = len(ids)
+            ids.append(question_id)
+
+    def _remove(self, question_id):
+        if question_id not in self._keys:
+            return
+
+        # swap the last id into the freed slot to keep removal O(1)
+        for key in self._keys.pop(question_id):
+            ids = self._ids[key]
+            positions = self._positions[key]
+            position = positions.pop(question_id)
+            last_id = ids.pop()
+            if last_id != question_id:
+                ids[position] = last_id
+                positions[last_id] = position
+
+    def add(self, question_id, category, difficulty=None):
+        with self._lock:
+            if self._loaded:
+                self._add(question_id, category, difficulty)
+
+    def remove(self, question_id):
+        with self._lock:
+            if self._loaded:
+                self._remove(question_id)
+
+    @staticmethod
+    def _key(category_id, difficulty):
+        if difficulty is None:
+            return category_id
+        return (category_id, difficulty)
+
+    def count(self, category_id, difficulty=None):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._ids.get(self._key(category_id, difficulty), ()))
+
+    def ids(self, category_id, difficulty=None):
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._ids.get(self._key(category_id, difficulty), ()))
+
+    def contains(self, category_id, question_id, difficulty=None):
+        '''
+        whether the question of the given id is one of the category, of the
+        given difficulty if any
+        '''
+        with self._lock:
+            self._ensure_loaded()
+            return question_id in self._positions.get(
+                self._key(category_id, difficulty), ())
+
+    def choose(self, category_id, excluded=frozenset(), difficulty=None):
+        '''
+        picks a uniformly random id of the category, of the given difficulty
+        if any, that is not in excluded, or None once every such question has
+        been excluded
+        '''
+        with self._lock:
+            self._ensure_loaded()
+            ids = self._ids.get(self._key(category_id, difficulty))
+            if not ids:
+                return None
+
+            for _ in range(MAX_SAMPLE_ATTEMPTS):
+                question_id = ids[random.randrange(len(ids))]
+                if question_id not in excluded:
+                    return question_id
+
+            # most of the category has been played, draw from what is left
+            remaining = [question_id for question_id in ids
+                         if question_id not in excluded]
+            return random.choice(remaining) if remaining else None
+
+    def on_question_change(self, action, questions):
+        if action == 'reset':
+            self.reset()
+        elif action == 'delete':
+            for question in questions:
+                self.remove(question.id)
+        else:
+            for question in questions:
+                self.add(question.id, question.category, question.difficulty)
+
+
+question_index = QuestionIdIndex()
+question_listeners.append(question_index.on_question_change)
+
+
+'''
+draw_question(category_id, excluded, difficulty)
+    returns a random question of the category (ALL_CATEGORIES for any
+    category), of the given difficulty if any, whose id is not in the
+    excluded set, or None when none is left
+'''
+
+
+def draw_question(category_id, excluded, difficulty=None):
+    while True:
+        question_id = question_index.choose(category_id, excluded, difficulty)
+        if question_id is None:
+            return None
+
+        question = Question.query.get(question_id)
+        if question is not None:
+            return question
+
+        if reading_replica():
+            # maybe not replayed on the replica yet
+            excluded = set(excluded) | {question_id}
+        else:
+            # deleted behind our back, e.g. by another worker
+            question_index.remove(question_id)
+
+
+'''
+select_random_question(category_id, previous_questions, draw)
+    returns a random question of the category (ALL_CATEGORIES for any
+    category) that is not one of previous_questions, or None when none is
+    left. draw is draw_question or the draw of a decks.DeckStore
+'''
+
+
+def select_random_question(category_id, previous_questions=(),
+                           draw=draw_question):
+    return draw(category_id, set(previous_questions))
+
+
+'''
+next_target_difficulty(target, correct)
+    moves the target difficulty of an adaptive quiz one step up after a
+    correct answer and one step down after a wrong one, within
+    QUIZ_MIN_DIFFICULTY and QUIZ_MAX_DIFFICULTY. The first turn, without a
+    target, starts at QUIZ_START_DIFFICULTY
+'''
+
+
+def next_target_difficulty(target=None, correct=None):
+    if target is None:
+        return QUIZ_START_DIFFICULTY
+    if correct is not None:
+        target += 1 if correct else -1
+    return min(max(target, QUIZ_MIN_DIFFICULTY), QUIZ_MAX_DIFFICULTY)
+
+
+'''
+difficulty_band(target)
+    difficulties to draw from for a target, nearest first: the target, then
+    one step away, and so on. Bounded by the number of difficulties, so a
+    turn stays O(1)
+'''
+
+
+def difficulty_band(target):
+    band = [target]
+    for distance in range(1, QUIZ_MAX_DIFFICULTY - QUIZ_MIN_DIFFICULTY + 1):
+        band.extend(
+            difficulty for difficulty in (target - distance, target + distance)
+            if QUIZ_MIN_DIFFICULTY <= difficulty <= QUIZ_MAX_DIFFICULTY)
+    return band
+
+
+'''
+select_adaptive_question(category_id, previous_questions, target, draw)
+    returns a random question of the category that is not one of
+    previous_questions, of the target difficulty or, once those are played,
+    of the nearest difficulty left
+'''
+
+
+def select_adaptive_question(category_id, previous_questions, target,
+                             draw=draw_question):
+    excluded = set(previous_questions)
+    for difficulty in difficulty_band(target):
+        question = draw(category_id, excluded, difficulty)
+        if question is not None:
+            return question
+    return None
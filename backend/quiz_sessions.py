@@ -0,0 +1,186 @@
+import random
+import secrets
+import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from constants import QUIZ_SESSION_TTL, QUIZ_SESSION_LIMIT
+
+# rounds of the Feistel network shuffling the turns of a session
+PERMUTATION_ROUNDS = 4
+MASK_64 = (1 << 64) - 1
+
+# seed, lowest id, span of the ids and category of a session
+SESSION_STRUCT = struct.Struct('<QiIi')
+
+
+'''
+QuizSession
+    what a quiz session keeps instead of its shuffled question ids: the
+    seed of the permutation of its id span, from the lowest id of the
+    category to the highest, and the category. Turn n plays the id at
+    position permuted_position(seed, n, size) of the span
+'''
+QuizSession = namedtuple('QuizSession', 'seed low size category_id')
+
+
+'''
+new_quiz_session(category_id, question_ids)
+    returns the QuizSession of the category over the span of question_ids,
+    with a random seed
+'''
+
+
+def new_quiz_session(category_id, question_ids):
+    low = min(question_ids, default=0)
+    size = max(question_ids) - low + 1 if question_ids else 0
+    return QuizSession(random.getrandbits(64), low, size, category_id)
+
+
+def mix(value, key):
+    value = (value ^ key) * 0x9E3779B97F4A7C15 & MASK_64
+    return value ^ (value >> 29)
+
+
+'''
+permuted_position(seed, position, size)
+    maps a position below size to another one, a different one for every
+    position, shuffled by seed. A Feistel network permutes the smallest
+    even power of two above size, and positions it maps beyond size are
+    permuted again until they land below it, four times at most on average
+'''
+
+
+def permuted_position(seed, position, size):
+    half = max(1, ((size - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    value = position
+    while True:
+        left, right = value >> half, value & mask
+        for round_number in range(PERMUTATION_ROUNDS):
+            key = (seed + round_number * 0x632BE59BD9B4E019) & MASK_64
+            left, right = right, left ^ (mix(right, key) & mask)
+        value = (left << half) | right
+        if value < size:
+            return value
+
+
+'''
+session_turn(session, cursor)
+    returns (category id, question id) of the given turn of a QuizSession,
+    or None once every id of its span has been played. The ids of the span
+    include those of other categories and of deleted questions, which the
+    caller skips
+'''
+
+
+def session_turn(session, cursor):
+    if cursor >= session.size:
+        return None
+    return session.category_id, session.low + permuted_position(
+        session.seed, cursor, session.size)
+
+
+'''
+InMemorySessionStore
+    keeps quiz sessions of the current process. Each session is a
+    QuizSession and a cursor into it, so serving a turn is O(1) and a
+    session takes the same few bytes whatever the size of its category.
+    Sessions expire ttl seconds after they start and at most max_sessions
+    are kept, the oldest being evicted first
+'''
+
+
+class InMemorySessionStore:
+
+    def __init__(self, ttl=QUIZ_SESSION_TTL, max_sessions=QUIZ_SESSION_LIMIT):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+
+    def _evict(self):
+        # sessions share one ttl, so insertion order is expiry order
+        now = time.monotonic()
+        while self._sessions:
+            session_id, (_, _, expires_at) = next(iter(self._sessions.items()))
+            if expires_at > now and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+
+    def create(self, category_id, question_ids):
+        session_id = secrets.token_urlsafe(16)
+        with self._lock:
+            self._sessions[session_id] = [
+                new_quiz_session(category_id, question_ids), 0,
+                time.monotonic() + self.ttl]
+            self._evict()
+        return session_id
+
+    def next_turn(self, session_id):
+        '''
+        returns the category and the next question id of the session, see
+        session_turn, None once the session is exhausted. Raises KeyError
+        for an unknown or expired session
+        '''
+        with self._lock:
+            self._evict()
+            session = self._sessions[session_id]
+            quiz_session, cursor, _ = session
+            if cursor >= quiz_session.size:
+                return None
+            session[1] = cursor + 1
+        return session_turn(quiz_session, cursor)
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self):
+        with self._lock:
+            self._evict()
+            return len(self._sessions)
+
+
+'''
+KeyValueSessionStore
+    keeps quiz sessions in a key-value store shared by all workers, e.g. a
+    redis client or kvstore.LocalKeyValueStore. The QuizSession is stored
+    once as packed bytes and the cursor is an atomic counter, so a turn
+    reads a few bytes whatever the size of the category
+'''
+
+
+class KeyValueSessionStore:
+
+    def __init__(self, client, ttl=QUIZ_SESSION_TTL, prefix='quiz_session:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _keys(self, session_id):
+        return (self.prefix + session_id + ':session',
+                self.prefix + session_id + ':cursor')
+
+    def create(self, category_id, question_ids):
+        session_id = secrets.token_urlsafe(16)
+        session_key, cursor_key = self._keys(session_id)
+        self.client.set(session_key, SESSION_STRUCT.pack(
+            *new_quiz_session(category_id, question_ids)), ex=self.ttl)
+        self.client.set(cursor_key, 0, ex=self.ttl)
+        return session_id
+
+    def next_turn(self, session_id):
+        session_key, cursor_key = self._keys(session_id)
+        cursor = self.client.incr(cursor_key) - 1
+        raw = self.client.get(session_key)
+        if raw is None:
+            # drop the counter incr created for an unknown session
+            self.client.delete(cursor_key)
+            raise KeyError(session_id)
+        return session_turn(
+            QuizSession(*SESSION_STRUCT.unpack(raw)), cursor)
+
+    def delete(self, session_id):
+        return self.client.delete(*self._keys(session_id)) > 0
@@ -0,0 +1,235 @@
+import contextlib
+import itertools
+import threading
+import time
+
+from flask import g, has_app_context, jsonify, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, exc, orm, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.expression import UpdateBase
+
+from db_pool import get_engine_options, get_pool_stats
+from constants import REPLICA_RETRY_INTERVAL, REPLICA_PIN_SECONDS, \
+    REPLICA_PIN_COOKIE
+
+
+'''
+Replica
+    engine of one read replica and its health. A replica is checked with
+    SELECT 1 before its first use and, once it failed, again after
+    retry_interval seconds; until then reads go to the other replicas
+'''
+
+
+class Replica:
+
+    def __init__(self, database_path, engine, retry_interval):
+        self.database_path = database_path
+        self.engine = engine
+        self.retry_interval = retry_interval
+        self.healthy = None
+        self.retry_at = 0.0
+        self.reads = 0
+        self.failures = 0
+        event.listen(engine, 'handle_error', self.on_error)
+
+    def check(self):
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except exc.DBAPIError:
+            self.mark_down()
+            return False
+        self.healthy = True
+        return True
+
+    def mark_down(self):
+        self.healthy = False
+        self.failures += 1
+        self.retry_at = time.monotonic() + self.retry_interval
+
+    def on_error(self, context):
+        # connections that could not be opened or were lost, not failing
+        # statements
+        if context.is_disconnect or context.connection is None:
+            self.mark_down()
+
+    def available(self):
+        if self.healthy:
+            return True
+        if self.healthy is False and time.monotonic() < self.retry_at:
+            return False
+        return self.check()
+
+    def stats(self):
+        return {
+            "database": repr(make_url(self.database_path)),
+            "healthy": self.healthy,
+            "reads": self.reads,
+            "failures": self.failures,
+            "pool": get_pool_stats(self.engine.pool)
+        }
+
+
+'''
+ReplicaSet
+    read replicas used in turn. choose() returns the next available
+    replica, or None when every replica is down and reads fall back to the
+    primary
+'''
+
+
+class ReplicaSet:
+
+    def __init__(self, database_paths, config):
+        retry_interval = config.get(
+            'REPLICA_RETRY_INTERVAL', REPLICA_RETRY_INTERVAL)
+        self.replicas = [Replica(
+            database_path,
+            create_engine(database_path,
+                          **get_engine_options(config, database_path)),
+            retry_interval) for database_path in database_paths]
+        self._turns = itertools.count()
+        self._lock = threading.Lock()
+
+    def choose(self):
+        start = next(self._turns)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if replica.available():
+                with self._lock:
+                    replica.reads += 1
+                return replica
+        return None
+
+    def stats(self):
+        return [replica.stats() for replica in self.replicas]
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+
+'''
+RoutingSession
+    session of a request reading from the replica chosen for it, if any.
+    Flushes and INSERT/UPDATE/DELETE statements go to the primary, and the
+    rest of the session stays there so that it reads what it wrote
+'''
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.app.extensions.get('replicas') is not None:
+            if self._flushing or isinstance(clause, UpdateBase):
+                self.info['primary'] = self.info['wrote'] = True
+            elif not self.info.get('primary') and has_app_context() and \
+                    g.get('read_replica') is not None:
+                return g.read_replica.engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def track_primary_writes(session):
+    if session.info.pop('wrote', False) and has_app_context():
+        g.wrote_primary = True
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def discard_primary_writes(session):
+    session.info.pop('wrote', None)
+
+
+'''
+primary_reads()
+    sends the reads of the block to the primary, whichever replica the
+    request reads from. For state kept beyond the request, e.g. indexes,
+    counts, decks and caches, which would otherwise keep what a lagging
+    replica returned
+'''
+
+
+@contextlib.contextmanager
+def primary_reads():
+    replica = g.pop('read_replica', None) if has_app_context() else None
+    try:
+        yield
+    finally:
+        if replica is not None:
+            g.read_replica = replica
+
+
+'''
+reading_replica()
+    whether the reads of the current request go to a replica
+'''
+
+
+def reading_replica():
+    return has_app_context() and g.get('read_replica') is not None
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+'''
+pinned_to_primary(request)
+    whether the client wrote less than REPLICA_PIN_SECONDS ago, as told by
+    the cookie set on its write, so that it reads its writes even from
+    replicas that lag behind
+'''
+
+
+def pinned_to_primary(request):
+    try:
+        return float(request.cookies.get(REPLICA_PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+'''
+init_replicas(app, read_endpoints)
+    routes the reads of GET and HEAD requests and of the read_endpoints to
+    the REPLICA_DATABASE_PATHS of the app config in turn, skipping replicas
+    that are down, and reports them at /health/replicas. Returns the
+    ReplicaSet, or None when no replica is configured
+'''
+
+
+def init_replicas(app, read_endpoints=()):
+    database_paths = app.config.get('REPLICA_DATABASE_PATHS')
+    if not database_paths:
+        return None
+
+    replicas = ReplicaSet(database_paths, app.config)
+    app.extensions['replicas'] = replicas
+    pin_seconds = app.config.get('REPLICA_PIN_SECONDS', REPLICA_PIN_SECONDS)
+
+    @app.before_request
+    def route_reads():
+        reads_only = request.method in ('GET', 'HEAD') or \
+            request.endpoint in read_endpoints
+        if reads_only and not pinned_to_primary(request):
+            g.read_replica = replicas.choose()
+
+    @app.after_request
+    def pin_writes(response):
+        if g.get('wrote_primary'):
+            response.set_cookie(REPLICA_PIN_COOKIE,
+                                '{:.3f}'.format(time.time() + pin_seconds),
+                                max_age=pin_seconds, httponly=True)
+        return response
+
+    @app.route('/health/replicas', methods=['GET'])
+    def get_replica_health():
+        return jsonify({
+            "success": True,
+            "replicas": replicas.stats()
+        })
+
+    return replicas
@@ -0,0 +1,263 @@
+import bisect
+import heapq
+import re
+import threading
+from collections import defaultdict
+
+from sqlalchemy import func, literal_column
+
+from models import db, Question, question_listeners
+from replicas import primary_reads
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+# term matches in the question rank above matches in the answer, and whole
+# word matches above prefix matches
+QUESTION_WEIGHT = 2
+ANSWER_WEIGHT = 1
+EXACT_MATCH_BOOST = 2
+
+
+'''
+tokenize(text)
+    splits text into lower case word tokens
+'''
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+'''
+InvertedIndex
+    in-process full-text index over the question and answer of every
+    question. Each token maps to the ids of the questions containing it with
+    a weight, and the sorted token list serves prefix lookups by bisection.
+    The index is loaded lazily and kept in sync through question_listeners,
+    which changes.data_changes also tells of the questions changed by other
+    processes
+'''
+
+
+class InvertedIndex:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # held while the index is rebuilt, outside of _lock
+        self._loading = threading.Lock()
+        self._loaded = False
+        self._built = False
+        self._postings = {}
+        self._tokens = []
+        self._documents = {}
+        # changes notified while the index is rebuilt, replayed onto it
+        self._changes = None
+
+    def __len__(self):
+        '''
+        number of indexed questions
+        '''
+        with self._lock:
+            return len(self._documents)
+
+    def reset(self):
+        '''
+        marks the index stale. Searches keep using it while the next one
+        rebuilds it
+        '''
+        with self._lock:
+            self._loaded = False
+
+    def load(self):
+        '''
+        rebuilds the index from the database
+        '''
+        with self._loading:
+            self._build()
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        # only the first build is waited for, later searches use the stale
+        # index while another thread rebuilds it
+        if self._loading.acquire(blocking=not self._built):
+            try:
+                if not self._loaded:
+                    self._build()
+            finally:
+                self._loading.release()
+
+    def _build(self):
+        with self._lock:
+            self._changes = []
+        try:
+            postings = defaultdict(dict)
+            documents = {}
+            with primary_reads():
+                rows = db.session.query(
+                    Question.id, Question.question,
+                    Question.answer).yield_per(1000)
+                for question_id, question, answer in rows:
+                    weights = self._weights(question, answer)
+                    documents[question_id] = list(weights)
+                    for token, weight in weights.items():
+                        postings[token][question_id] = weight
+            tokens = sorted(postings)
+        except Exception:
+            with self._lock:
+                self._changes = None
+            raise
+
+        with self._lock:
+            changes, self._changes = self._changes, None
+            self._postings = dict(postings)
+            self._tokens = tokens
+            self._documents = documents
+            self._loaded = self._built = True
+            for question_id, document in changes:
+                if document is None:
+                    self._remove(question_id)
+                else:
+                    self._add(question_id, *document)
+
+    def _weights(self, question, answer):
+        weights = defaultdict(int)
+        for token in tokenize(question):
+            weights[token] += QUESTION_WEIGHT
+        for token in tokenize(answer):
+            weights[token] += ANSWER_WEIGHT
+        return weights
+
+    def _add(self, question_id, question, answer):
+        self._remove(question_id)
+        weights = self._weights(question, answer)
+        self._documents[question_id] = list(weights)
+        for token, weight in weights.items():
+            if token not in self._postings:
+                self._postings[token] = {}
+                bisect.insort(self._tokens, token)
+            self._postings[token][question_id] = weight
+
+    def _remove(self, question_id):
+        for token in self._documents.pop(question_id, ()):
+            postings = self._postings[token]
+            postings.pop(question_id, None)
+            if not postings:
+                del self._postings[token]
+                del self._tokens[bisect.bisect_left(self._tokens, token)]
+
+    def add(self, question_id, question, answer):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((question_id, (question, answer)))
+            if self._built:
+                self._add(question_id, question, answer)
+
+    def remove(self, question_id):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((question_id, None))
+            if self._built:
+                self._remove(question_id)
+
+    def _matches(self, term):
+        scores = defaultdict(int)
+        position = bisect.bisect_left(self._tokens, term)
+        while position < len(self._tokens) and \
+                self._tokens[position].startswith(term):
+            token = self._tokens[position]
+            boost = EXACT_MATCH_BOOST if token == term else 1
+            for question_id, weight in self._postings[token].items():
+                scores[question_id] += weight * boost
+            position += 1
+        return scores
+
+    def search(self, terms, offset, limit):
+        '''
+        returns the ids of the questions matching every term, as a word or
+        a word prefix, ranked by score, along with the number of matches
+        '''
+        self._ensure_loaded()
+        with self._lock:
+            scores = None
+            for term in terms:
+                matches = self._matches(term)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {question_id: score + matches[question_id]
+                              for question_id, score in scores.items()
+                              if question_id in matches}
+                if not scores:
+                    return [], 0
+
+        # only the ranks up to the requested page need to be ordered
+        ranked = heapq.nsmallest(
+            offset + limit, scores,
+            key=lambda question_id: (-scores[question_id], question_id))
+        return ranked[offset:], len(scores)
+
+    def on_question_change(self, action, questions):
+        if action == 'reset':
+            self.reset()
+        elif action == 'delete':
+            for question in questions:
+                self.remove(question.id)
+        else:
+            for question in questions:
+                self.add(question.id, question.question, question.answer)
+
+
+search_index = InvertedIndex()
+question_listeners.append(search_index.on_question_change)
+
+
+'''
+PostgresSearchBackend
+    full-text search run by Postgres over a tsvector of the question and
+    answer, served by the GIN index the migrations create on the same
+    expression. Questions are weighted above answers when ranking
+'''
+
+
+class PostgresSearchBackend:
+
+    # spelled like the index expression so that the planner matches it
+    config = literal_column("'simple'::regconfig")
+
+    def document(self):
+        question = func.to_tsvector(
+            self.config, func.coalesce(Question.question, ''))
+        answer = func.to_tsvector(
+            self.config, func.coalesce(Question.answer, ''))
+        return func.setweight(question, 'A').op('||')(
+            func.setweight(answer, 'B'))
+
+    def search(self, terms, offset, limit):
+        document = self.document()
+        query = func.to_tsquery(self.config, ' & '.join(
+            term + ':*' for term in terms))
+        matches = db.session.query(Question.id).filter(
+            document.op('@@')(query))
+
+        total = matches.with_entities(func.count(Question.id)).scalar()
+        if total == 0 or offset >= total:
+            return [], total
+
+        rank = func.ts_rank(document, query)
+        rows = matches.order_by(rank.desc(), Question.id).offset(
+            offset).limit(limit).all()
+        return [question_id for question_id, in rows], total
+
+
+'''
+search_question_ids(search_term, offset, limit, backend)
+    returns the ids of a page of questions matching search_term and the total
+    number of matches. Terms match whole words or word prefixes of either the
+    question or the answer, and every term has to match
+'''
+
+
+def search_question_ids(search_term, offset, limit, backend=search_index):
+    terms = tokenize(search_term)
+    return backend.search(terms, offset, limit)
@@ -0,0 +1,93 @@
+import json
+
+from flask import current_app, jsonify
+
+from models import Question, Category
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer,
+                    Question.category, Question.difficulty)
+QUESTION_KEYS = ('id', 'question', 'answer', 'category', 'difficulty')
+CATEGORY_COLUMNS = (Category.id, Category.type)
+CATEGORY_KEYS = ('id', 'type')
+
+
+'''
+format_question_row(row) / format_category_row(row)
+    build the same dicts as Question.format() and Category.format() from
+    rows of QUESTION_COLUMNS and CATEGORY_COLUMNS, which skip the ORM
+    identity map and attribute instrumentation
+'''
+
+
+def format_question_row(row):
+    return dict(zip(QUESTION_KEYS, row))
+
+
+def format_category_row(row):
+    return dict(zip(CATEGORY_KEYS, row))
+
+
+'''
+JSON encoders
+    return the body jsonify produces for a payload (sorted keys, no spaces,
+    non-ASCII characters escaped, trailing newline) as bytes. orjson output
+    holding non-ASCII characters or types it does not know is re-encoded by
+    the standard library so that the bytes stay the same
+'''
+
+
+def dumps_stdlib(payload):
+    return (json.dumps(payload, sort_keys=True, separators=(',', ':')) +
+            '\n').encode('utf-8')
+
+
+def dumps_orjson(payload):
+    try:
+        body = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS |
+                            orjson.OPT_APPEND_NEWLINE)
+    except TypeError:
+        return dumps_stdlib(payload)
+    return body if body.isascii() else dumps_stdlib(payload)
+
+
+encoders = {'json': dumps_stdlib}
+if orjson is not None:
+    encoders['orjson'] = dumps_orjson
+
+
+'''
+get_encoder(name)
+    returns the encoder of the given name, 'auto' picking the fastest one
+    installed. Unknown or missing encoders fall back to the standard library
+'''
+
+
+def get_encoder(name='auto'):
+    if name == 'auto':
+        name = 'orjson' if 'orjson' in encoders else 'json'
+    return encoders.get(name, dumps_stdlib)
+
+
+'''
+json_response(payload, status)
+    builds a JSON response with the encoder named by the SERIALIZER setting
+    of the current app. In debug mode jsonify is used to keep its pretty
+    printing
+'''
+
+
+def json_response(payload, status=200):
+    app = current_app
+    if app.debug or app.config['JSONIFY_PRETTYPRINT_REGULAR']:
+        response = jsonify(payload)
+        response.status_code = status
+        return response
+
+    encode = get_encoder(app.config.get('SERIALIZER', 'auto'))
+    return app.response_class(encode(payload), status=status,
+                              mimetype=app.config['JSONIFY_MIMETYPE'])
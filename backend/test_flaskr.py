@@ -1,24 +1,70 @@
+import csv
+import gzip
+import io
+import marshal
 import os
+import tempfile
+import threading
+import time
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from flask import Response, g, jsonify
+from sqlalchemy import and_, create_engine, event, exc, func, inspect, \
+    select
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import ServiceUnavailable
 
 from flaskr import create_app
-from models import setup_db, Question, Category
-from constants import QUESTIONS_PER_PAGE, MESSAGE_NOT_FOUND, MESSAGE_UNPROCESSABLE
+from flaskr.asgi import TriviaASGI
+from models import db, setup_db, notify_question_listeners, \
+    notify_category_listeners, Question, Category, Job, DataChange
+from changes import data_changes
+from counts import question_counts
+from search import search_index
+from quiz import ALL_CATEGORIES, question_index
+from decks import Deck, DeckStore, build_deck
+from kvstore import LocalKeyValueStore
+from admission import AdmissionControl
+from group_commit import GroupCommitWriter
+from jobs import FAILED, QUEUED, SUCCEEDED, job_kinds, job_kind, \
+    stage_upload
+from cache import KeyValueCache, LRUCache
+from serializers import encoders, json_response
+from migrations import MIGRATIONS, applied_versions, migrate
+from db_pool import InstrumentedQueuePool, get_engine_options, get_pool_stats
+from quiz_sessions import InMemorySessionStore, KeyValueSessionStore, \
+    permuted_position
+from benchmarks.results import percentile
+from constants import QUESTIONS_PER_PAGE, MESSAGE_NOT_FOUND, \
+    MESSAGE_UNPROCESSABLE, MESSAGE_TOO_LARGE, MESSAGE_TOO_MANY_REQUESTS, \
+    MESSAGE_SERVICE_UNAVAILABLE, DATA_CHANGES_HOLE_TIMEOUT
 
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
+    # run each test in a transaction rolled back afterwards, instead of
+    # committing its writes
+    rollback = True
+
+    @classmethod
+    def setUpClass(cls):
+        """Define the database and create the app shared by the tests."""
+        cls.database_name = "trivia_test"
+        cls.database_path = "postgres://{}/{}".format(
+            'localhost:5432', cls.database_name)
+        # the schema comes from trivia.psql
+        cls.app = create_app({"DATABASE_PATH": cls.database_path,
+                              "DB_CREATE_ALL": False})
+        with cls.app.app_context():
+            cls.engine = db.get_engine(cls.app)
+
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
+        """Define test variables and begin the transaction of the test."""
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgres://{}/{}".format(
-            'localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
+        # reads outside a request go through the shared app rather than the
+        # last app a test created
+        db.app = self.app
 
         self.new_question = {
             "question": 'Which planet has a moon named Phobos?',
@@ -27,16 +73,455 @@ class TriviaTestCase(unittest.TestCase):
             "category": 1
         }
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+        if self.rollback:
+            # every session joins the transaction, commits included
+            self.connection = self.engine.connect()
+            self.transaction = self.connection.begin()
+            self.session = db.session
+            db.session = db.create_scoped_session(
+                {"bind": self.connection, "binds": {}})
 
     def tearDown(self):
-        """Executed after reach test"""
-        pass
+        """Roll back the transaction of the test."""
+        if self.rollback:
+            db.session.remove()
+            db.session = self.session
+            self.transaction.rollback()
+            self.connection.close()
+            # drop what the in-memory indexes, counts and caches kept of the
+            # rolled back writes
+            notify_question_listeners('reset')
+            notify_category_listeners()
+            data_changes.reset()
+
+    """
+      Migrations
+    """
+
+    def test_migrations_applied_once(self):
+        engine = create_engine(self.database_path)
+        migrate(engine)
+
+        self.assertEqual(migrate(engine), [])
+        with engine.connect() as connection:
+            self.assertEqual(
+                applied_versions(connection),
+                set(migration.version for migration in MIGRATIONS))
+        index_names = [index['name'] for index in
+                       inspect(engine).get_indexes('questions')]
+        self.assertIn('questions_category_id_idx', index_names)
+        self.assertIn('questions_difficulty_idx', index_names)
+        engine.dispose()
+
+    """
+      Endpoint: GET /health/pool
+    """
+
+    def test_get_pool_health_success(self):
+        response = self.client().get('/health/pool')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['pool']['class'])
+
+    def test_engine_options_from_config(self):
+        options = get_engine_options({
+            "DB_POOL_SIZE": 20,
+            "DB_MAX_OVERFLOW": 0,
+            "DB_POOL_PRE_PING": True,
+            "DB_STATEMENT_TIMEOUT": 5000
+        }, 'postgres://localhost:5432/trivia')
+
+        self.assertEqual(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertEqual(options['pool_pre_ping'], True)
+        self.assertEqual(options['connect_args'],
+                         {"options": "-c statement_timeout=5000"})
+
+    def test_pool_stats_record_checkouts_and_timeouts(self):
+        engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.01)
+        connection = engine.connect()
+        with self.assertRaises(exc.TimeoutError):
+            engine.connect()
+
+        stats = get_pool_stats(engine.pool)
+        connection.close()
+
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['wait_time_max'], 0.01)
+
+    """
+      Read replicas
+    """
+
+    def create_replica_app(self, replica_paths):
+        return create_app({"DATABASE_PATH": self.database_path,
+                           "REPLICA_DATABASE_PATHS": replica_paths})
+
+    def test_reads_success_round_robin_replicas(self):
+        app = self.create_replica_app([self.database_path, self.database_path])
+        client = app.test_client()
+
+        for path in ['/questions', '/categories', '/categories/1/questions']:
+            self.assertEqual(client.get(path).status_code, 200)
+        response = client.post('/quizzes', json={"quiz_category": {"id": 0}})
+        replicas = json.loads(client.get('/health/replicas').data)['replicas']
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([replica['reads'] for replica in replicas], [3, 2])
+        self.assertTrue(all(replica['healthy'] for replica in replicas))
+
+    def test_reads_success_replica_down(self):
+        app = self.create_replica_app(['sqlite:////nonexistent/replica.db',
+                                       self.database_path])
+        client = app.test_client()
+
+        for _ in range(2):
+            self.assertEqual(client.get('/questions').status_code, 200)
+        down, replica = app.extensions['replicas'].stats()
+
+        self.assertEqual(down['healthy'], False)
+        self.assertEqual(down['reads'], 0)
+        self.assertEqual(replica['reads'], 2)
+
+    def test_reads_success_every_replica_down(self):
+        app = self.create_replica_app(['sqlite:////nonexistent/replica.db'])
+        response = app.test_client().get('/questions')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(app.extensions['replicas'].stats()[0]['reads'], 0)
+
+    def test_reads_success_own_writes_from_primary(self):
+        app = self.create_replica_app([self.database_path])
+        replica = app.extensions['replicas'].replicas[0]
+        client = app.test_client()
+
+        response = client.post('/questions', json=self.new_question)
+        question_id = json.loads(response.data)['created']['id']
+        self.assertIn('trivia_primary_until=', response.headers['Set-Cookie'])
+        client.get('/questions')
+        reads_after_write = replica.reads
+        app.test_client().get('/questions')
+        response = client.delete('/questions/{}'.format(question_id))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(reads_after_write, 0)
+        self.assertEqual(replica.reads, 1)
+
+    def create_lagging_replica(self):
+        '''
+        a SQLite replica of the categories and questions that did not
+        replay the insert of the last question yet
+        '''
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        replica_path = 'sqlite:///{}'.format(
+            os.path.join(directory.name, 'replica.db'))
+        replica = create_engine(replica_path)
+        self.addCleanup(replica.dispose)
+        questions = Question.__table__
+        data_changes_table = DataChange.__table__
+        db.metadata.create_all(replica, tables=[
+            Category.__table__, questions, data_changes_table])
+
+        categories = [dict(row) for row in db.session.execute(
+            Category.__table__.select())]
+        rows = [dict(row) for row in db.session.execute(
+            questions.select().order_by(questions.c.id))]
+        changes = [dict(row) for row in db.session.execute(
+            data_changes_table.select())]
+        with replica.begin() as connection:
+            connection.execute(Category.__table__.insert(), categories)
+            connection.execute(questions.insert(), rows[:-1])
+            if changes:
+                connection.execute(data_changes_table.insert(), changes)
+        return replica_path, replica, rows[-1]
+
+    def test_reads_success_lagging_replica(self):
+        replica_path, replica, missing = self.create_lagging_replica()
+        client = self.create_replica_app([replica_path]).test_client()
+        question_counts.reset()
+        total = Question.query.count()
+        previous_questions = [question.id for question in Question.query
+                              if question.id != missing['id']]
+        # the next session is one of the replica app
+        db.session.remove()
+
+        response = client.get('/questions')
+        etag = response.headers['ETag']
+        not_modified = client.get(
+            '/questions', headers={"If-None-Match": etag})
+        quiz = client.post('/quizzes', json={
+            "quiz_category": {"id": 0},
+            "previous_questions": previous_questions})
+        # the replica catches up
+        with replica.begin() as connection:
+            connection.execute(Question.__table__.insert(), missing)
+            connection.execute(DataChange.__table__.insert(), {
+                "name": 'questions', "record_id": missing['id'],
+                "action": 'insert'})
+        caught_up = client.get('/questions', headers={"If-None-Match": etag})
+
+        self.assertEqual(json.loads(response.data)['total_questions'], total)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(json.loads(quiz.data)['question'], None)
+        self.assertEqual(question_index.count(ALL_CATEGORIES), total)
+        self.assertEqual(caught_up.status_code, 200)
+        self.assertNotEqual(caught_up.headers['ETag'], etag)
+
+    def test_get_replica_health_error_not_enabled(self):
+        response = self.client().get('/health/replicas')
+
+        self.assertEqual(response.status_code, 404)
+
+    """
+      Admission control
+    """
+
+    def test_get_guesses_error_rate_limited(self):
+        for store in [None, LocalKeyValueStore()]:
+            app = create_app({"DATABASE_PATH": self.database_path,
+                              "RATE_LIMITS": {"get_guesses": (1, 2)},
+                              "RATE_LIMIT_STORE": store})
+            client = app.test_client()
+            quiz = {"quiz_category": {"id": 0}}
+
+            statuses = [client.post('/quizzes', json=quiz).status_code
+                        for _ in range(3)]
+            response = client.post('/quizzes', json=quiz)
+            data = json.loads(response.data)
+            other_client = client.post('/quizzes', json=quiz, environ_base={
+                "REMOTE_ADDR": '10.0.0.2'})
+
+            self.assertEqual(statuses, [200, 200, 429])
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message'], MESSAGE_TOO_MANY_REQUESTS)
+            self.assertEqual(other_client.status_code, 200)
+
+    def test_search_questions_error_rate_limited(self):
+        app = create_app({"DATABASE_PATH": self.database_path,
+                          "RATE_LIMITS": {"search_questions": (1, 1)}})
+        client = app.test_client()
+
+        searched = client.post('/questions', json={"search_term": 'title'})
+        limited = client.post('/questions', json={"search_term": 'title'})
+        created = client.post('/questions', json=self.new_question)
+        client.delete('/questions/{}'.format(
+            json.loads(created.data)['created']['id']))
+        stats = json.loads(client.get('/health/admission').data)
+
+        self.assertEqual(searched.status_code, 200)
+        self.assertEqual(limited.status_code, 429)
+        self.assertEqual(created.status_code, 200)
+        self.assertEqual(stats['rejected'], {"search_questions": 1})
+
+    def test_search_questions_error_shed(self):
+        app = create_app({"DATABASE_PATH": self.database_path,
+                          "CONCURRENCY_LIMITS": {"search_questions": 0}})
+        response = app.test_client().post(
+            '/questions', json={"search_term": 'title'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], MESSAGE_SERVICE_UNAVAILABLE)
+
+    def test_admission_control_concurrency_limit(self):
+        admission = AdmissionControl(concurrency_limits={"search": 1})
+
+        with self.app.test_request_context():
+            admission.admit('search')
+            with self.assertRaises(ServiceUnavailable):
+                admission.admit('search')
+            admission.release(g.pop('admitted'))
+            admission.admit('search')
+
+            self.assertEqual(admission.stats()['in_flight'], {"search": 1})
+            self.assertEqual(admission.stats()['shed'], {"search": 1})
+
+    def test_admission_control_released_on_error(self):
+        app = create_app({"DATABASE_PATH": self.database_path,
+                          "CONCURRENCY_LIMITS": {"fail": 1}})
+        app.testing = True
+
+        @app.route('/fail')
+        def fail():
+            raise RuntimeError('failed')
+
+        client = app.test_client()
+        with self.assertRaises(RuntimeError):
+            client.get('/fail')
+        stats = json.loads(client.get('/health/admission').data)
+
+        self.assertEqual(stats['in_flight'], {})
+
+    def test_admission_control_held_while_streaming(self):
+        app = create_app({"DATABASE_PATH": self.database_path,
+                          "CONCURRENCY_LIMITS": {"stream": 1}})
+
+        @app.route('/stream')
+        def stream():
+            return Response(iter([b'a', b'b']))
+
+        client = app.test_client()
+        response = client.get('/stream', buffered=False)
+        shed = client.get('/stream', buffered=False)
+        streaming = json.loads(client.get('/health/admission').data)
+        response.close()
+        closed = json.loads(client.get('/health/admission').data)
+
+        self.assertEqual(shed.status_code, 503)
+        self.assertEqual(streaming['in_flight'], {"stream": 1})
+        self.assertEqual(closed['in_flight'], {})
+
+    """
+      Endpoint: GET /metrics
+    """
+
+    def test_get_metrics_success(self):
+        app = create_app({
+            "DATABASE_PATH": self.database_path,
+            "INSTRUMENTATION": True,
+            "SLOW_REQUEST_THRESHOLD": 0
+        })
+        client = app.test_client()
+
+        with self.assertLogs('trivia.slow_requests', 'WARNING') as logs:
+            client.get('/questions?page=1')
+        response = client.get('/metrics')
+        metrics = response.data.decode('utf-8')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('trivia_requests_total{method="GET",'
+                      'route="/questions",status="200"} 1', metrics)
+        self.assertIn('trivia_request_duration_seconds_count{method="GET",'
+                      'route="/questions"} 1', metrics)
+        self.assertNotIn('trivia_request_sql_statements_sum{method="GET",'
+                         'route="/questions"} 0\n', metrics)
+        self.assertIn('trivia_cache_misses_total{cache="categories"}', metrics)
+        self.assertIn('SELECT', logs.output[0])
+
+    def test_get_metrics_error_not_enabled(self):
+        response = self.client().get('/metrics')
+
+        self.assertEqual(response.status_code, 404)
+
+    """
+      Endpoint: POST /profiling, GET /profiling, GET /profiling/stats
+    """
+
+    def create_profiling_app(self, config=None):
+        return create_app(dict({"DATABASE_PATH": self.database_path,
+                                "DB_CREATE_ALL": False, "PROFILING": True},
+                               **(config or {})))
+
+    def test_profiling_success(self):
+        app = self.create_profiling_app()
+        client = app.test_client()
+
+        response = client.post('/profiling', json={"requests": 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['profiling']['active'],
+                         True)
+        for _ in range(3):
+            client.get('/questions')
+
+        status = json.loads(client.get('/profiling').data)['profiling']
+        call_stats = client.get('/profiling/stats').data.decode('utf-8')
+        dumped = marshal.loads(
+            client.get('/profiling/stats?format=pstats').data)
+        collapsed = client.get('/profiling/stats?format=collapsed')
+
+        self.assertEqual(status['active'], False)
+        self.assertEqual(status['requests'], 2)
+        self.assertIn('get_paginated_questions', call_stats)
+        self.assertIn('get_paginated_questions', [
+            function for _, _, function in dumped])
+        self.assertEqual(collapsed.status_code, 200)
+        for line in collapsed.data.decode('utf-8').splitlines():
+            self.assertRegex(line, r'^\S.* \d+$')
+
+    def test_profiling_stops_after_seconds(self):
+        client = self.create_profiling_app().test_client()
+
+        client.post('/profiling', json={"requests": None, "seconds": 0})
+        client.get('/questions')
+        status = json.loads(client.get('/profiling').data)['profiling']
+
+        self.assertEqual(status['active'], False)
+        self.assertEqual(status['requests'], 0)
+        self.assertEqual(client.get('/profiling/stats').status_code, 404)
+
+    def test_profiling_error_not_local(self):
+        client = self.create_profiling_app().test_client()
+
+        response = client.post('/profiling', environ_base={
+            "REMOTE_ADDR": '203.0.113.7'})
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_profiling_success_with_token(self):
+        client = self.create_profiling_app(
+            {"PROFILING_TOKEN": 'secret'}).test_client()
+
+        local = client.get('/profiling')
+        remote = client.get('/profiling', headers={
+            "X-Profiling-Token": 'secret'}, environ_base={
+            "REMOTE_ADDR": '203.0.113.7'})
+
+        self.assertEqual(local.status_code, 404)
+        self.assertEqual(remote.status_code, 200)
+
+    def test_profiling_error_invalid_limits(self):
+        client = self.create_profiling_app().test_client()
+
+        response = client.post('/profiling', json={"seconds": 'ten'})
+
+        self.assertEqual(response.status_code, 422)
+
+    def test_profiling_error_not_enabled(self):
+        response = self.client().get('/profiling')
+
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('end_request_profile', [
+            hook.__name__ for hooks in self.app.teardown_request_funcs.values()
+            for hook in hooks])
+
+    """
+      JSON serialization
+    """
+
+    def test_encoders_match_jsonify(self):
+        payload = {
+            "success": True,
+            "questions": [question.format()
+                          for question in Question.query.all()],
+            "current_category": None,
+            "text": 'Caf\u00e9 \u2013 "quoted" </script>'
+        }
+
+        with self.app.test_request_context():
+            expected = jsonify(payload).data
+            for name, encode in encoders.items():
+                self.assertEqual(encode(payload), expected, name)
+            self.assertEqual(json_response(payload).data, expected)
+
+    def test_get_questions_same_body_with_stdlib_serializer(self):
+        app = create_app({"DATABASE_PATH": self.database_path,
+                          "SERIALIZER": 'json'})
+        response = app.test_client().get('/questions?page=2')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data,
+                         self.client().get('/questions?page=2').data)
 
     """
       Endpoint: GET /categories
@@ -51,6 +536,99 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['categories']))
         self.assertTrue(data['total_categories'])
 
+    def test_get_categories_success_served_from_cache(self):
+        first_response = self.client().get('/categories')
+        stats = json.loads(self.client().get('/cache/stats').data)
+        second_response = self.client().get('/categories')
+        cached_stats = json.loads(self.client().get('/cache/stats').data)
+
+        self.assertEqual(second_response.status_code, 200)
+        self.assertEqual(second_response.data, first_response.data)
+        self.assertEqual(cached_stats['categories']['hits'],
+                         stats['categories']['hits'] + 1)
+        self.assertEqual(cached_stats['categories']['misses'],
+                         stats['categories']['misses'])
+
+    def test_get_categories_success_invalidated_on_commit(self):
+        for category_cache in [LRUCache(),
+                               KeyValueCache(LocalKeyValueStore())]:
+            app = create_app({"CATEGORY_CACHE": category_cache})
+            setup_db(app, self.database_path)
+            client = app.test_client()
+            total_categories = json.loads(
+                client.get('/categories').data)['total_categories']
+
+            category = Category(type='Music')
+            Question.query.session.add(category)
+            Question.query.session.commit()
+            formatted_category = category.format()
+            try:
+                data = json.loads(client.get('/categories').data)
+                self.assertEqual(data['total_categories'],
+                                 total_categories + 1)
+                self.assertIn(formatted_category, data['categories'])
+            finally:
+                Question.query.session.delete(
+                    Category.query.get(formatted_category['id']))
+                Question.query.session.commit()
+
+            data = json.loads(client.get('/categories').data)
+            self.assertEqual(data['total_categories'], total_categories)
+
+    def test_get_questions_success_gzip(self):
+        plain = self.client().get('/questions')
+        response = self.client().get(
+            '/questions', headers={"Accept-Encoding": 'gzip'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+
+    def test_get_categories_compressed_once(self):
+        app = create_app({"DATABASE_PATH": self.database_path,
+                          "COMPRESSION_MIN_SIZE": 0})
+        client = app.test_client()
+        stats = json.loads(client.get('/cache/stats').data)
+
+        for _ in range(3):
+            response = client.get(
+                '/categories', headers={"Accept-Encoding": 'gzip'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            data = json.loads(gzip.decompress(response.data))
+            self.assertTrue(data['categories'])
+        cached_stats = json.loads(client.get('/cache/stats').data)
+
+        self.assertEqual(cached_stats['compressed_responses']['misses'],
+                         stats['compressed_responses']['misses'] + 1)
+        self.assertEqual(cached_stats['compressed_responses']['hits'],
+                         stats['compressed_responses']['hits'] + 2)
+
+    def test_compressed_responses_cached_by_body(self):
+        app = create_app({"DATABASE_PATH": self.database_path,
+                          "COMPRESSION_MIN_SIZE": 0})
+
+        @app.route('/echo/<text>')
+        def echo(text):
+            response = jsonify({"text": text})
+            response.set_etag('same-for-every-text')
+            return response
+
+        client = app.test_client()
+        bodies = [json.loads(gzip.decompress(client.get(
+            '/echo/{}'.format(text),
+            headers={"Accept-Encoding": 'gzip'}).data))
+            for text in ('first', 'second')]
+
+        self.assertEqual(bodies, [{"text": 'first'}, {"text": 'second'}])
+
+    def test_get_categories_not_compressed_below_min_size(self):
+        response = self.client().get(
+            '/categories', headers={"Accept-Encoding": 'gzip'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+
     """
       Endpoint: GET /questions/<int:category_id>/questions
     """
@@ -117,6 +695,93 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['categories'])
         self.assertIsNone(data['current_category'])
 
+    def test_get_questions_success_last_page(self):
+        total_questions = Question.query.count()
+        last_page = (total_questions - 1) // QUESTIONS_PER_PAGE + 1
+        response = self.client().get('/questions?page={}'.format(last_page))
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(
+            len(data['questions']),
+            total_questions - (last_page - 1) * QUESTIONS_PER_PAGE)
+        self.assertEqual(data['total_questions'], total_questions)
+
+    def test_get_questions_success_with_cursor(self):
+        first_page = json.loads(self.client().get('/questions').data)
+        second_page = json.loads(self.client().get('/questions?page=2').data)
+
+        response = self.client().get(
+            '/questions?cursor={}'.format(first_page['next_cursor']))
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['questions'], second_page['questions'])
+        self.assertEqual(data['total_questions'],
+                         first_page['total_questions'])
+        self.assertEqual(data['next_cursor'], second_page['next_cursor'])
+
+    def test_get_questions_error_cursor_malformed(self):
+        response = self.client().get('/questions?cursor=not-a-cursor')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], MESSAGE_UNPROCESSABLE)
+
+    def test_get_questions_not_modified(self):
+        response = self.client().get('/questions')
+        etag = response.headers['ETag']
+        second_page_etag = self.client().get(
+            '/questions?page=2').headers['ETag']
+
+        self.assertIn('public', response.headers['Cache-Control'])
+        self.assertNotEqual(etag, second_page_etag)
+
+        response = self.client().get(
+            '/questions', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+
+        response = self.client().post('/questions', json=self.new_question.copy())
+        question_id = json.loads(response.data)['created']['id']
+        response = self.client().get(
+            '/questions', headers={"If-None-Match": etag})
+        self.client().delete('/questions/{}'.format(question_id))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_get_questions_not_modified_across_workers(self):
+        config = {"DATABASE_PATH": self.database_path, "DB_CREATE_ALL": False,
+                  "DATA_CHANGES_CHECK_INTERVAL": 0}
+        first, second = create_app(config), create_app(config)
+        etag = first.test_client().get('/questions').headers['ETag']
+
+        response = second.test_client().get(
+            '/questions', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.log_data_change('questions')
+        response = second.test_client().get(
+            '/questions', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_get_categories_not_modified(self):
+        etag = self.client().get('/categories').headers['ETag']
+
+        response = self.client().get(
+            '/categories', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client().get(
+            '/categories/1/questions', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+
     def test_get_questions_error_page_not_exist_beyond_valid_page(self):
         response = self.client().get('/questions?page=10000')
         data = json.loads(response.data)
@@ -163,6 +828,23 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['created']['category'],
                          new_question.category)
 
+    def test_create_question_success_group_commit(self):
+        app = create_app({"DATABASE_PATH": self.database_path,
+                          "DB_CREATE_ALL": False, "GROUP_COMMIT": True})
+
+        response = app.test_client().post(
+            '/questions', json=self.new_question.copy())
+        data = json.loads(response.data)
+
+        new_question = Question.query.order_by(Question.id.desc()).first()
+        new_question.delete()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['created'], new_question.format())
+        self.assertEqual(
+            app.extensions['trivia']['question_writer'].stats(),
+            {"batches": 1, "inserts": 1, "pending": 0})
+
     def test_create_question_error_question_is_missing(self):
         request = self.new_question.copy()
         del request["question"]
@@ -241,6 +923,18 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertIsNone(data['current_category'])
 
+    def test_search_questions_success_while_index_rebuilt(self):
+        search_index.load()
+        search_index.reset()
+        # held by the thread rebuilding the index
+        with search_index._loading:
+            response = self.client().post(
+                '/questions', json={"search_term": 'title'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data['questions'])
+
     def test_search_questions_success_no_results(self):
         response = self.client().post(
             '/questions', json={"search_term": 'QQQQQQQQ'})
@@ -252,6 +946,76 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['total_questions'], 0)
         self.assertIsNone(data['current_category'])
 
+    def test_search_questions_success_prefix_and_answer(self):
+        response = self.client().post(
+            '/questions', json={"search_term": 'scissor'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual(data['questions'][0]['answer'], 'Edward Scissorhands')
+
+    def test_search_questions_success_ranked_with_cursor(self):
+        response = self.client().post('/questions', json={"search_term": 'w'})
+        data = json.loads(response.data)
+        self.assertGreater(data['total_questions'], QUESTIONS_PER_PAGE)
+
+        response = self.client().post(
+            '/questions?cursor={}'.format(data['next_cursor']),
+            json={"search_term": 'w'})
+        next_data = json.loads(response.data)
+        response = self.client().post(
+            '/questions?page=2', json={"search_term": 'w'})
+        second_page = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(next_data['questions'], second_page['questions'])
+        played_ids = [question['id'] for question
+                      in data['questions'] + next_data['questions']]
+        self.assertEqual(len(set(played_ids)), len(played_ids))
+
+    def test_search_questions_success_follows_created_and_deleted(self):
+        new_question = self.new_question.copy()
+        new_question['question'] = 'Which moon of Mars is the Zyxwvutian one?'
+        response = self.client().post('/questions', json=new_question)
+        question_id = json.loads(response.data)['created']['id']
+
+        response = self.client().post(
+            '/questions', json={"search_term": 'zyxwv mars'})
+        data = json.loads(response.data)
+        self.assertEqual([question['id']
+                          for question in data['questions']], [question_id])
+
+        self.client().delete('/questions/{}'.format(question_id))
+        response = self.client().post(
+            '/questions', json={"search_term": 'zyxwv'})
+        data = json.loads(response.data)
+        self.assertEqual(data['total_questions'], 0)
+
+    def test_search_questions_success_follows_other_processes(self):
+        client = create_app({"DATABASE_PATH": self.database_path,
+                             "DB_CREATE_ALL": False,
+                             "DATA_CHANGES_CHECK_INTERVAL": 0}).test_client()
+        search = {"search_term": 'zyxwv'}
+        client.post('/questions', json=search)
+
+        # inserted as another worker would, only logging the change
+        table = Question.__table__
+        question_id = db.session.execute(table.insert().values(dict(
+            self.new_question,
+            question='Which moon of Mars is the Zyxwvutian one?'))
+        ).inserted_primary_key[0]
+        self.log_data_change('questions', question_id, 'insert')
+        try:
+            response = client.post('/questions', json=search)
+        finally:
+            db.session.execute(table.delete().where(table.c.id == question_id))
+            db.session.commit()
+        data = json.loads(response.data)
+
+        self.assertEqual([question['id']
+                          for question in data['questions']], [question_id])
+
     def test_search_questions_error_page_not_exist_beyond_valid_page(self):
         response = self.client().post(
             '/questions?page=10000', json={"search_term": 'title'})
@@ -281,6 +1045,222 @@ class TriviaTestCase(unittest.TestCase):
 
     # @QUESTION Is there any case to be tested when search_questions throws error?
 
+    """
+      Endpoint: GET /questions/counts
+    """
+
+    def test_get_question_counts_success(self):
+        response = self.client().get('/questions/counts')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], Question.query.count())
+        self.assertEqual(
+            data['categories'][str(1)],
+            Question.query.filter(Question.category == 1).count())
+        self.assertEqual(sum(data['difficulties'].values()),
+                         Question.query.filter(
+                             Question.difficulty.isnot(None)).count())
+
+    def test_get_question_counts_follow_created_and_deleted(self):
+        before = json.loads(self.client().get('/questions/counts').data)
+        response = self.client().post('/questions', json=self.new_question.copy())
+        question_id = json.loads(response.data)['created']['id']
+
+        created = json.loads(self.client().get('/questions/counts').data)
+        self.client().delete('/questions/{}'.format(question_id))
+        deleted = json.loads(self.client().get('/questions/counts').data)
+
+        self.assertEqual(created['total_questions'],
+                         before['total_questions'] + 1)
+        self.assertEqual(created['categories']['1'],
+                         before['categories'].get('1', 0) + 1)
+        self.assertEqual(created['difficulties']['3'],
+                         before['difficulties'].get('3', 0) + 1)
+        self.assertEqual(deleted, before)
+
+    def test_question_counts_reconciled_with_database(self):
+        question_counts.reconcile()
+        total = question_counts.total()
+        # committed behind the back of the listeners, e.g. by another worker
+        with self.app.app_context():
+            db.session.execute(Question.__table__.insert().values(
+                question='Q?', answer='A', category=1, difficulty=1))
+            db.session.commit()
+        question_id = Question.query.order_by(Question.id.desc()).first().id
+        stale_total = question_counts.total()
+        question_counts.reconcile()
+        reconciled_total = question_counts.total()
+
+        with self.app.app_context():
+            db.session.execute(Question.__table__.delete().where(
+                Question.id == question_id))
+            db.session.commit()
+        question_counts.reconcile()
+
+        self.assertEqual(stale_total, total)
+        self.assertEqual(reconciled_total, total + 1)
+
+    """
+      Endpoint: POST /questions/import, GET /questions/export
+    """
+
+    def test_import_questions_success_ndjson(self):
+        rows = [self.new_question.copy(), {"question": 'Missing answer'},
+                self.new_question.copy()]
+        body = '\n'.join(json.dumps(row) for row in rows) + '\nnot json\n'
+        total_questions = Question.query.count()
+
+        response = self.client().post(
+            '/questions/import', data=body,
+            content_type='application/x-ndjson')
+        data = json.loads(response.data)
+
+        imported = Question.query.order_by(Question.id.desc()).limit(2).all()
+        for question in imported:
+            question.delete()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['imported'], 2)
+        self.assertEqual(data['rejected'], 2)
+        self.assertEqual([error['line'] for error in data['errors']], [2, 4])
+        self.assertEqual(data['errors'][0]['message'], MESSAGE_UNPROCESSABLE)
+        self.assertEqual([question.question for question in imported],
+                         [self.new_question['question']] * 2)
+        self.assertEqual(Question.query.count(), total_questions)
+
+    def test_import_questions_success_csv(self):
+        body = ('question,answer,difficulty,category\n'
+                '"Which planet has a moon named Phobos?",Mars,3,1\n'
+                'Bad difficulty,Mars,hard,1\n')
+
+        response = self.client().post(
+            '/questions/import', data=body, content_type='text/csv')
+        data = json.loads(response.data)
+
+        question = Question.query.order_by(Question.id.desc()).first()
+        question.delete()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['rejected'], 1)
+        self.assertEqual(data['errors'][0]['line'], 3)
+        self.assertEqual(question.difficulty, 3)
+
+    def test_import_questions_rejects_invalid_types_and_categories(self):
+        rows = [dict(self.new_question, question=5),
+                dict(self.new_question, difficulty='3'),
+                dict(self.new_question, category=True),
+                dict(self.new_question, category=100000),
+                self.new_question.copy()]
+        body = '\n'.join(json.dumps(row) for row in rows) + '\n'
+
+        response = self.client().post(
+            '/questions/import', data=body,
+            content_type='application/x-ndjson')
+        data = json.loads(response.data)
+        Question.query.order_by(Question.id.desc()).first().delete()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['rejected'], 4)
+        self.assertEqual([error['line'] for error in data['errors']],
+                         [1, 2, 3, 4])
+
+    def test_import_questions_csv_reports_bad_records(self):
+        body = (b'question,answer,difficulty,category\n'
+                b'"Which planet has a moon named Phobos?",Mars,3,1\n'
+                b'Not \xff UTF-8,Mars,3,1\n' +
+                b'x' * (csv.field_size_limit() + 1) + b',Mars,3,1\n'
+                b'"Which planet has a moon named Deimos?",Mars,3,1\n')
+
+        response = self.client().post(
+            '/questions/import', data=body, content_type='text/csv')
+        data = json.loads(response.data)
+        for question in Question.query.order_by(
+                Question.id.desc()).limit(2).all():
+            question.delete()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['imported'], 2)
+        self.assertEqual(data['rejected'], 2)
+        self.assertEqual([error['line'] for error in data['errors']], [3, 4])
+
+    def reject_question_inserts(self, text):
+        '''
+        fails the inserts of questions of the given text with an
+        IntegrityError, as a constraint of the database would
+        '''
+        def check(connection, cursor, statement, parameters, context,
+                  executemany):
+            rows = parameters if executemany else [parameters]
+            values = [value for row in rows for value in (
+                row.values() if isinstance(row, dict) else row)]
+            if statement.startswith('INSERT INTO questions') and \
+                    text in values:
+                raise exc.IntegrityError(statement, parameters,
+                                         Exception('rejected'))
+
+        event.listen(Engine, 'before_cursor_execute', check)
+        self.addCleanup(event.remove, Engine, 'before_cursor_execute', check)
+
+    def test_import_questions_batch_retried_per_row(self):
+        self.reject_question_inserts('Rejected by the database?')
+        rows = [self.new_question.copy(),
+                dict(self.new_question, question='Rejected by the database?'),
+                self.new_question.copy()]
+        body = '\n'.join(json.dumps(row) for row in rows) + '\n'
+        total_questions = Question.query.count()
+
+        response = self.client().post(
+            '/questions/import', data=body,
+            content_type='application/x-ndjson')
+        data = json.loads(response.data)
+        imported_count = Question.query.count()
+        for question in Question.query.order_by(
+                Question.id.desc()).limit(2).all():
+            question.delete()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['imported'], 2)
+        self.assertEqual(data['rejected'], 1)
+        self.assertEqual([error['line'] for error in data['errors']], [2])
+        self.assertEqual(imported_count, total_questions + 2)
+
+    def test_export_questions_success(self):
+        response = self.client().get('/questions/export')
+        rows = [json.loads(line) for line in response.data.splitlines()]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(rows, [question.format() for question in
+                                Question.query.order_by(Question.id).all()])
+
+    def test_export_questions_success_gzip(self):
+        plain = self.client().get('/questions/export')
+        response = self.client().get(
+            '/questions/export', headers={"Accept-Encoding": 'gzip'})
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+
+    def test_export_questions_success_csv(self):
+        response = self.client().get('/questions/export?format=csv')
+        lines = response.data.decode('utf-8').splitlines()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(lines[0], 'id,question,answer,category,difficulty')
+        self.assertEqual(len(lines) - 1, Question.query.count())
+
+    def test_export_questions_error_unknown_format(self):
+        response = self.client().get('/questions/export?format=xml')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['message'], MESSAGE_UNPROCESSABLE)
+
     """
       Endpoint: DELETE /questions/<int:question_id>
     """
@@ -308,6 +1288,320 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], MESSAGE_NOT_FOUND)
 
+    """
+      Endpoint: POST /questions/batch, DELETE /questions
+    """
+
+    def test_create_and_delete_questions_success(self):
+        invalid_question = self.new_question.copy()
+        del invalid_question['answer']
+        total_questions = Question.query.count()
+
+        response = self.client().post('/questions/batch', json={"questions": [
+            self.new_question.copy(), invalid_question,
+            self.new_question.copy()]})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_created'], 2)
+        self.assertEqual([result['success'] for result in data['results']],
+                         [True, False, True])
+        self.assertEqual(data['results'][1]['error'], 422)
+        self.assertEqual(data['results'][1]['message'], MESSAGE_UNPROCESSABLE)
+        created = [data['results'][0]['created'],
+                   data['results'][2]['created']]
+        for question in created:
+            self.assertEqual(question,
+                             Question.query.get(question['id']).format())
+        self.assertEqual(Question.query.count(), total_questions + 2)
+
+        created_ids = [question['id'] for question in created]
+        response = self.client().delete('/questions', json={
+            "ids": created_ids + [100000000, created_ids[0]]})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_deleted'], 2)
+        self.assertEqual(data['results'][:2], [
+            {"success": True, "deleted": question_id}
+            for question_id in created_ids])
+        # unknown and repeated ids are not found
+        self.assertEqual(data['results'][2:], [{
+            "success": False, "error": 404, "message": MESSAGE_NOT_FOUND}] * 2)
+        self.assertEqual(Question.query.count(), total_questions)
+
+    def test_create_questions_rejects_untyped_items(self):
+        total_questions = Question.query.count()
+        items = [dict(self.new_question, difficulty='hard'),
+                 dict(self.new_question, category=100000),
+                 dict(self.new_question, question=['Phobos?']),
+                 'Mars',
+                 self.new_question.copy()]
+
+        response = self.client().post('/questions/batch',
+                                      json={"questions": items})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_created'], 1)
+        self.assertEqual([result['success'] for result in data['results']],
+                         [False, False, False, False, True])
+        self.assertEqual([result.get('error') for result in data['results']],
+                         [422, 422, 422, 422, None])
+        self.assertEqual(Question.query.count(), total_questions + 1)
+        self.client().delete('/questions/{}'.format(
+            data['results'][4]['created']['id']))
+
+    def test_create_questions_error_not_an_object(self):
+        response = self.client().post('/questions/batch', json=[1])
+
+        self.assertEqual(response.status_code, 422)
+
+    def test_delete_questions_error_ids_missing(self):
+        response = self.client().delete('/questions', json={"ids": ['1']})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], MESSAGE_UNPROCESSABLE)
+
+    """
+      Background jobs: POST /jobs, GET /jobs/<int:job_id>
+    """
+
+    def create_jobs_app(self, config=None):
+        # jobs run on the test thread, inside the transaction of the test
+        return create_app(dict({"DATABASE_PATH": self.database_path,
+                                "DB_CREATE_ALL": False, "JOB_WORKERS": 0,
+                                "JOB_RETRY_DELAY": 0}, **(config or {})))
+
+    def register_job_kind(self, name, run):
+        job_kind(name)(run)
+        self.addCleanup(job_kinds.pop, name)
+
+    def test_import_questions_background_success(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        app = self.create_jobs_app({"JOB_UPLOAD_DIRECTORY": directory.name})
+        rows = [self.new_question.copy(), {"question": 'Missing answer'},
+                self.new_question.copy()]
+        body = '\n'.join(json.dumps(row) for row in rows) + '\n'
+        total_questions = Question.query.count()
+
+        response = app.test_client().post(
+            '/questions/import?background=true', data=body,
+            content_type='application/x-ndjson')
+        data = json.loads(response.data)
+        jobs = app.extensions['trivia']['jobs']
+        payload = jobs.store.get(data['job']['id']).payload
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(data['job']['status'], QUEUED)
+        self.assertEqual(response.headers['Location'],
+                         'http://localhost/jobs/{}'.format(data['job']['id']))
+        self.assertEqual(Question.query.count(), total_questions)
+        # the upload is staged on disk, the payload only names it
+        with open(os.path.join(directory.name, payload['file'])) as upload:
+            self.assertEqual(upload.read(), body)
+
+        self.assertEqual(jobs.run_pending(), 1)
+        response = app.test_client().get('/jobs/{}'.format(data['job']['id']))
+        job = json.loads(response.data)['job']
+        imported_count = Question.query.count()
+
+        for question in Question.query.order_by(
+                Question.id.desc()).limit(2).all():
+            question.delete()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(job['status'], SUCCEEDED)
+        self.assertEqual(job['attempts'], 1)
+        self.assertEqual(job['progress'], {"done": 3, "total": None})
+        self.assertEqual(job['result']['imported'], 2)
+        self.assertEqual(job['result']['rejected'], 1)
+        self.assertEqual(job['result']['errors'][0]['line'], 2)
+        self.assertEqual(imported_count, total_questions + 2)
+        self.assertEqual(os.listdir(directory.name), [])
+
+    def test_import_questions_background_error_too_large(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        app = self.create_jobs_app({"JOB_UPLOAD_DIRECTORY": directory.name,
+                                    "JOB_UPLOAD_MAX_BYTES": 10})
+        client = app.test_client()
+        body = json.dumps(self.new_question) + '\n'
+
+        response = client.post(
+            '/questions/import?background=true', data=body,
+            content_type='application/x-ndjson')
+        data = json.loads(response.data)
+        # chunked, without a length up front
+        chunked = client.post(
+            '/questions/import?background=true',
+            input_stream=io.BytesIO(body.encode()),
+            content_type='application/x-ndjson',
+            environ_overrides={"wsgi.input_terminated": True})
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(data['message'], MESSAGE_TOO_LARGE)
+        self.assertEqual(chunked.status_code, 413)
+        self.assertEqual(os.listdir(directory.name), [])
+
+    def test_import_questions_background_retry_resumes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        app = self.create_jobs_app({"JOB_UPLOAD_DIRECTORY": directory.name,
+                                    "JOB_MAX_ATTEMPTS": 1})
+        jobs = app.extensions['trivia']['jobs']
+
+        with app.test_request_context():
+            name = stage_upload(io.BytesIO(b'{"question": "Missing answer"}'),
+                                'ndjson')
+        job = jobs.enqueue('import_questions', {"file": name})
+        jobs.store.update(job.id, 0, {"progress_done": 1})
+
+        self.assertEqual(jobs.run_pending(), 1)
+        job = jobs.get(job.id)
+        self.assertEqual(job.status, SUCCEEDED)
+        self.assertEqual(job.result['rejected'], 0)
+        self.assertEqual(os.listdir(directory.name), [])
+
+        job = jobs.enqueue('import_questions', {"file": name})
+        jobs.run_pending()
+        self.assertEqual(jobs.get(job.id).status, FAILED)
+        self.assertIn('FileNotFoundError', jobs.get(job.id).error)
+
+        for payload in ({"file": '../trivia.psql'},
+                        {"rows": [[1, self.new_question]]}):
+            with self.assertRaises(ValueError):
+                jobs.enqueue('import_questions', payload)
+
+    def test_delete_questions_background_success(self):
+        app = self.create_jobs_app()
+        question_ids = [question.id for question in Question.query.order_by(
+            Question.id.desc()).limit(2)]
+        total_questions = Question.query.count()
+
+        response = app.test_client().delete(
+            '/questions?background=true',
+            json={"ids": question_ids + [100000000]})
+        job_id = json.loads(response.data)['job']['id']
+        app.extensions['trivia']['jobs'].run_pending()
+        job = json.loads(app.test_client().get(
+            '/jobs/{}'.format(job_id)).data)['job']
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(job['status'], SUCCEEDED)
+        self.assertEqual(job['result'], {"deleted": sorted(question_ids),
+                                         "total_deleted": 2})
+        self.assertEqual(Question.query.count(), total_questions - 2)
+
+    def test_create_job_success_maintenance(self):
+        app = self.create_jobs_app()
+        client = app.test_client()
+        job_ids = [json.loads(client.post('/jobs', json={"kind": kind}).data)[
+            'job']['id'] for kind in ('reindex_search', 'reconcile_counts')]
+
+        app.extensions['trivia']['jobs'].run_pending()
+        results = [json.loads(client.get('/jobs/{}'.format(job_id)).data)[
+            'job']['result'] for job_id in job_ids]
+
+        total_questions = Question.query.count()
+        self.assertEqual(results, [{"indexed": total_questions},
+                                   {"total_questions": total_questions}])
+
+    def test_maintenance_jobs_reset_other_processes(self):
+        app = self.create_jobs_app()
+        jobs = app.extensions['trivia']['jobs']
+        table = DataChange.__table__
+        count_resets = select([func.count()]).where(and_(
+            table.c.name == 'questions', table.c.action == 'reset'))
+        resets = db.session.execute(count_resets).scalar()
+
+        jobs.enqueue('reindex_search')
+        jobs.enqueue('reconcile_counts')
+        jobs.run_pending()
+
+        self.assertEqual(db.session.execute(count_resets).scalar(),
+                         resets + 2)
+
+    def test_create_job_error_invalid(self):
+        client = self.create_jobs_app().test_client()
+
+        for body in ({"kind": 'unknown'},
+                     {"kind": 'delete_questions', "payload": {"ids": ['1']}},
+                     {"kind": 'reconcile_counts', "payload": []},
+                     ['reconcile_counts'], 'reconcile_counts'):
+            response = client.post('/jobs', json=body)
+            data = json.loads(response.data)
+
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(data['message'], MESSAGE_UNPROCESSABLE)
+
+    def test_get_job_error_not_exist(self):
+        response = self.client().get('/jobs/100000000')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['message'], MESSAGE_NOT_FOUND)
+
+    def test_job_retried_with_progress_then_failed(self):
+        app = self.create_jobs_app({"JOB_MAX_ATTEMPTS": 2})
+        seen = []
+
+        def run(job, progress):
+            seen.append((job.progress_done, job.result))
+            progress(job.progress_done + 1, 10, {"attempt": job.attempts})
+            raise RuntimeError('attempt {}'.format(job.attempts))
+
+        self.register_job_kind('flaky', run)
+        jobs = app.extensions['trivia']['jobs']
+        job_id = jobs.enqueue('flaky').id
+
+        self.assertEqual(jobs.run_pending(), 2)
+        job = jobs.get(job_id)
+        self.assertEqual(seen, [(0, None), (1, {"attempt": 1})])
+        self.assertEqual(job.status, FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(job.progress_done, 2)
+        self.assertEqual(job.error, 'RuntimeError: attempt 2')
+
+    def test_job_retried_after_delay(self):
+        app = self.create_jobs_app({"JOB_RETRY_DELAY": 60})
+        self.register_job_kind('flaky', lambda job, progress: 1 / 0)
+        jobs = app.extensions['trivia']['jobs']
+        job_id = jobs.enqueue('flaky').id
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(jobs.get(job_id).status, QUEUED)
+        self.assertEqual(jobs.get(job_id).error,
+                         'ZeroDivisionError: division by zero')
+
+    def test_database_job_store_success(self):
+        Job.__table__.create(db.session.connection(), checkfirst=True)
+        app = self.create_jobs_app({"JOB_STORE": 'database'})
+        question_id = Question.query.order_by(Question.id.desc()).first().id
+
+        response = app.test_client().delete(
+            '/questions?background=true', json={"ids": [question_id]})
+        job_id = json.loads(response.data)['job']['id']
+        jobs = app.extensions['trivia']['jobs']
+        # the job is in the table, whichever process runs it
+        self.assertEqual(db.session.query(Job.status).filter(
+            Job.id == job_id).scalar(), QUEUED)
+
+        self.assertEqual(jobs.run_pending(), 1)
+        job = json.loads(app.test_client().get(
+            '/jobs/{}'.format(job_id)).data)['job']
+
+        self.assertEqual(job['status'], SUCCEEDED)
+        self.assertEqual(job['result'], {"deleted": [question_id],
+                                         "total_deleted": 1})
+        self.assertIsNone(Question.query.get(question_id))
+        self.assertIsNone(jobs.store.claim(60))
+
     """
       Endpoint: POST /quizzes
     """
@@ -356,6 +1650,205 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertIsNone(data['question'])
 
+    def test_get_guesses_success_plays_every_question_once(self):
+        category = Category.query.first()
+        expected_ids = sorted(question.id for question in
+                              Question.query.filter(
+                                  Question.category == category.id).all())
+
+        previous_questions = []
+        for _ in expected_ids:
+            response = self.client().post(
+                '/quizzes', json={"quiz_category": category.format(),
+                                  "previous_questions": previous_questions})
+            data = json.loads(response.data)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['question']['category'], category.id)
+            self.assertNotIn(data['question']['id'], previous_questions)
+            previous_questions.append(data['question']['id'])
+
+        self.assertEqual(sorted(previous_questions), expected_ids)
+
+    def test_get_guesses_success_all_categories(self):
+        response = self.client().post(
+            '/quizzes', json={"quiz_category": {"type": "click", "id": 0}})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIsNotNone(Question.query.get(data['question']['id']))
+
+    def test_get_guesses_adaptive_success_starts_at_target(self):
+        response = self.client().post(
+            '/quizzes', json={"quiz_category": {"id": 0}, "adaptive": {}})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['target_difficulty'], 2)
+        self.assertEqual(data['question']['difficulty'], 2)
+
+    def test_get_guesses_adaptive_success_moves_target(self):
+        targets = []
+        for adaptive in [{"target": 2, "correct": True},
+                         {"target": 2, "correct": False},
+                         {"target": 1, "correct": False},
+                         {"target": 2}]:
+            response = self.client().post('/quizzes', json={
+                "quiz_category": {"id": 0}, "adaptive": adaptive})
+            targets.append(json.loads(response.data)['target_difficulty'])
+
+        self.assertEqual(targets, [3, 1, 1, 2])
+
+    def test_get_guesses_adaptive_success_nearest_difficulty(self):
+        played = [question.id for question in
+                  Question.query.filter(Question.difficulty == 2).all()]
+
+        response = self.client().post('/quizzes', json={
+            "quiz_category": {"id": 0}, "previous_questions": played,
+            "adaptive": {}})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(data['question']['difficulty'], [1, 3])
+
+    def test_get_guesses_adaptive_success_follows_created_and_deleted(self):
+        new_question = dict(self.new_question, difficulty=5)
+        response = self.client().post('/questions', json=new_question)
+        question_id = json.loads(response.data)['created']['id']
+        played = [question.id for question in Question.query.filter(
+            Question.category == 1, Question.difficulty == 5,
+            Question.id != question_id).all()]
+        request = {"quiz_category": {"id": 1}, "previous_questions": played,
+                   "adaptive": {"target": 5}}
+
+        created = json.loads(self.client().post('/quizzes', json=request).data)
+        self.client().delete('/questions/{}'.format(question_id))
+        deleted = json.loads(self.client().post('/quizzes', json=request).data)
+
+        self.assertEqual(created['question']['id'], question_id)
+        self.assertNotEqual(deleted['question']['id'], question_id)
+
+    def test_get_guesses_adaptive_error_target_not_int(self):
+        response = self.client().post('/quizzes', json={
+            "quiz_category": {"id": 0}, "adaptive": {"target": "hard"}})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], MESSAGE_UNPROCESSABLE)
+
+    def count_statements(self, function):
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            result = function()
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+        return result, statements
+
+    def create_deck_app(self, **config):
+        return create_app(dict(config, DATABASE_PATH=self.database_path,
+                               QUIZ_DECKS=True))
+
+    def test_get_guesses_success_from_deck_without_queries(self):
+        client = self.create_deck_app().test_client()
+        category_ids = [question.id for question in
+                        Question.query.filter(Question.category == 1).all()]
+        quiz = {"quiz_category": {"id": 1},
+                "previous_questions": category_ids[1:]}
+
+        client.post('/quizzes', json=quiz)
+        response, statements = self.count_statements(
+            lambda: client.post('/quizzes', json=quiz))
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['question'],
+                         Question.query.get(category_ids[0]).format())
+        self.assertEqual(statements, [])
+
+    def test_get_guesses_success_deck_follows_created_and_deleted(self):
+        client = self.create_deck_app().test_client()
+        played = [question.id for question in Question.query.filter(
+            Question.category == 1, Question.difficulty == 5).all()]
+        quiz = {"quiz_category": {"id": 1}, "previous_questions": played,
+                "adaptive": {"target": 5}}
+        client.post('/quizzes', json=quiz)
+
+        response = client.post('/questions', json=dict(
+            self.new_question, difficulty=5))
+        created = json.loads(response.data)['created']
+        drawn = json.loads(client.post('/quizzes', json=quiz).data)
+        client.delete('/questions/{}'.format(created['id']))
+        deleted = json.loads(client.post('/quizzes', json=quiz).data)
+
+        self.assertEqual(drawn['question'], created)
+        self.assertNotEqual(deleted['question']['id'], created['id'])
+
+    def test_quiz_session_success_from_deck(self):
+        self.play_quiz_session(self.create_deck_app().test_client())
+
+    def test_quiz_decks_shared_through_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'questions.deck')
+            self.create_deck_app(QUIZ_DECK_PATH=path, QUIZ_DECK_PRELOAD=True)
+            store = DeckStore(path)
+
+            _, statements = self.count_statements(store.ensure_loaded)
+            question = store.draw(ALL_CATEGORIES)
+
+            self.assertEqual(statements, [])
+            self.assertEqual(question.format(),
+                             Question.query.get(question.id).format())
+
+    def test_quiz_deck_drawn_from_while_rebuilt_after_reset(self):
+        store = DeckStore()
+        with self.app.app_context():
+            store.ensure_loaded()
+            question_id = self.insert_question_elsewhere()
+            played = [question.id for question in Question.query.filter(
+                Question.id != question_id).all()]
+            store.on_question_change('reset', [])
+
+            # as while a thread of its own rebuilds the deck
+            with store._refreshing:
+                stale = store.draw(ALL_CATEGORIES, set(played))
+            store.refresh()
+            fresh = store.draw(ALL_CATEGORIES, set(played))
+
+        self.assertTrue(store.loaded)
+        self.assertIsNone(stale)
+        self.assertEqual(fresh.id, question_id)
+
+    def test_deck_draws_and_lookups(self):
+        deck = Deck(build_deck([
+            (3, 'Caf\u00e9?', 'Oui', 2, 1),
+            (1, 'One?', 'Yes', 1, 2),
+            (2, 'Two?', 'No', 1, 1),
+            (4, 'Four?', 'Maybe', None, None)
+        ]))
+
+        self.assertEqual(len(deck), 4)
+        self.assertEqual(deck.get(3).format(), {
+            "id": 3, "question": 'Caf\u00e9?', "answer": 'Oui',
+            "category": 2, "difficulty": 1})
+        self.assertIsNone(deck.get(5))
+        self.assertEqual(deck.count(ALL_CATEGORIES), 4)
+        self.assertEqual(deck.count(1), 2)
+        self.assertEqual(deck.count(ALL_CATEGORIES, 1), 2)
+        self.assertEqual(deck.draw(1, {1}).id, 2)
+        self.assertEqual(deck.draw(ALL_CATEGORIES, {2}, 1).id, 3)
+        self.assertEqual(deck.draw(1, set(), 2).id, 1)
+        self.assertIsNone(deck.draw(1, {1, 2}))
+        self.assertIsNone(deck.draw(7))
+        self.assertIsNone(Deck(build_deck([])).draw(ALL_CATEGORIES))
+
     def test_get_guesses_error_no_category_specified(self):
         response = self.client().post('/quizzes')
         data = json.loads(response.data)
@@ -364,6 +1857,354 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], MESSAGE_UNPROCESSABLE)
 
+    def test_get_guesses_error_category_not_an_object(self):
+        for body in [{"quiz_category": 1, "previous_questions": []}, [1]]:
+            response = self.client().post('/quizzes', json=body)
+            data = json.loads(response.data)
+
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(data['message'], MESSAGE_UNPROCESSABLE)
+
+    def log_data_change(self, name, record_id=None, action='reset'):
+        '''
+        appends a change as the commit of another process would, without
+        notifying the listeners of this one, and returns its version
+        '''
+        version = db.session.execute(DataChange.__table__.insert().values(
+            name=name, record_id=record_id, action=action)
+        ).inserted_primary_key[0]
+        db.session.commit()
+        return version
+
+    def insert_question_elsewhere(self):
+        '''
+        inserts a question as another process would, returning its id
+        '''
+        question_id = db.session.execute(Question.__table__.insert().values(
+            self.new_question)).inserted_primary_key[0]
+        self.log_data_change('questions', question_id, 'insert')
+        return question_id
+
+    def delete_question_elsewhere(self, question_id):
+        table = Question.__table__
+        db.session.execute(table.delete().where(table.c.id == question_id))
+        self.log_data_change('questions', question_id, 'delete')
+
+    def test_question_index_follows_changes_of_other_processes(self):
+        with self.app.app_context():
+            data_changes.reset()
+            data_changes.check()
+            question_index.ensure_loaded()
+            question = Question('Who?', 'Me', 1, 1)
+            question.insert()
+            question.delete()
+            data_changes.check(0)
+            count = question_index.count(ALL_CATEGORIES)
+
+            question_id = self.insert_question_elsewhere()
+            data_changes.check(None)
+            self.assertEqual(question_index.count(ALL_CATEGORIES), count)
+            data_changes.check(0)
+            self.assertTrue(question_index.loaded)
+            self.assertIn(question_id, question_index.ids(ALL_CATEGORIES))
+
+            self.delete_question_elsewhere(question_id)
+            data_changes.check(0)
+            self.assertTrue(question_index.loaded)
+            self.assertEqual(question_index.count(ALL_CATEGORIES), count)
+
+    def test_data_changes_reset_once_a_change_is_missed(self):
+        with self.app.app_context():
+            data_changes.reset()
+            data_changes.check()
+            question_index.ensure_loaded()
+            # a version whose change never shows up
+            table = DataChange.__table__
+            missing = self.log_data_change('questions', 0, 'insert')
+            db.session.execute(table.delete().where(
+                table.c.version == missing))
+            question_id = self.insert_question_elsewhere()
+            self.addCleanup(self.delete_question_elsewhere, question_id)
+
+            data_changes.check(0)
+            self.assertTrue(question_index.loaded)
+            data_changes.hole_timeout = 0
+            self.addCleanup(setattr, data_changes, 'hole_timeout',
+                            DATA_CHANGES_HOLE_TIMEOUT)
+            data_changes.check(0)
+            self.assertFalse(question_index.loaded)
+
+    """
+      Endpoint: POST /quizzes/sessions
+    """
+
+    def play_quiz_session(self, client):
+        category = Category.query.first()
+        expected_ids = sorted(question.id for question in
+                              Question.query.filter(
+                                  Question.category == category.id).all())
+
+        response = client.post(
+            '/quizzes/sessions', json={"quiz_category": category.format()})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], len(expected_ids))
+
+        played_ids = []
+        for _ in expected_ids:
+            response = client.post(
+                '/quizzes', json={"session_id": data['session_id']})
+            question = json.loads(response.data)['question']
+            self.assertEqual(question['category'], category.id)
+            played_ids.append(question['id'])
+
+        response = client.post(
+            '/quizzes', json={"session_id": data['session_id']})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(json.loads(response.data)['question'])
+        self.assertEqual(sorted(played_ids), expected_ids)
+
+    def test_quiz_session_success(self):
+        self.play_quiz_session(self.client())
+
+    def test_quiz_session_success_key_value_store(self):
+        app = create_app({
+            "QUIZ_SESSION_STORE": KeyValueSessionStore(LocalKeyValueStore())
+        })
+        setup_db(app, self.database_path)
+        self.play_quiz_session(app.test_client())
+
+    def test_quiz_session_error_session_not_exist(self):
+        response = self.client().post(
+            '/quizzes', json={"session_id": 'not-a-session'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], MESSAGE_NOT_FOUND)
+
+    def test_delete_quiz_session_success(self):
+        response = self.client().post(
+            '/quizzes/sessions', json={"quiz_category": {"id": 0}})
+        session_id = json.loads(response.data)['session_id']
+
+        response = self.client().delete(
+            '/quizzes/sessions/{}'.format(session_id))
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['deleted'], session_id)
+        response = self.client().post(
+            '/quizzes', json={"session_id": session_id})
+        self.assertEqual(response.status_code, 404)
+
+    def test_quiz_session_store_evicts_expired_sessions(self):
+        for store in [InMemorySessionStore(ttl=0),
+                      KeyValueSessionStore(LocalKeyValueStore(), ttl=0)]:
+            session_id = store.create(1, [1, 2, 3])
+            with self.assertRaises(KeyError):
+                store.next_turn(session_id)
+
+        store = InMemorySessionStore(max_sessions=2)
+        session_ids = [store.create(1, [1]) for _ in range(3)]
+        self.assertEqual(len(store), 2)
+        with self.assertRaises(KeyError):
+            store.next_turn(session_ids[0])
+        self.assertEqual(store.next_turn(session_ids[2]), (1, 1))
+
+    def test_quiz_session_store_plays_each_id_of_the_span_once(self):
+        for store in [InMemorySessionStore(),
+                      KeyValueSessionStore(LocalKeyValueStore())]:
+            session_id = store.create(2, [10, 14, 1009])
+            turns = [store.next_turn(session_id) for _ in range(1000)]
+
+            self.assertEqual(sorted(turns), [(2, question_id) for question_id
+                                             in range(10, 1010)])
+            self.assertNotEqual(turns, sorted(turns))
+            self.assertIsNone(store.next_turn(session_id))
+            self.assertIsNone(store.next_turn(store.create(2, [])))
+
+        for size in range(1, 70):
+            self.assertEqual(sorted(
+                permuted_position(7, position, size)
+                for position in range(size)), list(range(size)))
+
+    """
+      Benchmarks
+    """
+
+    def test_percentile_nearest_rank(self):
+        self.assertEqual(percentile(list(range(1, 101)), 0.99), 99)
+        self.assertEqual(percentile(list(range(1, 101)), 0.5), 50)
+        self.assertEqual(percentile(list(range(1, 11)), 0.5), 5)
+        self.assertEqual(percentile(list(range(1, 11)), 1), 10)
+        self.assertEqual(percentile([7], 0), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+
+class TriviaAsgiTestCase(TriviaTestCase):
+    """This class runs the trivia test case against the ASGI app"""
+
+    # the native routes read through their own connections, which do not
+    # see the writes of an open transaction
+    rollback = False
+
+    def setUp(self):
+        super().setUp()
+        self.asgi_app = TriviaASGI(self.app)
+        self.client = self.asgi_app.test_client
+
+    def tearDown(self):
+        self.asgi_app.test_client().close()
+        super().tearDown()
+
+    def test_reads_success_asgi_replica(self):
+        app = self.create_replica_app([self.database_path])
+        asgi_app = TriviaASGI(app)
+        try:
+            response = asgi_app.test_client().get('/questions')
+        finally:
+            asgi_app.test_client().close()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(app.extensions['replicas'].replicas[0].reads, 1)
+
+    def post_chunked(self, path, body):
+        '''
+        posts a JSON body to the ASGI app one byte per message, without a
+        Content-Length, and returns the status and data of the response
+        '''
+        chunks = [body[start:start + 1] for start in range(len(body))]
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': chunks.pop(0),
+                    'more_body': bool(chunks)}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            'type': 'http', 'http_version': '1.1', 'method': 'POST',
+            'scheme': 'http', 'path': path, 'query_string': b'',
+            'root_path': '', 'server': ('localhost', 80),
+            'headers': [(b'content-type', b'application/json')]
+        }
+        self.client().loop.run_until_complete(
+            self.asgi_app(scope, receive, send))
+        return messages[0]['status'], json.loads(b''.join(
+            message.get('body', b'') for message in messages[1:]))
+
+    def test_chunked_body_success(self):
+        quiz_status, quiz = self.post_chunked(
+            '/quizzes', json.dumps({"quiz_category": {"id": 0}}).encode())
+        search_status, search = self.post_chunked(
+            '/questions', json.dumps({"search_term": 'title'}).encode())
+
+        self.assertEqual(quiz_status, 200)
+        self.assertTrue(quiz['question'])
+        self.assertEqual(search_status, 200)
+        self.assertEqual(search['success'], True)
+
+    def test_before_request_hooks_run_in_executor(self):
+        app = create_app({"DATABASE_PATH": self.database_path,
+                          "DB_CREATE_ALL": False})
+        threads = []
+        app.before_request(
+            lambda: threads.append(threading.current_thread().name))
+        asgi_app = TriviaASGI(app)
+        try:
+            response = asgi_app.test_client().get('/categories')
+        finally:
+            asgi_app.test_client().close()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(threads[0].startswith('trivia-asgi'))
+
+
+class TriviaGroupCommitTestCase(unittest.TestCase):
+    """This class runs the group commit writer against the database"""
+
+    # group commit leaders write from their own threads, through their own
+    # connections, so these tests commit and clean up after themselves
+    # instead of running in a transaction rolled back afterwards
+
+    @classmethod
+    def setUpClass(cls):
+        cls.database_name = "trivia_test"
+        cls.database_path = "postgres://{}/{}".format(
+            'localhost:5432', cls.database_name)
+        cls.app = create_app({"DATABASE_PATH": cls.database_path,
+                              "DB_CREATE_ALL": False})
+
+    def setUp(self):
+        db.app = self.app
+        self.new_question = {
+            "question": 'Which planet has a moon named Phobos?',
+            "answer": "Mars",
+            "difficulty": 3,
+            "category": 1
+        }
+
+    def insert_concurrently(self, writer, questions):
+        results = [None] * len(questions)
+
+        def insert(index):
+            with self.app.app_context():
+                try:
+                    results[index] = writer.insert(questions[index])
+                except Exception as error:
+                    results[index] = error
+
+        threads = [threading.Thread(target=insert, args=(index,))
+                   for index in range(len(questions))]
+        # every insert queues up while a batch is being committed
+        with writer._committing:
+            for thread in threads:
+                thread.start()
+            while writer.stats()['pending'] < len(questions):
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_group_commit_one_transaction_per_batch(self):
+        writer = GroupCommitWriter(max_batch=3)
+        questions = [dict(self.new_question, question=str(number))
+                     for number in range(5)]
+
+        records = self.insert_concurrently(writer, questions)
+        with self.app.app_context():
+            stored = [Question.query.get(record.id).format()
+                      for record in records]
+            Question.delete_all([record.id for record in records])
+
+        self.assertEqual([record.question for record in records],
+                         [question['question'] for question in questions])
+        self.assertEqual(len(set(record.id for record in records)), 5)
+        self.assertEqual(stored, [record._asdict() for record in records])
+        self.assertEqual(writer.stats(),
+                         {"batches": 2, "inserts": 5, "pending": 0})
+
+    def test_group_commit_error_of_one_insert(self):
+        writer = GroupCommitWriter()
+        questions = [self.new_question.copy(),
+                     dict(self.new_question, unknown_column=1),
+                     self.new_question.copy()]
+
+        results = self.insert_concurrently(writer, questions)
+        with self.app.app_context():
+            Question.delete_all([results[0].id, results[2].id])
+
+        self.assertIsInstance(results[1], TypeError)
+        self.assertEqual(results[0].question, self.new_question['question'])
+        self.assertEqual(results[2].question, self.new_question['question'])
+        # the failed batch is retried one question per transaction
+        self.assertEqual(writer.stats(),
+                         {"batches": 2, "inserts": 2, "pending": 0})
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
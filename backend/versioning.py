@@ -0,0 +1,148 @@
+import functools
+import hashlib
+import secrets
+import weakref
+
+from flask import current_app, make_response, request
+
+from changes import data_changes, select_position
+from models import db, category_listeners, question_listeners
+from replicas import reading_replica
+from constants import READ_CACHE_MAX_AGE, READ_CACHE_SHARED_MAX_AGE
+
+
+'''
+DataVersions
+    monotonically increasing versions of the data behind the read endpoints.
+    By default they are the versions of the data_changes table, appended
+    to by every commit and shared by every worker, as changes.data_changes
+    caught up with them. Given a key-value store, e.g. a redis client, they are
+    counters kept there instead, and a random epoch stored alongside keeps
+    validators from repeating once the counters are lost
+'''
+
+
+class DataVersions:
+
+    def __init__(self, client=None, prefix='data_version:'):
+        self.client = client
+        self.prefix = prefix
+
+    def epoch(self):
+        if self.client is None:
+            # the versions outlive every process
+            return 'db'
+        epoch = self.client.get(self.prefix + 'epoch')
+        if epoch is None:
+            self.client.set(self.prefix + 'epoch', secrets.token_hex(4))
+            epoch = self.client.get(self.prefix + 'epoch')
+        return epoch.decode('ascii')
+
+    def get(self, resource):
+        if self.client is None:
+            return data_changes.version(resource)
+        return int(self.client.get(self.prefix + resource) or 0)
+
+    def bump(self, resource):
+        if self.client is None:
+            # appended to by the commit itself, see models.log_data_changes
+            return None
+        return self.client.incr(self.prefix + resource)
+
+    def etag(self, resources, key, replica_position=None):
+        '''
+        returns a validator of the response identified by key, e.g. a path
+        and query string, built from the versions of the resources it reads.
+        A response read from a replica also depends on replica_position, the
+        latest version of data_changes the replica replayed, so that it is
+        validated again once the replica caught up
+        '''
+        versions = '.'.join(str(self.get(resource)) for resource in resources)
+        if replica_position is not None:
+            versions += 'r{}'.format(replica_position)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+        return '{}-{}-{}'.format(self.epoch(), versions, digest)
+
+
+'''
+data_version_sets
+    DataVersions registered by create_app, bumped as questions and
+    categories are committed or the database is rebound
+'''
+data_version_sets = weakref.WeakSet()
+
+
+def bump_versions(*resources):
+    for versions in list(data_version_sets):
+        for resource in resources:
+            versions.bump(resource)
+
+
+def on_question_change(action, questions):
+    if action == 'reset':
+        bump_versions('questions', 'categories')
+    else:
+        bump_versions('questions')
+
+
+question_listeners.append(on_question_change)
+category_listeners.append(lambda: bump_versions('categories'))
+
+
+'''
+read_replica_position()
+    the latest version of data_changes on the replica the request reads
+    from, or None when it reads from the primary
+'''
+
+
+def read_replica_position():
+    if not reading_replica():
+        return None
+    return db.session.execute(select_position()).scalar() or 0
+
+
+'''
+set_validators(response, etag, config)
+    sets the weak ETag and the Cache-Control header of a read response, with
+    the max ages given by the READ_CACHE_* settings of config
+'''
+
+
+def set_validators(response, etag, config):
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = config.get(
+        'READ_CACHE_MAX_AGE', READ_CACHE_MAX_AGE)
+    shared_max_age = config.get(
+        'READ_CACHE_SHARED_MAX_AGE', READ_CACHE_SHARED_MAX_AGE)
+    if shared_max_age is not None:
+        response.cache_control.s_maxage = shared_max_age
+    return response
+
+
+'''
+conditional(versions, *resources)
+    decorates a read route so that it answers 304 Not Modified, without
+    running the route, when the If-None-Match header of the request holds
+    the current validator of the response. Successful responses carry the
+    validator as a weak ETag and a Cache-Control header for shared caches
+'''
+
+
+def conditional(versions, *resources):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = versions.etag(resources, request.full_path,
+                                 read_replica_position())
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            return set_validators(response, etag, current_app.config)
+        return wrapper
+    return decorator